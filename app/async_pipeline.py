@@ -0,0 +1,200 @@
+import asyncio
+import functools
+import itertools
+import time
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+from app import common
+from app import populate_tables
+from app.bulk_writer import AsyncBulkWriter
+from app.load_stats import LoadStats
+from app.partitions import Partitions, is_partitioned
+from app.scheduler import STAGE_DEPENDENCIES
+from app.sources import iter_lines
+from app.transform import _transform_chunk, process_pool
+from config.config import LOAD_SETTINGS
+
+
+async def populate_tables_async(load, sources, transform_workers=None):
+    """
+    Populates every table with three concurrent stages connected by
+    bounded queues: fetching lines of the source, decoding and
+    transforming them and writing rows through asyncpg. Writing starts
+    as soon as tables the table references are committed, while
+    fetching and transforming start at once and wait when queues are full.
+    Chunks of lines are decoded and transformed in threads, or in worker
+    processes with transform workers, so the event loop keeps fetching
+    and writing meanwhile
+    """
+    executor = process_pool(transform_workers) if transform_workers else None
+    pool = await common.create_async_pool()
+    try:
+        committed = {table: asyncio.Event() for table in populate_tables.TABLES}
+        await _gather(
+            _load_table(pool, load, table, sources[table], committed, executor)
+            for table in populate_tables.TABLES)
+    finally:
+        await pool.close()
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+
+
+async def _load_table(pool, load, table, source, committed, executor=None):
+    chunk_size = LOAD_SETTINGS['TRANSFORM_CHUNK_SIZE']
+    queue_size = max(1, LOAD_SETTINGS['PREFETCH_SIZE'] // chunk_size)
+    lines = asyncio.Queue(queue_size)
+    transformed = asyncio.Queue(queue_size)
+    metrics = load['metrics']
+    await _gather([
+        fetch_lines(source, lines, chunk_size, metrics, table=table),
+        _transform(table, lines, transformed, executor, metrics),
+        _write(pool, load, table, transformed, committed)
+    ])
+    committed[table].set()
+
+
+async def _gather(coroutines):
+    """
+    Runs coroutines concurrently. The first failed one cancels the rest
+    and its error is raised
+    """
+    tasks = [asyncio.ensure_future(coroutine) for coroutine in coroutines]
+    try:
+        await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+
+
+async def fetch_lines(source, lines, chunk_size, metrics=None, **labels):
+    """
+    Puts chunks of lines of the source to the queue and None after the
+    last one. Links are downloaded with aiohttp when it is installed,
+    other sources are read in a thread so the event loop is not blocked.
+    Time spent waiting for lines is added to metrics
+    """
+    fetch_time = 0
+    if aiohttp is not None and source.startswith(('http://', 'https://')):
+        timeout = aiohttp.ClientTimeout(sock_read=LOAD_SETTINGS['DOWNLOAD_TIMEOUT'])
+        async with aiohttp.ClientSession(raise_for_status=True,
+                                         timeout=timeout) as session:
+            async with session.get(source) as response:
+                chunk = []
+                content = aiter(response.content)
+                while True:
+                    start = time.perf_counter()
+                    line = await anext(content, None)
+                    fetch_time += time.perf_counter() - start
+                    if line is None:
+                        break
+                    chunk.append(line)
+                    if len(chunk) >= chunk_size:
+                        await lines.put(chunk)
+                        chunk = []
+                if chunk:
+                    await lines.put(chunk)
+    else:
+        source_lines = iter_lines(source)
+        while True:
+            start = time.perf_counter()
+            chunk = await asyncio.to_thread(
+                list, itertools.islice(source_lines, chunk_size))
+            fetch_time += time.perf_counter() - start
+            if not chunk:
+                break
+            await lines.put(chunk)
+    await lines.put(None)
+    if metrics is not None:
+        metrics.inc('stage_seconds_total', fetch_time, stage='fetch', **labels)
+
+
+async def _transform(table, lines, transformed, executor=None, metrics=None):
+    """
+    Decodes and transforms chunks of lines in the executor, the default
+    thread pool of the loop if it is None
+    """
+    loop = asyncio.get_running_loop()
+    transform = functools.partial(populate_tables._transform_line, table)
+    transform_time = 0
+    while (chunk := await lines.get()) is not None:
+        chunk = [bytes(line) for line in chunk if line.strip()]
+        results, elapsed = await loop.run_in_executor(
+            executor, _transform_chunk, transform, chunk)
+        transform_time += elapsed
+        await transformed.put([
+            (line, references, rows)
+            for line, (references, rows) in zip(chunk, results)
+        ])
+    await transformed.put(None)
+    if metrics is not None:
+        metrics.inc('stage_seconds_total', transform_time, table=table,
+                    stage='transform')
+
+
+async def _write(pool, load, table, transformed, committed):
+    for dependency in STAGE_DEPENDENCIES[table]:
+        await committed[dependency].wait()
+
+    spec = populate_tables.TABLES[table]
+    report = load['report']
+    resolvers = load['resolvers']
+    metrics = load['metrics']
+    stats = LoadStats(table)
+    start = time.time()
+    bytes_read = records = 0
+    read_time = resolve_time = write_time = 0
+    async with pool.acquire() as conn:
+        async with conn.transaction():
+            writer = AsyncBulkWriter(
+                conn, table, spec['columns'], metrics=metrics,
+                partitions=Partitions(table) if is_partitioned(table) else None)
+            while True:
+                tick = time.perf_counter()
+                chunk = await transformed.get()
+                read_time += time.perf_counter() - tick
+                if chunk is None:
+                    break
+                for data, references, rows in chunk:
+                    bytes_read += len(data)
+                    records += 1
+                    for report_key, new_data in rows:
+                        tick = time.perf_counter()
+                        populate_tables._resolve_references(
+                            resolvers, spec['references'], references, new_data)
+                        resolve_time += time.perf_counter() - tick
+                        missing_fields = populate_tables._get_missing_obligatory_fields(
+                            spec['obligatory_fields'], new_data)
+                        if missing_fields:
+                            populate_tables._skip_saving_and_write_logs(
+                                load['rejections'], spec['log_file'], data,
+                                references, missing_fields)
+                            report['skipped'][report_key] += 1
+                            continue
+                        if not populate_tables._count_row(
+                                load, table, stats, report_key, data, new_data):
+                            continue
+                        tick = time.perf_counter()
+                        await writer.add(new_data)
+                        write_time += time.perf_counter() - tick
+            tick = time.perf_counter()
+            await writer.flush()
+            await stats.save_async(conn)
+            write_time += time.perf_counter() - tick
+            if table in resolvers:
+                await resolvers[table].load_async(conn)
+
+    metrics.inc('bytes_read_total', bytes_read, table=table)
+    metrics.inc('records_decoded_total', records, table=table)
+    metrics.inc('rows_written_total', writer.rows_written, table=table)
+    metrics.inc('db_round_trips_total',
+                writer.round_trips + 1 + (table in resolvers), table=table)
+    metrics.inc('stage_seconds_total', read_time, table=table, stage='read')
+    metrics.inc('stage_seconds_total', resolve_time, table=table, stage='resolve')
+    metrics.inc('stage_seconds_total', write_time, table=table, stage='write')
+    populate_tables._report_table(load, table, start, writer.rows_written)
@@ -0,0 +1,232 @@
+import io
+import time
+
+from app import storage
+from config.config import LOAD_SETTINGS
+
+
+class BulkWriter:
+    """
+    Buffers rows of one table and streams them into PostgreSQL
+    with COPY FROM STDIN once batch size is reached.
+
+    In 'upsert' mode rows are copied into a staging table and merged
+    into the table by unique source_id. In 'replace' mode rows of
+    changed resources replace all rows with their source_id.
+
+    If partitions are passed, missing monthly partitions of the rows
+    are created before every batch. Without autoflush full batches are
+    written only when flush is called.
+
+    If on_error is passed, every batch is written in a savepoint. A
+    failed batch is rolled back to it and bisected until rows the db
+    rejects are isolated, on_error is called with the context of each
+    of them and the error, the rest are written. Clean batches cost
+    two more statements only.
+
+    With SQLite backend batches are inserted with executemany, rows are
+    upserted with ON CONFLICT and replaced by deleting changed ones.
+    """
+
+    def __init__(self, cur, table, columns, batch_size=None, mode='insert',
+                 metrics=None, partitions=None, autoflush=True, on_error=None):
+        self.cur = cur
+        self.table = table
+        self.columns = columns
+        self.batch_size = batch_size or LOAD_SETTINGS['BATCH_SIZE']
+        self.mode = mode
+        self.metrics = metrics
+        self.partitions = partitions
+        self.autoflush = autoflush
+        self.on_error = on_error
+        self.rows = []
+        self.contexts = []
+        self.rows_written = 0
+        self.round_trips = 0
+        self._staging_created = False
+        self._staging = f'{table}_staging'
+        target = self._staging if mode != 'insert' else table
+        self._copy_sql = 'COPY {} ({}) FROM STDIN'.format(
+            target, ', '.join(columns))
+
+    def add(self, new_data, context=None):
+        self.rows.append(tuple(new_data.get(column) for column in self.columns))
+        self.contexts.append(context)
+        if self.autoflush and len(self.rows) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self.rows:
+            return
+        start = time.perf_counter()
+        if self.partitions is not None:
+            for command in _partition_commands(self):
+                self._execute(command)
+        if self.mode != 'insert' and not storage.is_embedded():
+            self._create_staging()
+        if self.on_error is None:
+            self._write(self.rows)
+            self.rows_written += len(self.rows)
+        else:
+            self.rows_written += self._write_isolated(0, len(self.rows))
+        if self.metrics is not None:
+            self.metrics.observe('write_batch_seconds',
+                                 time.perf_counter() - start, table=self.table)
+        self.rows = []
+        self.contexts = []
+
+    def _write(self, rows):
+        if storage.is_embedded():
+            self._insert_rows(rows)
+        else:
+            buffer = io.StringIO()
+            for row in rows:
+                buffer.write(_format_row(row))
+            buffer.seek(0)
+            if self.mode == 'insert':
+                self._execute_copy(buffer)
+            else:
+                self._merge(buffer)
+
+    def _write_isolated(self, start, end):
+        """
+        Writes rows from start to end in a savepoint, bisecting them
+        when the db rejects them, and returns number of written rows
+        """
+        self._execute('SAVEPOINT bulk_writer_batch')
+        try:
+            self._write(self.rows[start:end])
+        except storage.DATABASE_ERRORS as error:
+            self._execute('ROLLBACK TO SAVEPOINT bulk_writer_batch')
+            self._execute('RELEASE SAVEPOINT bulk_writer_batch')
+            if end - start == 1:
+                self.on_error(self.contexts[start], error)
+                return 0
+            middle = (start + end) // 2
+            return (self._write_isolated(start, middle)
+                    + self._write_isolated(middle, end))
+        self._execute('RELEASE SAVEPOINT bulk_writer_batch')
+        return end - start
+
+    def _execute(self, command):
+        self.cur.execute(command)
+        self.round_trips += 1
+
+    def _execute_copy(self, buffer):
+        self.cur.copy_expert(self._copy_sql, buffer)
+        self.round_trips += 1
+
+    def _insert_rows(self, rows):
+        columns = ', '.join(self.columns)
+        placeholders = ', '.join(['%s'] * len(self.columns))
+        insert = f'INSERT INTO {self.table} ({columns}) VALUES ({placeholders})'
+        if self.mode == 'upsert':
+            insert += f' ON CONFLICT (source_id) DO UPDATE SET {self._updates()}'
+        elif self.mode == 'replace':
+            source_id = self.columns.index('source_id')
+            content_hash = self.columns.index('content_hash')
+            self.cur.executemany(
+                f'DELETE FROM {self.table} '
+                f'WHERE source_id = %s AND content_hash IS NOT %s',
+                {(row[source_id], row[content_hash]) for row in rows})
+            self.round_trips += 1
+        self.cur.executemany(insert, rows)
+        self.round_trips += 1
+
+    def _updates(self):
+        return ', '.join(f'{column} = EXCLUDED.{column}'
+                         for column in self.columns if column != 'source_id')
+
+    def _create_staging(self):
+        """
+        Staging table is created out of savepoints of batches, so it is
+        not dropped when they are rolled back
+        """
+        if not self._staging_created:
+            self._execute(
+                f'CREATE TEMP TABLE IF NOT EXISTS {self._staging} '
+                f'ON COMMIT DELETE ROWS '
+                f'AS SELECT {", ".join(self.columns)} FROM {self.table} WITH NO DATA')
+            self._staging_created = True
+
+    def _merge(self, buffer):
+        columns = ', '.join(self.columns)
+        self._execute_copy(buffer)
+        if self.mode == 'upsert':
+            self._execute(
+                f'INSERT INTO {self.table} ({columns}) '
+                f'SELECT {columns} FROM {self._staging} '
+                f'ON CONFLICT (source_id) DO UPDATE SET {self._updates()}')
+        else:
+            self._execute(
+                f'DELETE FROM {self.table} t USING {self._staging} s '
+                f'WHERE t.source_id = s.source_id '
+                f'AND t.content_hash IS DISTINCT FROM s.content_hash')
+            self._execute(
+                f'INSERT INTO {self.table} ({columns}) '
+                f'SELECT {columns} FROM {self._staging}')
+        self._execute(f'TRUNCATE {self._staging}')
+
+
+class AsyncBulkWriter:
+    """
+    Buffers rows of one table and copies them into PostgreSQL through
+    asyncpg connection once batch size is reached. Only inserts rows
+    """
+
+    def __init__(self, conn, table, columns, batch_size=None, metrics=None,
+                 partitions=None):
+        self.conn = conn
+        self.table = table
+        self.columns = columns
+        self.batch_size = batch_size or LOAD_SETTINGS['BATCH_SIZE']
+        self.metrics = metrics
+        self.partitions = partitions
+        self.rows = []
+        self.rows_written = 0
+        self.round_trips = 0
+
+    async def add(self, new_data):
+        self.rows.append(tuple(new_data.get(column) for column in self.columns))
+        if len(self.rows) >= self.batch_size:
+            await self.flush()
+
+    async def flush(self):
+        if not self.rows:
+            return
+        start = time.perf_counter()
+        if self.partitions is not None:
+            for command in _partition_commands(self):
+                await self.conn.execute(command)
+                self.round_trips += 1
+        buffer = io.BytesIO(''.join(_format_row(row) for row in self.rows).encode())
+        await self.conn.copy_to_table(
+            self.table, source=buffer, columns=list(self.columns), format='text')
+        self.round_trips += 1
+        self.rows_written += len(self.rows)
+        if self.metrics is not None:
+            self.metrics.observe('write_batch_seconds',
+                                 time.perf_counter() - start, table=self.table)
+        self.rows = []
+
+
+def _partition_commands(writer):
+    index = writer.columns.index(writer.partitions.key)
+    return writer.partitions.missing(row[index] for row in writer.rows)
+
+
+def _format_row(row):
+    """
+    Formats row as a line of COPY text format
+    """
+    return '\t'.join(_format_value(value) for value in row) + '\n'
+
+
+def _format_value(value):
+    if value is None:
+        return '\\N'
+    return (str(value)
+            .replace('\\', '\\\\')
+            .replace('\t', '\\t')
+            .replace('\n', '\\n')
+            .replace('\r', '\\r'))
@@ -0,0 +1,77 @@
+import hashlib
+
+
+def load_checkpoints(cur, sources):
+    """
+    Returns checkpoint of every table: number of resources of its source
+    already committed, hash of the last of them and whether the table
+    is done, start keeps the number the load resumes from. Checkpoints
+    of other sources than the given ones are errors, since resuming them
+    would skip wrong resources
+    """
+    cur.execute('SELECT table_name, source, line, content_hash, done '
+                'FROM load_checkpoints')
+    saved = {table: (source, line, content_hash, bool(done))
+             for table, source, line, content_hash, done in cur.fetchall()}
+    checkpoints = dict()
+    for table, source in sources.items():
+        checkpoint = {'source': source, 'line': 0, 'content_hash': None,
+                      'done': False}
+        if table in saved:
+            saved_source, line, content_hash, done = saved[table]
+            if saved_source != source:
+                raise ValueError(
+                    f'{table} load was interrupted with source {saved_source}, '
+                    f'clear load_checkpoints table to load {source}')
+            checkpoint.update(line=line, content_hash=content_hash, done=done)
+        checkpoint['start'] = checkpoint['line']
+        checkpoints[table] = checkpoint
+    return checkpoints
+
+
+def save_checkpoint(cur, table, checkpoint):
+    cur.execute(
+        'INSERT INTO load_checkpoints '
+        '(table_name, source, line, content_hash, done) '
+        'VALUES (%s, %s, %s, %s, %s) '
+        'ON CONFLICT (table_name) DO UPDATE SET line = EXCLUDED.line, '
+        'content_hash = EXCLUDED.content_hash, done = EXCLUDED.done',
+        (table, checkpoint['source'], checkpoint['line'],
+         checkpoint['content_hash'], checkpoint['done']))
+
+
+def clear_checkpoints(cur):
+    cur.execute('DELETE FROM load_checkpoints')
+
+
+def skip_committed(lines, checkpoint):
+    """
+    Skips resources of the source committed before the checkpoint,
+    checking that the last of them is the same one. The checkpoint is
+    read at once, since commits of the load update it while lines are
+    still consumed
+    """
+    if checkpoint['done']:
+        return iter(())
+    return _skip_lines(lines, checkpoint['source'], checkpoint['line'],
+                       checkpoint['content_hash'])
+
+
+def _skip_lines(lines, source, committed, content_hash):
+    position = 0
+    for line in lines:
+        if position == committed:
+            yield line
+            continue
+        if not line.strip():
+            continue
+        position += 1
+        if position == committed and line_hash(line) != content_hash:
+            raise ValueError(f'{source} changed after the checkpoint, '
+                             f'resource {position} is not the committed one')
+
+
+def line_hash(line):
+    if isinstance(line, str):
+        line = line.encode()
+    return hashlib.md5(line.rstrip(b'\r\n')).hexdigest()
@@ -0,0 +1,182 @@
+import threading
+
+from app import common
+from app import storage
+from config.config import LOAD_SETTINGS
+
+# Columns of codes and their systems every normalized table keeps as
+# id of the pair in code table
+CODED_COLUMNS = {
+    'procedure': {
+        'type_code_id': ('type_code', 'type_code_system')
+    },
+    'observation': {
+        'type_code_id': ('type_code', 'type_code_system'),
+        'unit_code_id': ('unit_code', 'unit_code_system')
+    }
+}
+
+# Views keeping columns of normalized tables as they are without
+# normalization, so readers do not have to join code tables
+DENORMALIZED_VIEWS = {
+    'procedure': """SELECT p.id, p.source_id, p.patient_id, p.encounter_id,
+                          p.procedure_date, t.code AS type_code,
+                          ts.uri AS type_code_system, p.content_hash
+                   FROM procedure p
+                   JOIN code t ON t.id = p.type_code_id
+                   LEFT JOIN code_system ts ON ts.id = t.system_id""",
+    'observation': """SELECT o.id, o.source_id, o.patient_id, o.encounter_id,
+                            o.observation_date, t.code AS type_code,
+                            ts.uri AS type_code_system, o.value,
+                            u.code AS unit_code, us.uri AS unit_code_system,
+                            o.content_hash
+                     FROM observation o
+                     JOIN code t ON t.id = o.type_code_id
+                     LEFT JOIN code_system ts ON ts.id = t.system_id
+                     LEFT JOIN code u ON u.id = o.unit_code_id
+                     LEFT JOIN code_system us ON us.id = u.system_id"""
+}
+
+
+def is_normalized():
+    return LOAD_SETTINGS['NORMALIZED_CODES']
+
+
+def readable_table(table):
+    """
+    Returns table or view rows of the table are read from in their
+    denormalized shape
+    """
+    if is_normalized() and table in DENORMALIZED_VIEWS:
+        return f'{table}_denormalized'
+    return table
+
+
+def table_columns(table, columns):
+    """
+    Returns columns rows of the table are written to, with codes and
+    their systems replaced by ids of the pairs when codes are normalized
+    """
+    if not is_normalized() or table not in CODED_COLUMNS:
+        return columns
+    encoded = {column: id_column
+               for id_column, pair in CODED_COLUMNS[table].items()
+               for column in pair}
+    table_columns = []
+    for column in columns:
+        column = encoded.get(column, column)
+        if column not in table_columns:
+            table_columns.append(column)
+    return tuple(table_columns)
+
+
+def create_code_tables(cur):
+    cur.execute(f"""
+        CREATE TABLE IF NOT EXISTS code_system (
+                {_id_column('smallserial')},
+                uri text NOT NULL UNIQUE
+        )
+        """)
+    cur.execute(f"""
+        CREATE TABLE IF NOT EXISTS code (
+                {_id_column('serial')},
+                system_id smallint references code_system(id),
+                code text
+        )
+        """)
+    cur.execute('CREATE UNIQUE INDEX IF NOT EXISTS code_key '
+                "ON code (COALESCE(system_id, 0), COALESCE(code, ''))")
+
+
+def create_denormalized_views(cur):
+    for table, query in DENORMALIZED_VIEWS.items():
+        if storage.is_embedded():
+            cur.execute(f'CREATE VIEW IF NOT EXISTS {readable_table(table)} AS {query}')
+        else:
+            cur.execute(f'CREATE OR REPLACE VIEW {readable_table(table)} AS {query}')
+
+
+def _id_column(serial):
+    if storage.is_embedded():
+        return 'id integer primary key'
+    return f'id {serial} primary key'
+
+
+class CodeCache:
+    """
+    Interns code systems and pairs of codes and systems of loaded rows
+    into code_system and code tables and keeps their ids in memory, so
+    every distinct code costs db round trips once per load. New codes
+    are committed at once in a connection of their own, so concurrent
+    loads of tables do not wait for each other's transactions to reuse
+    them. The connection is opened outside the pool, which loads holding
+    its connections may exhaust. SQLite has one writer, so codes are
+    written in the load cursor there
+    """
+
+    def __init__(self):
+        self.system_ids = {}
+        self.code_ids = {}
+        self._loaded = False
+        self._lock = threading.Lock()
+        self._conn = None
+
+    def encode(self, cur, table, new_data):
+        """
+        Sets ids of codes of the row of the table in new_data
+        """
+        for id_column, (code, system) in CODED_COLUMNS[table].items():
+            new_data[id_column] = self.code_id(
+                cur, new_data.get(system), new_data.get(code))
+
+    def code_id(self, cur, system, code):
+        if system is None and code is None:
+            return None
+        id = self.code_ids.get((system, code))
+        if id is None:
+            with self._lock:
+                if not self._loaded:
+                    self._load(cur)
+                id = self.code_ids.get((system, code))
+                if id is None:
+                    id = self._intern(cur, system, code)
+        return id
+
+    def _load(self, cur):
+        cur.execute('SELECT uri, id FROM code_system')
+        self.system_ids.update(cur.fetchall())
+        cur.execute('SELECT s.uri, c.code, c.id FROM code c '
+                    'LEFT JOIN code_system s ON s.id = c.system_id')
+        for system, code, id in cur.fetchall():
+            self.code_ids[(system, code)] = id
+        self._loaded = True
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def _intern(self, cur, system, code):
+        if storage.is_embedded():
+            return self._insert(cur, system, code)
+        if self._conn is None:
+            self._conn = common.get_db_connection()
+            self._conn.autocommit = True
+        with self._conn.cursor() as intern_cur:
+            return self._insert(intern_cur, system, code)
+
+    def _insert(self, cur, system, code):
+        system_id = None
+        if system is not None:
+            system_id = self.system_ids.get(system)
+            if system_id is None:
+                cur.execute('INSERT INTO code_system (uri) VALUES (%s) '
+                            'ON CONFLICT DO NOTHING', (system,))
+                cur.execute('SELECT id FROM code_system WHERE uri = %s', (system,))
+                system_id = self.system_ids[system] = cur.fetchone()[0]
+        cur.execute('INSERT INTO code (system_id, code) VALUES (%s, %s) '
+                    'ON CONFLICT DO NOTHING', (system_id, code))
+        cur.execute("SELECT id FROM code WHERE COALESCE(system_id, 0) = %s "
+                    "AND COALESCE(code, '') = %s", (system_id or 0, code or ''))
+        id = self.code_ids[(system, code)] = cur.fetchone()[0]
+        return id
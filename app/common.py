@@ -1,18 +1,136 @@
+import contextlib
+import functools
+import threading
+
 import psycopg2
+import psycopg2.pool
+
+try:
+    import asyncpg
+except ImportError:
+    asyncpg = None
 
+from app import storage
 from config.config import DB_SETTINGS as db
 
+_pool = None
+_pool_slots = None
+_pool_lock = threading.Lock()
+
 
 def get_db_connection():
-    conn = psycopg2.connect(
-        host=db['HOST'],
-        port=db['PORT'],
-        dbname=db['NAME'],
-        user=db['USER']
-    )
+    conn = psycopg2.connect(**_connection_settings())
     return conn
 
 
+def get_connection_pool():
+    """
+    Returns connection pool shared by the process, creating it on first use
+    """
+    global _pool, _pool_slots
+    with _pool_lock:
+        if _pool is None:
+            _pool = psycopg2.pool.ThreadedConnectionPool(
+                db['POOL_MIN_SIZE'], db['POOL_MAX_SIZE'],
+                **_connection_settings())
+            _pool_slots = threading.BoundedSemaphore(db['POOL_MAX_SIZE'])
+    return _pool
+
+
+def close_connection_pool():
+    """
+    Closes connections of the pool, next use of the pool opens it again
+    """
+    global _pool, _pool_slots
+    with _pool_lock:
+        if _pool is not None:
+            _pool.closeall()
+            _pool = None
+            _pool_slots = None
+
+
+@contextlib.contextmanager
+def db_connection():
+    """
+    Hands out pooled connection in a transaction which is committed on
+    success and rolled back on error. Waits while all connections are busy.
+    With SQLite backend a connection to the db file is opened instead
+    """
+    if storage.is_embedded():
+        conn = storage.connect_sqlite()
+        try:
+            with _transaction(conn):
+                yield conn
+        finally:
+            conn.close()
+        return
+
+    pool = get_connection_pool()
+    slots = _pool_slots
+    slots.acquire()
+    try:
+        conn = pool.getconn()
+        try:
+            with _transaction(conn):
+                yield conn
+        finally:
+            pool.putconn(conn, close=bool(conn.closed))
+    finally:
+        slots.release()
+
+
+@contextlib.contextmanager
+def _transaction(conn):
+    try:
+        yield
+        conn.commit()
+    except BaseException:
+        if not conn.closed:
+            conn.rollback()
+        raise
+
+
+@contextlib.contextmanager
+def db_cursor():
+    with db_connection() as conn:
+        with conn.cursor() as cur:
+            yield cur
+
+
+def with_db_cursor(func):
+    """
+    Decorator that runs function in a managed transaction passing
+    cursor as the first argument
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with db_cursor() as cur:
+            return func(cur, *args, **kwargs)
+    return wrapper
+
+
+async def create_async_pool():
+    """
+    Creates asyncpg connection pool to the same db and of the same size
+    as the pool of get_connection_pool
+    """
+    if asyncpg is None:
+        raise ImportError('asyncpg package is needed for async loads')
+    settings = _connection_settings()
+    settings['database'] = settings.pop('dbname')
+    return await asyncpg.create_pool(
+        min_size=db['POOL_MIN_SIZE'], max_size=db['POOL_MAX_SIZE'], **settings)
+
+
+def _connection_settings():
+    return {
+        'host': db['HOST'],
+        'port': db['PORT'],
+        'dbname': db['NAME'],
+        'user': db['USER']
+    }
+
+
 def num_to_week_day(number):
     if number == 0:
         return 'Sunday'
@@ -1,35 +1,111 @@
 import psycopg2
+from concurrent.futures import ThreadPoolExecutor
 
+from app import codes
 from app import common
+from app import storage
+from app.partitions import PARTITION_KEYS, is_partitioned
+from config.config import LOAD_SETTINGS
 
+ESSENTIAL_INDEXES = {
+    'patient_source_id_key':
+        'CREATE UNIQUE INDEX IF NOT EXISTS patient_source_id_key ON patient (source_id)',
+    'encounter_source_id_key':
+        'CREATE UNIQUE INDEX IF NOT EXISTS encounter_source_id_key ON encounter (source_id)',
+    'procedure_source_id_key':
+        'CREATE UNIQUE INDEX IF NOT EXISTS procedure_source_id_key ON procedure (source_id)'
+}
 
-def create_tables():
-    """ Creates tables in already defined PostgreSQL"""
-    try:
-        conn = common.get_db_connection()
-        cur = conn.cursor()
-        execute_commands(cur)
+# Unique indexes of partitioned tables must include partition key,
+# so source ids of partitioned tables are indexed without uniqueness
+PARTITIONED_ESSENTIAL_INDEXES = {
+    'procedure': {
+        'procedure_source_id_key':
+            'CREATE INDEX IF NOT EXISTS procedure_source_id_key ON procedure (source_id)'
+    }
+}
 
-        result = cur.fetchall()
-        print(result)
+DEFERRED_INDEXES = {
+    'encounter_patient_id_idx':
+        'CREATE INDEX IF NOT EXISTS encounter_patient_id_idx ON encounter (patient_id)',
+    'procedure_patient_id_idx':
+        'CREATE INDEX IF NOT EXISTS procedure_patient_id_idx ON procedure (patient_id)',
+    'procedure_encounter_id_idx':
+        'CREATE INDEX IF NOT EXISTS procedure_encounter_id_idx ON procedure (encounter_id)',
+    'observation_source_id_idx':
+        'CREATE INDEX IF NOT EXISTS observation_source_id_idx ON observation (source_id)',
+    'observation_patient_id_idx':
+        'CREATE INDEX IF NOT EXISTS observation_patient_id_idx ON observation (patient_id)',
+    'observation_encounter_id_idx':
+        'CREATE INDEX IF NOT EXISTS observation_encounter_id_idx ON observation (encounter_id)'
+}
 
-        cur.close()
-        conn.commit()
+TABLES = ('patient', 'encounter', 'procedure', 'observation')
 
+# Materialized views behind reports of process_tables. Every report
+# is a list of keys with counts. Keys are unique, which is needed to
+# refresh views concurrently, and counts are also kept in load_stats
+# table under stat name
+REPORT_VIEWS = {
+    'report_table_counts': {
+        'query': """SELECT 'patient' AS table_name, COUNT(*) AS count FROM patient
+                   UNION ALL
+                   SELECT 'encounter', COUNT(*) FROM encounter
+                   UNION ALL
+                   SELECT 'procedure', COUNT(*) FROM procedure
+                   UNION ALL
+                   SELECT 'observation', COUNT(*) FROM observation""",
+        'key': 'table_name',
+        'stat': 'rows'
+    },
+    'report_patient_genders': {
+        'query': """SELECT COALESCE(gender, 'unknown') AS gender, COUNT(*) AS count
+                   FROM patient
+                   GROUP BY COALESCE(gender, 'unknown')""",
+        'key': 'gender',
+        'stat': 'gender'
+    },
+    'report_procedure_types': {
+        'query': """SELECT type_code, COUNT(*) AS count
+                   FROM procedure
+                   GROUP BY type_code""",
+        'key': 'type_code',
+        'stat': 'procedure_type',
+        # Rows are grouped by integer ids of normalized codes first
+        'normalized_query': """SELECT c.code AS type_code,
+                                     CAST(SUM(p.count) AS bigint) AS count
+                              FROM (SELECT type_code_id, COUNT(*) AS count
+                                    FROM procedure
+                                    GROUP BY type_code_id) AS p
+                              JOIN code c ON c.id = p.type_code_id
+                              GROUP BY c.code"""
+    },
+    'report_encounter_days': {
+        'query': """SELECT {day_of_week} AS day_of_week,
+                          COUNT(*) AS count
+                   FROM encounter
+                   GROUP BY {day_of_week}""",
+        'key': 'day_of_week',
+        'stat': 'encounter_day'
+    }
+}
+
+
+def create_tables():
+    """ Creates tables in already defined PostgreSQL"""
+    try:
+        with common.db_cursor() as cur:
+            execute_commands(cur)
 
     except (Exception, psycopg2.DatabaseError) as error:
         print(error)
-    finally:
-        if conn is not None:
-            cur.close()
-            conn.close()
 
 
 def execute_commands(cur):
     commands = (
-        """
+        f"""
         CREATE TABLE IF NOT EXISTS patient (
-            id serial primary key,
+            {_id_column('patient')},
             source_id text NOT NULL,
             birth_date date,
             gender varchar(10),
@@ -37,52 +113,207 @@ def execute_commands(cur):
             race_code_system varchar(40),
             ethnicity_code varchar(20),
             ethnicity_code_system varchar(40),
-            country varchar(30)
+            country varchar(30),
+            content_hash text
         )
         """,
-        """
+        f"""
         CREATE TABLE IF NOT EXISTS encounter (
-                id serial primary key,
+                {_id_column('encounter')},
                 source_id text NOT NULL,
                 patient_id int references patient(id) NOT NULL,
                 start_date date NOT NULL,
                 end_date date NOT NULL,
                 type_code varchar(40),
-                type_code_system varchar(40)
+                type_code_system varchar(40),
+                content_hash text
         )
         """,
-        """
+        f"""
         CREATE TABLE IF NOT EXISTS procedure (
-                id serial primary key,
+                {_id_column('procedure')},
                 source_id text NOT NULL,
                 patient_id int references patient(id) NOT NULL,
                 encounter_id int references encounter(id),
                 procedure_date timestamp with time zone NOT NULL,
-                type_code varchar(40) NOT NULL,
-                type_code_system varchar(40) NOT NULL
-        )
+                {_code_columns('type_code', ' NOT NULL')},
+                content_hash text{_primary_key('procedure')}
+        ){_partition_by('procedure')}
         """,
-        """
+        f"""
         CREATE TABLE IF NOT EXISTS observation (
-                id serial primary key,
+                {_id_column('observation')},
                 source_id text NOT NULL,
                 patient_id int references patient(id) NOT NULL,
                 encounter_id int references encounter(id),
                 observation_date timestamp with time zone NOT NULL,
-                type_code varchar(40) NOT NULL,
-                type_code_system varchar(40) NOT NULL,
+                {_code_columns('type_code', ' NOT NULL')},
                 value decimal NOT NULL,
-                unit_code varchar(40),
-                unit_code_system varchar(40)
+                {_code_columns('unit_code')},
+                content_hash text{_primary_key('observation')}
+        ){_partition_by('observation')}
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS load_stats (
+                stat varchar(20),
+                key varchar(40),
+                count bigint NOT NULL,
+                primary key (stat, key)
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS load_checkpoints (
+                table_name varchar(20) primary key,
+                source text NOT NULL,
+                line bigint NOT NULL,
+                content_hash text,
+                done boolean NOT NULL
+        )
+        """,
+        f"""
+        CREATE TABLE IF NOT EXISTS load_runs (
+                {_id_column('load_runs')},
+                started_at timestamp with time zone NOT NULL,
+                finished_at timestamp with time zone NOT NULL,
+                metrics jsonb NOT NULL
         )
         """
     )
+    if codes.is_normalized():
+        codes.create_code_tables(cur)
     for command in commands:
         cur.execute(command)
 
+    create_indexes(cur)
+    if codes.is_normalized():
+        codes.create_denormalized_views(cur)
+    create_report_views(cur)
+
     cur.execute("SELECT * FROM patient;")
     cur.fetchall()
     print('TABLES CREATED')
 
+
+def _id_column(table):
+    if storage.is_embedded():
+        return 'id integer primary key'
+    if is_partitioned(table):
+        return 'id serial'
+    return 'id serial primary key'
+
+
+def _code_columns(column, constraint=''):
+    """
+    Code and its system, or id of the pair in code table when codes
+    are normalized
+    """
+    if codes.is_normalized():
+        return f'{column}_id integer{constraint} references code(id)'
+    return (f'{column} varchar(40){constraint},\n'
+            f'                {column}_system varchar(40){constraint}')
+
+
+def _primary_key(table):
+    """
+    Primary key of partitioned table has to include its partition key
+    """
+    if is_partitioned(table):
+        return f',\n                primary key (id, {PARTITION_KEYS[table]})'
+    return ''
+
+
+def _partition_by(table):
+    if is_partitioned(table):
+        return f' PARTITION BY RANGE ({PARTITION_KEYS[table]})'
+    return ''
+
+
+def create_indexes(cur, deferred=True):
+    """
+    Creates indexes on source ids and foreign keys. Indexes which are
+    not needed while loading are created only if deferred is True
+    """
+    essential_indexes = dict(ESSENTIAL_INDEXES)
+    for table, indexes in PARTITIONED_ESSENTIAL_INDEXES.items():
+        if is_partitioned(table):
+            essential_indexes.update(indexes)
+    for command in essential_indexes.values():
+        cur.execute(command)
+    if deferred:
+        for command in DEFERRED_INDEXES.values():
+            cur.execute(command)
+
+
+def report_query(name):
+    """
+    Returns query of report view in SQL dialect of storage backend and
+    for the schema of codes
+    """
+    view = REPORT_VIEWS[name]
+    query = view['query']
+    if codes.is_normalized() and 'normalized_query' in view:
+        query = view['normalized_query']
+    return query.format(
+        day_of_week=storage.day_of_week('start_date'))
+
+
+def create_report_views(cur):
+    """
+    Creates materialized views of reports with unique indexes. SQLite
+    has no materialized views, so plain views are created there
+    """
+    for name, view in REPORT_VIEWS.items():
+        if storage.is_embedded():
+            cur.execute(f'CREATE VIEW IF NOT EXISTS {name} AS {report_query(name)}')
+            continue
+        cur.execute(f'CREATE MATERIALIZED VIEW IF NOT EXISTS {name} AS {report_query(name)}')
+        cur.execute(f'CREATE UNIQUE INDEX IF NOT EXISTS {name}_key ON {name} ({view["key"]})')
+
+
+def refresh_report_views(workers=None):
+    """
+    Refreshes materialized views of reports after load, each one in its
+    own connection. Views are refreshed concurrently so reports can be
+    read while it happens. Plain views of SQLite need no refresh
+    """
+    if storage.is_embedded():
+        return
+    workers = workers or LOAD_SETTINGS['WORKERS']
+    _execute_in_parallel(
+        [f'REFRESH MATERIALIZED VIEW CONCURRENTLY {name}' for name in REPORT_VIEWS],
+        workers)
+    print('REPORTS REFRESHED')
+
+
+@common.with_db_cursor
+def drop_deferred_indexes(cur):
+    """
+    Drops indexes which are not needed while loading so bulk load
+    does not have to maintain them
+    """
+    for name in DEFERRED_INDEXES:
+        cur.execute(f'DROP INDEX IF EXISTS {name}')
+
+
+def build_deferred_indexes(workers=None):
+    """
+    Builds dropped indexes after bulk load, each one in its own
+    connection so they are built in parallel, and analyzes tables
+    """
+    workers = workers or LOAD_SETTINGS['WORKERS']
+    _execute_in_parallel(DEFERRED_INDEXES.values(), workers)
+    _execute_in_parallel([f'ANALYZE {table}' for table in TABLES], workers)
+    print('INDEXES BUILT')
+
+
+def _execute_in_parallel(commands, workers):
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        list(executor.map(_execute, commands))
+
+
+@common.with_db_cursor
+def _execute(cur, command):
+    cur.execute(command)
+
 if __name__ == '__main__':
     create_tables()
\ No newline at end of file
@@ -0,0 +1,120 @@
+import hashlib
+import json
+import os
+import posixpath
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from config.config import LOAD_SETTINGS
+
+
+def download_sources(sources, cache_dir=None, workers=None):
+    """
+    Downloads links among sources concurrently to the cache directory and
+    returns sources with links replaced by paths of downloaded files.
+    Other sources are returned as they are
+    """
+    links = {name: source for name, source in sources.items()
+             if source.startswith(('http://', 'https://'))}
+    if not links:
+        return dict(sources)
+    workers = workers or LOAD_SETTINGS['WORKERS']
+    with ThreadPoolExecutor(max_workers=min(workers, len(links))) as executor:
+        paths = dict(zip(links, executor.map(
+            lambda link: download(link, cache_dir), links.values())))
+    return {**sources, **paths}
+
+
+def download(link, cache_dir=None, revalidate=None, timeout=None):
+    """
+    Streams the link to a file in the cache directory and returns its path.
+    Cached file is revalidated with ETag and Last-Modified of the previous
+    download and served from disk if it did not change. Interrupted
+    download is resumed with a Range request if the file is the same
+    """
+    cache_dir = cache_dir or LOAD_SETTINGS['DOWNLOAD_CACHE_DIR']
+    if revalidate is None:
+        revalidate = LOAD_SETTINGS['DOWNLOAD_REVALIDATE']
+    timeout = timeout or LOAD_SETTINGS['DOWNLOAD_TIMEOUT']
+    path = cache_path(link, cache_dir)
+    part = path + '.part'
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    cached = _read_validators(path)
+    if cached is not None and os.path.exists(path):
+        if not revalidate:
+            return path
+        headers = _conditional_headers(cached, 'If-None-Match', 'If-Modified-Since')
+    else:
+        headers = dict()
+
+    partial = _read_validators(part)
+    if partial and os.path.exists(part) \
+            and _conditional_headers(partial, 'If-Range', 'If-Range'):
+        offset = os.path.getsize(part)
+    else:
+        offset = 0
+    if offset:
+        headers = _conditional_headers(partial, 'If-Range', 'If-Range')
+        headers['Range'] = f'bytes={offset}-'
+
+    with requests.get(link, headers=headers, stream=True, timeout=timeout) as response:
+        if response.status_code == 304:
+            return path
+        if response.status_code == 416:
+            return _finish(part, path, partial)
+        response.raise_for_status()
+        if response.status_code != 206:
+            offset = 0
+        validators = {
+            'link': link,
+            'etag': response.headers.get('ETag'),
+            'last_modified': response.headers.get('Last-Modified')
+        }
+        if offset == 0:
+            _write_validators(part, validators)
+        with open(part, 'ab' if offset else 'wb') as f:
+            for chunk in response.iter_content(LOAD_SETTINGS['STREAM_CHUNK_SIZE']):
+                f.write(chunk)
+    return _finish(part, path, validators)
+
+
+def cache_path(link, cache_dir=None):
+    """
+    Returns path of the cached file of the link. Name of the file is kept
+    so its extension still tells how to read it
+    """
+    cache_dir = cache_dir or LOAD_SETTINGS['DOWNLOAD_CACHE_DIR']
+    name = posixpath.basename(urllib.parse.urlsplit(link).path) or 'index'
+    digest = hashlib.sha1(link.encode()).hexdigest()[:16]
+    return os.path.join(cache_dir, digest, name)
+
+
+def _finish(part, path, validators):
+    os.replace(part, path)
+    _write_validators(path, validators)
+    os.remove(part + '.json')
+    return path
+
+
+def _conditional_headers(validators, etag_header, date_header):
+    if validators.get('etag'):
+        return {etag_header: validators['etag']}
+    if validators.get('last_modified'):
+        return {date_header: validators['last_modified']}
+    return dict()
+
+
+def _read_validators(path):
+    try:
+        with open(path + '.json') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def _write_validators(path, validators):
+    with open(path + '.json', 'w') as f:
+        json.dump(validators, f)
@@ -0,0 +1,139 @@
+import argparse
+import os
+
+import psycopg2
+
+try:
+    import pyarrow
+    import pyarrow.dataset
+except ImportError:
+    pyarrow = None
+
+from app import codes
+from app import common
+from app import storage
+from config.config import LOAD_SETTINGS
+
+# Expressions of month every row of a table belongs to, in UTC
+MONTHS = {
+    'encounter': "to_char(start_date, 'YYYY-MM')",
+    'procedure': "to_char(procedure_date AT TIME ZONE 'UTC', 'YYYY-MM')",
+    'observation': "to_char(observation_date AT TIME ZONE 'UTC', 'YYYY-MM')"
+}
+
+# Columns parquet files of every table are partitioned by
+EXPORT_PARTITIONS = {
+    'patient': (),
+    'encounter': ('month',),
+    'procedure': ('type_code', 'month'),
+    'observation': ('type_code', 'month')
+}
+
+NUMERIC_OID = 1700
+
+# Precision and scale of decimals numeric columns declared without them
+# are exported as
+NUMERIC_DECIMAL = (38, 18)
+
+
+def export_tables(directory=None, tables=None):
+    """
+    Exports tables to parquet files partitioned by EXPORT_PARTITIONS
+    in the directory, so analytics do not have to query db
+    """
+    directory = directory or LOAD_SETTINGS['EXPORT_DIR']
+    try:
+        if pyarrow is None:
+            raise ImportError('pyarrow package is needed to export tables')
+        if storage.is_embedded():
+            raise ValueError('Export needs PostgreSQL backend')
+        for table in tables or EXPORT_PARTITIONS:
+            with common.db_cursor() as cur:
+                rows = export_table(cur, table, directory)
+            print(f'{table} exported - {rows} rows')
+
+    except (Exception, psycopg2.DatabaseError) as error:
+        print(error)
+
+
+def export_table(cur, table, directory):
+    """
+    Streams rows of the table with a server-side cursor into dictionary
+    encoded and compressed parquet files in directory/table and returns
+    number of exported rows. Files of the previous export of the same
+    partitions are replaced. Normalized codes are exported as strings
+    and numeric columns as decimals
+    """
+    month = f', {MONTHS[table]} AS month' if table in MONTHS else ''
+    batch_size = LOAD_SETTINGS['BATCH_SIZE']
+    exported = 0
+
+    with cur.connection.cursor(name=f'{table}_export') as export_cur:
+        export_cur.itersize = batch_size
+        export_cur.execute(f'SELECT *{month} FROM {codes.readable_table(table)}')
+        rows = export_cur.fetchmany(batch_size)
+        schema = pyarrow.schema([
+            (column.name, _arrow_type(column))
+            for column in export_cur.description])
+
+        def batches(rows):
+            nonlocal exported
+            while rows:
+                exported += len(rows)
+                yield _record_batch(schema, rows)
+                rows = export_cur.fetchmany(batch_size)
+
+        pyarrow.dataset.write_dataset(
+            batches(rows), os.path.join(directory, table), schema=schema,
+            format='parquet',
+            partitioning=_partitioning(schema, EXPORT_PARTITIONS[table]),
+            file_options=pyarrow.dataset.ParquetFileFormat().make_write_options(
+                compression=LOAD_SETTINGS['EXPORT_COMPRESSION'],
+                use_dictionary=True),
+            existing_data_behavior='delete_matching')
+    return exported
+
+
+def _arrow_type(column):
+    if column.type_code == NUMERIC_OID:
+        if column.precision is None:
+            return pyarrow.decimal128(*NUMERIC_DECIMAL)
+        return pyarrow.decimal128(column.precision, column.scale or 0)
+    types = {
+        16: pyarrow.bool_(),
+        20: pyarrow.int64(),
+        21: pyarrow.int16(),
+        23: pyarrow.int32(),
+        700: pyarrow.float32(),
+        701: pyarrow.float64(),
+        1082: pyarrow.date32(),
+        1114: pyarrow.timestamp('us'),
+        1184: pyarrow.timestamp('us', tz='UTC')
+    }
+    return types.get(column.type_code, pyarrow.string())
+
+
+def _partitioning(schema, partitions):
+    if not partitions:
+        return None
+    return pyarrow.dataset.partitioning(
+        pyarrow.schema([schema.field(name) for name in partitions]),
+        flavor='hive')
+
+
+def _record_batch(schema, rows):
+    columns = [pyarrow.array(values, type=field.type)
+               for field, values in zip(schema, zip(*rows))]
+    return pyarrow.RecordBatch.from_arrays(columns, schema=schema)
+
+
+def _parse_args():
+    parser = argparse.ArgumentParser(description='Export tables to parquet')
+    parser.add_argument('--output', help='directory for parquet files')
+    parser.add_argument('--tables', nargs='+', choices=list(EXPORT_PARTITIONS))
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = _parse_args()
+    export_tables(args.output, args.tables)
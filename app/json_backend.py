@@ -0,0 +1,84 @@
+import json
+import threading
+
+from config.config import LOAD_SETTINGS
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import simdjson
+except ImportError:
+    simdjson = None
+
+BACKENDS = ('simdjson', 'orjson', 'json')
+
+_local = threading.local()
+
+
+def get_backend():
+    """
+    Returns name of JSON backend set in config or the fastest installed one
+    """
+    backend = LOAD_SETTINGS['JSON_BACKEND']
+    if backend:
+        if backend not in BACKENDS:
+            raise ValueError(f'Unknown JSON backend {backend}')
+        if backend != 'json' and globals()[backend] is None:
+            raise RuntimeError(f'{backend} package is not installed')
+        return backend
+    if simdjson is not None:
+        return 'simdjson'
+    if orjson is not None:
+        return 'orjson'
+    return 'json'
+
+
+def loads(line):
+    backend = get_backend()
+    if backend == 'simdjson':
+        return _simdjson_parser().parse(line, True)
+    if backend == 'orjson':
+        return orjson.loads(line)
+    return json.loads(line)
+
+
+def loads_selective(line, fields):
+    """
+    Decodes only given top-level fields of JSON object when backend
+    parses lazily (simdjson), other backends decode the whole object
+    """
+    if get_backend() != 'simdjson':
+        return loads(line)
+    document = _simdjson_parser().parse(line)
+    data = dict()
+    for field in fields:
+        if field in document:
+            data[field] = _materialize(document[field])
+    return data
+
+
+def dumps(data):
+    """
+    Returns JSON string of data
+    """
+    if get_backend() in ('simdjson', 'orjson') and orjson is not None:
+        return orjson.dumps(data).decode()
+    return json.dumps(data)
+
+
+def _simdjson_parser():
+    parser = getattr(_local, 'parser', None)
+    if parser is None:
+        parser = _local.parser = simdjson.Parser()
+    return parser
+
+
+def _materialize(value):
+    if isinstance(value, simdjson.Object):
+        return value.as_dict()
+    if isinstance(value, simdjson.Array):
+        return value.as_list()
+    return value
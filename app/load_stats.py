@@ -0,0 +1,162 @@
+import datetime
+from collections import Counter
+
+import psycopg2.extras
+
+from app import storage
+from app.create_tables import REPORT_VIEWS, report_query
+
+ROWS = 'rows'
+GENDER = 'gender'
+PROCEDURE_TYPE = 'procedure_type'
+ENCOUNTER_DAY = 'encounter_day'
+
+
+def _gender(new_data):
+    return new_data.get('gender') or 'unknown'
+
+
+def _day_of_week(new_data):
+    """
+    Day of week of encounter start as EXTRACT(DOW ...) returns it,
+    0 is Sunday
+    """
+    start_date = datetime.date.fromisoformat(str(new_data['start_date'])[:10])
+    return str(start_date.isoweekday() % 7)
+
+
+def _type_code(new_data):
+    return new_data['type_code']
+
+
+# Report statistics kept for rows of every table besides row counts
+STATS = {
+    'patient': ((GENDER, _gender),),
+    'encounter': ((ENCOUNTER_DAY, _day_of_week),),
+    'procedure': ((PROCEDURE_TYPE, _type_code),),
+    'observation': ()
+}
+
+# Columns of rows of every table report statistics count them by
+STATS_COLUMNS = {
+    'patient': ('gender',),
+    'encounter': ('start_date',),
+    'procedure': ('type_code',),
+    'observation': ()
+}
+
+
+class LoadStats:
+    """
+    Counts rows written to table by report statistics while they are
+    loaded and merges counts into load_stats table in the transaction
+    of the rows, so reports do not have to scan tables. Incremental
+    loads uncount loaded rows which rows of changed resources replace,
+    so only the delta is merged
+    """
+
+    def __init__(self, table):
+        self.table = table
+        self.stats = STATS[table]
+        self.counts = Counter()
+        self.replaced = Counter()
+        self._replaced_keys = {}
+
+    def keys(self, new_data):
+        """
+        Returns keys the row is counted by. Raises ValueError when a value
+        the row is counted by is invalid
+        """
+        return [(ROWS, self.table)] + [
+            (stat, key(new_data)) for stat, key in self.stats]
+
+    def add(self, new_data):
+        self.counts.update(self.keys(new_data))
+
+    def remove(self, new_data):
+        """
+        Uncounts row which was added but rejected by db
+        """
+        for counted in self.keys(new_data):
+            self.counts[counted] -= 1
+            if not self.counts[counted]:
+                del self.counts[counted]
+
+    def replace(self, source_id, keys):
+        """
+        Uncounts loaded rows of the resource, which are going to be
+        replaced by its new rows, by their keys
+        """
+        self.replaced.update(keys)
+        self._replaced_keys[source_id] = keys
+
+    def restore(self, source_id):
+        """
+        Counts loaded rows of the resource again when its new rows were
+        rejected by db
+        """
+        self.replaced.subtract(self._replaced_keys.pop(source_id, ()))
+
+    def save(self, cur):
+        deltas = Counter(self.counts)
+        deltas.subtract(self.replaced)
+        # Sorted, so concurrent loads of shards lock rows in the same order.
+        # Keys of rows which were all rejected are not saved, negative
+        # deltas are saved for keys of replaced rows only
+        rows = [(stat, key, count)
+                for (stat, key), count in sorted(deltas.items())
+                if count > 0 or count < 0 and self.replaced[(stat, key)]]
+        self.counts.clear()
+        self.replaced.clear()
+        self._replaced_keys.clear()
+        if not rows:
+            return
+        merge = ('ON CONFLICT (stat, key) DO UPDATE '
+                 'SET count = load_stats.count + EXCLUDED.count')
+        if storage.is_embedded():
+            cur.executemany('INSERT INTO load_stats (stat, key, count) '
+                            f'VALUES (%s, %s, %s) {merge}', rows)
+        else:
+            psycopg2.extras.execute_values(
+                cur, f'INSERT INTO load_stats (stat, key, count) VALUES %s {merge}',
+                rows)
+        if any(count < 0 for _, _, count in rows):
+            cur.execute('DELETE FROM load_stats WHERE count <= 0')
+
+    async def save_async(self, conn):
+        """
+        Same as save for asyncpg connection
+        """
+        counts = {counted: count for counted, count in self.counts.items()
+                  if count > 0}
+        if not counts:
+            self.counts.clear()
+            return
+        (stats, keys), counts = zip(*counts), list(counts.values())
+        await conn.execute(
+            'INSERT INTO load_stats (stat, key, count) '
+            'SELECT * FROM unnest($1::text[], $2::text[], $3::bigint[]) '
+            'ON CONFLICT (stat, key) DO UPDATE '
+            'SET count = load_stats.count + EXCLUDED.count',
+            list(stats), list(keys), counts)
+        self.counts.clear()
+
+    def rebuild(self, cur):
+        """
+        Counts statistics of the table again from its rows. Used after
+        partitions of the table are dropped
+        """
+        stats = [stat for stat, _ in self.stats]
+        cur.execute('DELETE FROM load_stats WHERE stat = %s AND key = %s',
+                    (ROWS, self.table))
+        cur.execute('INSERT INTO load_stats (stat, key, count) '
+                    f'SELECT %s, %s, COUNT(*) FROM {self.table}',
+                    (ROWS, self.table))
+        for name, view in REPORT_VIEWS.items():
+            if view['stat'] in stats:
+                cur.execute('DELETE FROM load_stats WHERE stat = %s', (view['stat'],))
+                cur.execute('INSERT INTO load_stats (stat, key, count) '
+                            f'SELECT %s, CAST({view["key"]} AS text), count '
+                            f'FROM ({report_query(name)}) AS report',
+                            (view['stat'],))
+        self.counts.clear()
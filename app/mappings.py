@@ -0,0 +1,135 @@
+REQUIRED = True
+OPTIONAL = False
+
+# Every table column is mapped to a FHIR path of the resource. Path parts
+# are separated by dots, numbers are list indexes, alternative paths are
+# separated by '|' and the first one present is used. Missing required
+# columns are left out of the row so it fails obligatory fields check,
+# missing optional columns are set to None.
+
+PATIENT = {
+    'source_id': ('id', REQUIRED),
+    'birth_date': ('birthDate', OPTIONAL),
+    'gender': ('gender', OPTIONAL),
+    'race_code': ('extension.0.valueCodeableConcept.coding.0.code', OPTIONAL),
+    'race_code_system': ('extension.0.valueCodeableConcept.coding.0.system', OPTIONAL),
+    'ethnicity_code': ('extension.1.valueCodeableConcept.coding.0.code', OPTIONAL),
+    'ethnicity_code_system': ('extension.1.valueCodeableConcept.coding.0.system', OPTIONAL),
+    'country': ('address.0.country', OPTIONAL)
+}
+
+ENCOUNTER = {
+    'source_id': ('id', REQUIRED),
+    'start_date': ('period.start', REQUIRED),
+    'end_date': ('period.end', REQUIRED),
+    'type_code': ('type.0.coding.0.code', OPTIONAL),
+    'type_code_system': ('type.0.coding.0.system', OPTIONAL)
+}
+
+PROCEDURE = {
+    'source_id': ('id', REQUIRED),
+    'procedure_date': ('performedDateTime | performedPeriod.start', REQUIRED),
+    'type_code': ('code.coding.0.code', REQUIRED),
+    'type_code_system': ('code.coding.0.system', REQUIRED)
+}
+
+OBSERVATION_RESOURCE = {
+    'source_id': ('id', REQUIRED),
+    'observation_date': ('effectiveDateTime', REQUIRED)
+}
+
+# Observation value fields are taken either from the observation itself
+# or from every its component
+OBSERVATION_VALUE = {
+    'type_code': ('code.coding.0.code', REQUIRED),
+    'type_code_system': ('code.coding.0.system', REQUIRED),
+    'value': ('valueQuantity.value', REQUIRED),
+    'unit_code': ('valueQuantity.unit', OPTIONAL),
+    'unit_code_system': ('valueQuantity.system', OPTIONAL)
+}
+
+OBSERVATION = {**OBSERVATION_RESOURCE, **OBSERVATION_VALUE}
+
+
+def compile_mapping(mapping):
+    """
+    Compiles mapping into function extracting columns of a resource into
+    new_data dict. Paths of all columns are merged into a tree so a
+    common prefix is looked up only once per resource, and missing
+    fields are detected without raising exceptions
+    """
+    tree = _PathNode()
+    columns = []
+    for column, (paths, required) in mapping.items():
+        alternatives = [path.strip() for path in paths.split('|')]
+        for priority, path in enumerate(alternatives):
+            tree.add(_parse_path(path), (column, priority))
+        columns.append((column, len(alternatives), required))
+    visit = tree.compile()
+
+    def extract(data, new_data):
+        found = {}
+        visit(data, found)
+        for column, alternatives, required in columns:
+            for priority in range(alternatives):
+                value = found.get((column, priority))
+                if value is not None:
+                    new_data[column] = value
+                    break
+            else:
+                if not required:
+                    new_data[column] = None
+        return new_data
+
+    return extract
+
+
+def get_fields(mapping):
+    """
+    Returns top-level fields of resource the mapping reads
+    """
+    return {
+        _parse_path(path.strip())[0]
+        for paths, required in mapping.values()
+        for path in paths.split('|')
+    }
+
+
+class _PathNode:
+    def __init__(self):
+        self.children = {}
+        self.leaves = []
+
+    def add(self, parts, leaf):
+        node = self
+        for part in parts:
+            node = node.children.setdefault(part, _PathNode())
+        node.leaves.append(leaf)
+
+    def compile(self):
+        leaves = tuple(self.leaves)
+        children = tuple(
+            (part, child.compile()) for part, child in self.children.items())
+
+        def visit(value, found):
+            for leaf in leaves:
+                found[leaf] = value
+            for part, child in children:
+                if isinstance(part, int):
+                    if isinstance(value, list) and len(value) > part:
+                        child_value = value[part]
+                    else:
+                        continue
+                elif isinstance(value, dict):
+                    child_value = value.get(part)
+                else:
+                    continue
+                if child_value is not None:
+                    child(child_value, found)
+
+        return visit
+
+
+def _parse_path(path):
+    return tuple(int(part) if part.isdigit() else part
+                 for part in path.split('.'))
@@ -0,0 +1,180 @@
+import bisect
+import contextlib
+import datetime
+import json
+import os
+import threading
+import time
+
+from config.config import LOAD_SETTINGS
+
+PREFIX = 'healthcare_load_'
+
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60)
+
+
+class Metrics:
+    """
+    Counters and histograms of one load run which can be exported as
+    JSON or Prometheus text format
+    """
+
+    def __init__(self):
+        self.started_at = time.time()
+        self.counters = dict()
+        self.histograms = dict()
+        self._lock = threading.Lock()
+
+    def inc(self, name, value=1, **labels):
+        key = (name, _labels_key(labels))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, buckets=DEFAULT_BUCKETS, **labels):
+        key = (name, _labels_key(labels))
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = _Histogram(buckets)
+            histogram.observe(value)
+
+    @contextlib.contextmanager
+    def timer(self, name, **labels):
+        """
+        Observes time spent in the block in histogram name
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def merge(self, other):
+        """
+        Adds counters and histograms of other metrics, e.g. collected
+        in a worker process
+        """
+        with self._lock:
+            for key, value in other.counters.items():
+                self.counters[key] = self.counters.get(key, 0) + value
+            for key, histogram in other.histograms.items():
+                if key not in self.histograms:
+                    self.histograms[key] = _Histogram(histogram.buckets)
+                self.histograms[key].merge(histogram)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def value(self, name, **labels):
+        return self.counters.get((name, _labels_key(labels)), 0)
+
+    def to_dict(self):
+        with self._lock:
+            counters = dict()
+            for (name, labels), value in sorted(self.counters.items()):
+                counters.setdefault(name, []).append(
+                    {'labels': dict(labels), 'value': value})
+            histograms = dict()
+            for (name, labels), histogram in sorted(self.histograms.items()):
+                histograms.setdefault(name, []).append(
+                    {'labels': dict(labels), **histogram.to_dict()})
+        return {
+            'started_at': self.started_at,
+            'counters': counters,
+            'histograms': histograms
+        }
+
+    def to_prometheus(self):
+        lines = []
+        metrics = self.to_dict()
+        for name, samples in metrics['counters'].items():
+            lines.append(f'# TYPE {PREFIX}{name} counter')
+            for sample in samples:
+                lines.append(f'{PREFIX}{name}{_format_labels(sample["labels"])} '
+                             f'{sample["value"]}')
+        for name, samples in metrics['histograms'].items():
+            lines.append(f'# TYPE {PREFIX}{name} histogram')
+            for sample in samples:
+                labels = sample['labels']
+                for le, count in sample['buckets'].items():
+                    bucket_labels = _format_labels({**labels, 'le': le})
+                    lines.append(f'{PREFIX}{name}_bucket{bucket_labels} {count}')
+                lines.append(f'{PREFIX}{name}_sum{_format_labels(labels)} '
+                             f'{sample["sum"]}')
+                lines.append(f'{PREFIX}{name}_count{_format_labels(labels)} '
+                             f'{sample["count"]}')
+        return '\n'.join(lines) + '\n'
+
+    def export(self, directory=None):
+        """
+        Writes metrics.json and metrics.prom files to the directory
+        """
+        directory = directory or LOAD_SETTINGS['METRICS_DIR']
+        os.makedirs(directory, exist_ok=True)
+        with open(os.path.join(directory, 'metrics.json'), 'w') as f:
+            json.dump(self.to_dict(), f, indent=2)
+        with open(os.path.join(directory, 'metrics.prom'), 'w') as f:
+            f.write(self.to_prometheus())
+
+    def save(self, cur):
+        """
+        Persists metrics of the run to load_runs table
+        """
+        cur.execute(
+            'INSERT INTO load_runs (started_at, finished_at, metrics) '
+            'VALUES (%s, %s, %s)',
+            (_isoformat(self.started_at), _isoformat(time.time()),
+             json.dumps(self.to_dict())))
+
+
+class _Histogram:
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * len(self.buckets)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        if index < len(self.counts):
+            self.counts[index] += 1
+        self.sum += value
+        self.count += 1
+
+    def merge(self, other):
+        self.counts = [a + b for a, b in zip(self.counts, other.counts)]
+        self.sum += other.sum
+        self.count += other.count
+
+    def to_dict(self):
+        buckets = dict()
+        cumulative = 0
+        for le, count in zip(self.buckets, self.counts):
+            cumulative += count
+            buckets[str(le)] = cumulative
+        buckets['+Inf'] = self.count
+        return {'buckets': buckets, 'sum': self.sum, 'count': self.count}
+
+
+def _isoformat(timestamp):
+    return datetime.datetime.fromtimestamp(
+        timestamp, datetime.timezone.utc).isoformat()
+
+
+def _labels_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    pairs = ','.join(
+        '{}="{}"'.format(key, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+        for key, value in labels.items())
+    return '{' + pairs + '}'
@@ -0,0 +1,99 @@
+import datetime
+import re
+
+from app import storage
+from config.config import LOAD_SETTINGS
+
+# Columns tables can be range partitioned by month on
+PARTITION_KEYS = {
+    'observation': 'observation_date',
+    'procedure': 'procedure_date'
+}
+
+# Naive dates are stored in the time zone of the session, so partitions
+# of both neighbouring months are created for them
+_MAX_UTC_OFFSET = datetime.timedelta(hours=14)
+
+
+def is_partitioned(table):
+    """
+    Tables are partitioned only in PostgreSQL
+    """
+    return table in LOAD_SETTINGS['PARTITIONED_TABLES'] and not storage.is_embedded()
+
+
+class Partitions:
+    """
+    Tracks monthly partitions of a range partitioned table which were
+    created during load and returns commands creating missing ones
+    """
+
+    def __init__(self, table):
+        self.table = table
+        self.key = PARTITION_KEYS[table]
+        self.months = set()
+
+    def missing(self, values):
+        """
+        Returns commands creating partitions for months of values
+        that were not created yet
+        """
+        months = set()
+        for value in values:
+            months.update(_months(value))
+        commands = [create_partition_command(self.table, month)
+                    for month in sorted(months - self.months)]
+        self.months |= months
+        return commands
+
+
+def partition_name(table, month):
+    return f'{table}_{month.year}_{month.month:02d}'
+
+
+def create_partition_command(table, month):
+    return (f'CREATE TABLE IF NOT EXISTS {partition_name(table, month)} '
+            f'PARTITION OF {table} FOR VALUES '
+            f"FROM ('{month.isoformat()} 00:00:00+00') "
+            f"TO ('{_next_month(month).isoformat()} 00:00:00+00')")
+
+
+def drop_expired_partitions(cur, table, retention_months, today=None):
+    """
+    Drops partitions of months older than retention_months before the
+    current one and returns their names
+    """
+    today = today or datetime.date.today()
+    cutoff = today.replace(day=1)
+    for _ in range(retention_months):
+        cutoff = (cutoff - datetime.timedelta(days=1)).replace(day=1)
+    cur.execute('SELECT c.relname FROM pg_inherits i '
+                'JOIN pg_class c ON c.oid = i.inhrelid '
+                'WHERE i.inhparent = %s::regclass', (table,))
+    pattern = re.compile(rf'^{table}_(\d{{4}})_(\d{{2}})$')
+    expired = []
+    for name, in cur.fetchall():
+        match = pattern.match(name)
+        if match and datetime.date(int(match[1]), int(match[2]), 1) < cutoff:
+            expired.append(name)
+    for name in sorted(expired):
+        cur.execute(f'DROP TABLE {name}')
+    return sorted(expired)
+
+
+def _months(value):
+    if value is None:
+        return ()
+    try:
+        moment = datetime.datetime.fromisoformat(value)
+    except (TypeError, ValueError):
+        return ()
+    if moment.tzinfo is not None:
+        moment = moment.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+        return {moment.date().replace(day=1)}
+    return {(moment - _MAX_UTC_OFFSET).date().replace(day=1),
+            (moment + _MAX_UTC_OFFSET).date().replace(day=1)}
+
+
+def _next_month(month):
+    return (month + datetime.timedelta(days=32)).replace(day=1)
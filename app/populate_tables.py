@@ -1,17 +1,116 @@
-import ndjson
+import argparse
+import asyncio
+import functools
+import hashlib
 import psycopg2
 import psycopg2.extras
 import requests
 import time
 import json
 
+from app import checkpoints
+from app import codes
 from app import common
-
-
-def populate_tables():
+from app import json_backend
+from app import mappings
+from app import storage
+from app.bulk_writer import BulkWriter
+from app.downloads import download_sources
+from app.load_stats import STATS_COLUMNS, LoadStats
+from app.metrics import Metrics
+from app.partitions import (
+    PARTITION_KEYS, Partitions, drop_expired_partitions, is_partitioned)
+from app.rejections import (
+    DATABASE_ERROR, INVALID_VALUE, MISSING_REQUIRED_FIELDS, UNRESOLVED_REFERENCE,
+    RejectionSink)
+from app.create_tables import (
+    build_deferred_indexes, drop_deferred_indexes, refresh_report_views)
+from app.resolver import ReferenceResolver
+from app.scheduler import STAGE_DEPENDENCIES, prefetch, run_stages
+from app.transform import transform_in_pool
+from app.sources import iter_lines
+from config.config import LOAD_SETTINGS, SOURCES
+
+PATIENT_COLUMNS = (
+    'source_id',
+    'gender',
+    'birth_date',
+    'country',
+    'race_code',
+    'race_code_system',
+    'ethnicity_code',
+    'ethnicity_code_system',
+    'content_hash'
+)
+
+ENCOUNTER_COLUMNS = (
+    'source_id',
+    'patient_id',
+    'start_date',
+    'end_date',
+    'type_code',
+    'type_code_system',
+    'content_hash'
+)
+
+PROCEDURE_COLUMNS = (
+    'source_id',
+    'patient_id',
+    'encounter_id',
+    'procedure_date',
+    'type_code',
+    'type_code_system',
+    'content_hash'
+)
+
+OBSERVATION_COLUMNS = (
+    'source_id',
+    'patient_id',
+    'encounter_id',
+    'observation_date',
+    'type_code',
+    'type_code_system',
+    'value',
+    'unit_code',
+    'unit_code_system',
+    'content_hash'
+)
+
+
+def populate_tables(sources=None, parallel=None, transform_workers=None,
+                    defer_indexes=None, incremental=None, asynchronous=None,
+                    checkpoint=None, shards=None):
     """
-    Inserts medical example data to four tables retrieved from link
+    Inserts medical example data to four tables retrieved from sources.
+    Sources not passed explicitly are taken from config, links are
+    downloaded to the cache directory first if it is set. In parallel
+    mode independent tables are populated concurrently. With transform
+    workers resources are decoded and transformed in worker processes.
+    With deferred indexes foreign key indexes are dropped before load
+    and built again after it. In incremental mode resources which did not
+    change since the previous load are skipped and changed ones are upserted.
+    In asynchronous mode fetching, transforming and writing of all tables
+    overlap in one event loop. With checkpoints every batch is committed
+    with the position in its source, so an interrupted load run again
+    resumes after the last committed batch. With shards local files of
+    SHARDED_TABLES are split into byte ranges loaded by worker processes
     """
+    sources = {**SOURCES, **(sources or {})}
+    if parallel is None:
+        parallel = LOAD_SETTINGS['PARALLEL']
+    if transform_workers is None:
+        transform_workers = LOAD_SETTINGS['TRANSFORM_WORKERS']
+    if defer_indexes is None:
+        defer_indexes = LOAD_SETTINGS['DEFER_INDEXES']
+    if incremental is None:
+        incremental = LOAD_SETTINGS['INCREMENTAL']
+    if asynchronous is None:
+        asynchronous = LOAD_SETTINGS['ASYNC']
+    if checkpoint is None:
+        checkpoint = LOAD_SETTINGS['CHECKPOINTS']
+    if shards is None:
+        shards = LOAD_SETTINGS['SHARDS']
+    metrics = Metrics()
     report = {
         'insert_time': {
             'patients': 0,
@@ -25,504 +124,745 @@ def populate_tables():
             'procedures': 0,
             'observations': 0,
             'observations_with_component': 0
+            },
+        'inserted': {
+            'patients': 0,
+            'encounters': 0,
+            'procedures': 0,
+            'observations': 0
+            },
+        'unchanged': {
+            'patients': 0,
+            'encounters': 0,
+            'procedures': 0,
+            'observations': 0
             }
     }
+    load = {
+        'report': report,
+        'resolvers': {
+            'patient': ReferenceResolver('patient'),
+            'encounter': ReferenceResolver('encounter')
+        },
+        'rejections': RejectionSink(),
+        'metrics': metrics,
+        'incremental': incremental,
+        'checkpoints': None,
+        'shards': shards,
+        'sharded': {},
+        'codes': codes.CodeCache() if codes.is_normalized() else None
+    }
+    indexes_dropped = False
     try:
-        conn = common.get_db_connection()
-        cur = conn.cursor()
-
-        _populate_patient_table(cur, report)
-
-        _populate_encounter_table(cur, report)
-
-        _populate_procedure_table(cur, report)
-
-        _populate_observation_table(cur, report)
-
-        # print('\nTime spent for populating tables: ')
-        # print(f'Patient - {report["insert_time"]["patients"]} sec')
-        # print(f'Encounter - {report["insert_time"]["encounters"]} sec')
-        # print(f'Procedure - {report["insert_time"]["procedures"]} sec')
-        # print(f'Observation - {report["insert_time"]["observations"]} sec')
-
-        cur.close()
-        conn.commit()
+        if LOAD_SETTINGS['DOWNLOAD_CACHE_DIR']:
+            sources = download_sources(sources)
+        if checkpoint:
+            load['checkpoints'] = _load_checkpoints(sources)
+        load['sharded'] = {
+            table: source for table, source in sources.items()
+            if _is_sharded(load, table, source)
+        }
+        transformed = {
+            table: _transform_source(table, source, transform_workers, metrics,
+                                     load['checkpoints'])
+            for table, source in sources.items()
+        }
+        if defer_indexes:
+            drop_deferred_indexes()
+            indexes_dropped = True
+
+        if asynchronous:
+            _populate_tables_async(load, sources, transform_workers)
+        elif parallel:
+            _populate_tables_in_parallel(load, transformed)
+        else:
+            with common.db_cursor() as cur:
+                for table in TABLES:
+                    if table in load['sharded']:
+                        # Shards reference rows of tables loaded before
+                        cur.connection.commit()
+                        _populate_table_sharded(cur, load, table)
+                    else:
+                        _populate_table(cur, load, table, transformed[table])
+        if checkpoint:
+            _clear_checkpoints()
+
+        if indexes_dropped:
+            build_deferred_indexes()
+            indexes_dropped = False
+        if LOAD_SETTINGS['PARTITION_RETENTION_MONTHS']:
+            _drop_expired_partitions(LOAD_SETTINGS['PARTITION_RETENTION_MONTHS'])
+        if LOAD_SETTINGS['REFRESH_REPORTS']:
+            refresh_report_views()
+
+        print('\nTime spent for populating tables: ')
+        print(f'Patient - {report["insert_time"]["patients"]} sec')
+        print(f'Encounter - {report["insert_time"]["encounters"]} sec')
+        print(f'Procedure - {report["insert_time"]["procedures"]} sec')
+        print(f'Observation - {report["insert_time"]["observations"]} sec')
 
     except (Exception, psycopg2.DatabaseError) as error:
         print(error)
     finally:
-        if conn is not None:
-            cur.close()
-            conn.close()
+        if indexes_dropped:
+            # Failed load does not leave foreign keys without indexes
+            try:
+                build_deferred_indexes()
+            except (Exception, psycopg2.DatabaseError) as error:
+                print(error)
+        for resolver in load['resolvers'].values():
+            resolver.close()
+        if load['codes'] is not None:
+            load['codes'].close()
+        load['rejections'].close()
+        report['rejected'] = load['rejections'].summary()
+        _print_rejections(report['rejected'])
+        _export_metrics(metrics, report['rejected'])
+        common.close_connection_pool()
+
+
+def _populate_tables_in_parallel(load, transformed):
+    """
+    Populates every table in its own connection and transaction as soon
+    as tables it references are committed. Sources of all tables are
+    downloaded and decoded ahead in background while waiting
+    """
+    stages = {
+        table: functools.partial(
+            _populate_table_in_transaction, load, table,
+            prefetch(transformed[table], LOAD_SETTINGS['PREFETCH_SIZE']))
+        for table in TABLES if table not in load['sharded']
+    }
+    for table in load['sharded']:
+        stages[table] = functools.partial(
+            _populate_table_sharded_in_transaction, load, table)
+    run_stages(stages, STAGE_DEPENDENCIES, LOAD_SETTINGS['WORKERS'])
 
 
-def _populate_patient_table(cur, report):
+@common.with_db_cursor
+def _drop_expired_partitions(cur, retention_months):
     """
-    Inserts patient data
+    Drops monthly partitions older than retention and counts report
+    statistics of their tables again
     """
+    for table in PARTITION_KEYS:
+        if is_partitioned(table):
+            dropped = drop_expired_partitions(cur, table, retention_months)
+            if dropped:
+                LoadStats(table).rebuild(cur)
+                print(f'{table} partitions dropped: {", ".join(dropped)}')
 
-    patients_link = 'https://raw.githubusercontent.com/smart-on-fhir/flat-fhir-files/master/r3/Patient.ndjson'
-    patients_data = get_ndjson(patients_link)
-    obligatory_fields = {'source_id'}
-    log_file = 'skipped_patients.ndjson'
 
-    start = time.time()
-    for data in patients_data:
-
-        new_data = dict()
+@common.with_db_cursor
+def _load_checkpoints(cur, sources):
+    return checkpoints.load_checkpoints(cur, sources)
 
-        _handle_patient_fields(data, new_data)
 
-        all_obligatory_fields = _check_all_obligatory_fields_present(
-            obligatory_fields, new_data)
+@common.with_db_cursor
+def _clear_checkpoints(cur):
+    checkpoints.clear_checkpoints(cur)
 
-        if not all_obligatory_fields:
-            _skip_saving_and_write_logs(log_file)
-            report['skipped']['patients'] += 1
-            continue
 
-        _save_patients(cur, new_data)
+def _is_sharded(load, table, source):
+    """
+    Local sources of SHARDED_TABLES are sharded. Positions of checkpoints
+    and partitions created during load can not be shared by shards
+    """
+    return (load['shards'] > 1 and table in LOAD_SETTINGS['SHARDED_TABLES']
+            and not load['checkpoints'] and not is_partitioned(table)
+            and not source.startswith(('http://', 'https://')))
 
-    print('Patient TABLE populated')
-    print(f'- There were {report["skipped"]["patients"]} skipped patients!')
 
-    report['insert_time']['patients'] = round(time.time() - start, 2)
-    print(f'- It took {report["insert_time"]["patients"]} sec')
+def _populate_table_sharded(cur, load, table):
+    from app.shards import populate_table_sharded
+    populate_table_sharded(cur, load, table)
 
 
-def _handle_patient_fields(data, new_data):
+@common.with_db_cursor
+def _populate_table_sharded_in_transaction(cur, load, table):
+    _populate_table_sharded(cur, load, table)
 
-    try:
-        new_data['source_id'] = data['id']
-    except:
-        pass
 
-    try:
-        new_data['birth_date'] = data['birthDate']
-    except:
-        new_data['birth_date'] = None
+def _populate_tables_async(load, sources, transform_workers):
+    if load['sharded']:
+        raise ValueError('Sharded loads are not supported in async mode')
+    if load['checkpoints']:
+        raise ValueError('Checkpoints are not supported in async mode')
+    if load['codes']:
+        raise ValueError('Normalized codes are not supported in async mode')
+    if load['incremental']:
+        raise ValueError('Incremental loads are not supported in async mode')
+    if storage.is_embedded():
+        raise ValueError('Async mode needs PostgreSQL backend')
+    from app.async_pipeline import populate_tables_async
+    asyncio.run(populate_tables_async(load, sources, transform_workers))
 
-    try:
-        new_data['gender'] = data['gender']
-    except:
-        new_data['gender'] = None
 
-    try:
-        new_data['race_code'] = data['extension'][0]['valueCodeableConcept']['coding'][0]['code']
-    except:
-        new_data['race_code'] = None
+@common.with_db_cursor
+def _populate_table_in_transaction(cur, load, table, transformed):
+    _populate_table(cur, load, table, transformed)
 
-    try:
-        new_data['race_code_system'] = data['extension'][0]['valueCodeableConcept']['coding'][0]['system']
-    except:
-        new_data['race_code_system'] = None
 
-    try:
-        new_data['ethnicity_code'] = data['extension'][1]['valueCodeableConcept']['coding'][0]['code']
-    except:
-        new_data['ethnicity_code'] = None
+def _transform_source(table, source, transform_workers, metrics=None,
+                      table_checkpoints=None):
+    lines = iter_lines(source)
+    if table_checkpoints:
+        lines = checkpoints.skip_committed(lines, table_checkpoints[table])
+    if transform_workers:
+        return transform_in_pool(
+            functools.partial(_transform_line, table), lines, transform_workers,
+            metrics=metrics, table=table)
+    return _transform_lines(table, lines, metrics)
 
-    try:
-        new_data['ethnicity_code_system'] = data['extension'][1]['valueCodeableConcept']['coding'][0]['system']
-    except:
-        new_data['ethnicity_code_system'] = None
-
-    try:
-        new_data['country'] = data['address'][0]['country']
-    except:
-        new_data['country'] = None
-
-
-def _save_patients(cur, new_data):
-    cur.execute("""
-        INSERT INTO patient (
-            source_id,
-            gender,
-            birth_date,
-            country,
-            race_code,
-            race_code_system,
-            ethnicity_code,
-            ethnicity_code_system
-        )
-        VALUES (
-            %(source_id)s,
-            %(gender)s,
-            %(birth_date)s,
-            %(country)s,
-            %(race_code)s,
-            %(race_code_system)s,
-            %(ethnicity_code)s,
-            %(ethnicity_code_system)s
-        )
-        """, new_data)
-
-
-def _populate_encounter_table(cur, report):
-    """
-    Inserts encounter data
-    """
-
-    encounter_link = 'https://raw.githubusercontent.com/smart-on-fhir/flat-fhir-files/master/r3/Encounter.ndjson'
-    encounters_data = get_ndjson(encounter_link)
-    obligatory_fields = {'source_id', 'patient_id', 'start_date', 'end_date'}
-    log_file = 'skipped_encounters.ndjson'
 
+def _populate_table(cur, load, table, transformed):
     start = time.time()
-    for data in encounters_data:
-
-        new_data = dict()
-
-        _handle_encounter_fields(data, new_data)
-
-        _handle_encounter_referenced_fields(cur, data, new_data)
-
-        all_obligatory_fields = _check_all_obligatory_fields_present(
-            obligatory_fields, new_data)
-
-        if not all_obligatory_fields:
-            _skip_saving_and_write_logs(log_file, data)
-            report['skipped']['encounters'] += 1
-            continue
-
-        _save_encounters(cur, new_data)
-
-    print('Encounter TABLE populated')
-    print(f'- There were {report["skipped"]["encounters"]} skipped encounters!')
+    rows_written = _write_table(cur, load, table, transformed)
+    _report_table(load, table, start, rows_written)
 
-    report['insert_time']['encounters'] = round(time.time() - start, 2)
-    print(f'- It took {report["insert_time"]["encounters"]} sec')
-
-
-def _handle_encounter_fields(data, new_data):
-
-    try:
-        new_data['source_id'] = data['id']
-
-        new_data['start_date'] = data['period']['start']
-
-        new_data['end_date'] = data['period']['end']
-    except:
-        pass
-
-    try:
-        new_data['type_code'] = data['type'][0]['coding'][0]['code']
-    except:
-        new_data['type_code'] = None
-
-    try:
-        new_data['type_code_system'] = data['type'][0]['coding'][0]['system']
-    except:
-        new_data['type_code_system'] = None
 
+def _write_table(cur, load, table, transformed, content_hashes=None):
+    """
+    Inserts transformed resources of the table and returns number of
+    written rows. Rows without obligatory fields or with values report
+    statistics can not count are skipped and their resources are saved
+    with the reason in the rejection log. In
+    incremental mode resources with the same content hash as already
+    loaded ones are skipped and the rest are upserted, hashes are read
+    from the table unless they are given. Report statistics
+    of written rows are merged into load_stats table, incremental loads
+    merge them less statistics of the replaced rows. Rows the
+    db rejects are isolated in their batch and logged, the rest of the
+    batch is written. With checkpoints full batches are committed
+    between resources together with the checkpoint of the last resource.
+    Normalized codes are written as ids interned by the code cache
+    """
+    spec = TABLES[table]
+    report = load['report']
+    resolvers = load['resolvers']
+    metrics = load['metrics']
+    checkpoint = load['checkpoints'][table] if load['checkpoints'] else None
+    autoflush = checkpoint is None
+    columns = codes.table_columns(table, spec['columns'])
+    code_cache = load['codes'] if table in codes.CODED_COLUMNS else None
+    stats = LoadStats(table)
+    on_error = functools.partial(_reject_row, load, table, stats)
+    round_trips = 0
+    table_partitions = Partitions(table) if is_partitioned(table) else None
+    if load['incremental']:
+        if content_hashes is None:
+            content_hashes = _load_content_hashes(cur, table)
+            round_trips += 1
+        # Partitioned tables have no unique source_id to upsert by
+        mode = 'replace' if table_partitions else spec['incremental']
+        writer = BulkWriter(cur, table, columns, mode=mode,
+                            metrics=metrics, partitions=table_partitions,
+                            autoflush=autoflush, on_error=on_error)
+    else:
+        content_hashes = None
+        writer = BulkWriter(cur, table, columns, metrics=metrics,
+                            partitions=table_partitions, autoflush=autoflush,
+                            on_error=on_error)
+
+    read_time = resolve_time = write_time = 0
+    bytes_read = records = 0
+    transformed = iter(transformed)
+    while True:
+        if checkpoint is not None and len(writer.rows) >= writer.batch_size:
+            _commit_batch(cur, load, table, writer, stats, records, data)
+        tick = time.perf_counter()
+        resource = next(transformed, None)
+        read_time += time.perf_counter() - tick
+        if resource is None:
+            break
+        data, references, rows = resource
+        bytes_read += len(data)
+        records += 1
+
+        if content_hashes is not None:
+            if _is_unchanged(content_hashes, rows):
+                report['unchanged'][spec['report_key']] += 1
+                continue
+            _replace_loaded(stats, content_hashes, rows)
 
-def _handle_encounter_referenced_fields(cur, data, new_data):
-    _get_patient_id(cur, data, new_data)
+        for report_key, new_data in rows:
 
+            tick = time.perf_counter()
+            _resolve_references(resolvers, spec['references'], references, new_data)
+            resolve_time += time.perf_counter() - tick
 
-def _save_encounters(cur, new_data):
-    cur.execute("""
-        INSERT INTO encounter (
-            source_id,
-            patient_id,
-            start_date,
-            end_date,
-            type_code,
-            type_code_system
-        )
-        VALUES (
-            %(source_id)s,
-            %(patient_id)s,
-            %(start_date)s,
-            %(end_date)s,
-            %(type_code)s,
-            %(type_code_system)s
-        )
-        """, new_data)
+            missing_fields = _get_missing_obligatory_fields(
+                spec['obligatory_fields'], new_data)
 
+            if missing_fields:
+                _skip_saving_and_write_logs(
+                    load['rejections'], spec['log_file'], data, references,
+                    missing_fields)
+                report['skipped'][report_key] += 1
+                continue
 
+            if not _count_row(load, table, stats, report_key, data, new_data):
+                continue
 
-def _populate_procedure_table(cur, report):
+            tick = time.perf_counter()
+            if code_cache is not None:
+                code_cache.encode(cur, table, new_data)
+            writer.add(new_data, (report_key, data, new_data))
+            write_time += time.perf_counter() - tick
+
+    tick = time.perf_counter()
+    writer.flush()
+    stats.save(cur)
+    round_trips += 1
+    write_time += time.perf_counter() - tick
+    if table in resolvers:
+        resolvers[table].load(cur)
+        round_trips += 1
+    if checkpoint is not None:
+        checkpoint['done'] = True
+        checkpoints.save_checkpoint(cur, table, checkpoint)
+        cur.connection.commit()
+
+    metrics.inc('bytes_read_total', bytes_read, table=table)
+    metrics.inc('records_decoded_total', records, table=table)
+    metrics.inc('rows_written_total', writer.rows_written, table=table)
+    metrics.inc('db_round_trips_total', round_trips + writer.round_trips,
+                table=table)
+    metrics.inc('stage_seconds_total', read_time, table=table, stage='read')
+    metrics.inc('stage_seconds_total', resolve_time, table=table, stage='resolve')
+    metrics.inc('stage_seconds_total', write_time, table=table, stage='write')
+    return writer.rows_written
+
+
+def _commit_batch(cur, load, table, writer, stats, records, data):
     """
-    Inserts procedure data
+    Writes the batch and commits it with the checkpoint of the last
+    resource. Statistics of incremental loads are counted at the end
     """
+    checkpoint = load['checkpoints'][table]
+    writer.flush()
+    if not load['incremental']:
+        stats.save(cur)
+    checkpoint['line'] = checkpoint['start'] + records
+    checkpoint['content_hash'] = checkpoints.line_hash(data)
+    checkpoints.save_checkpoint(cur, table, checkpoint)
+    cur.connection.commit()
 
-    procedure_link = 'https://raw.githubusercontent.com/smart-on-fhir/flat-fhir-files/master/r3/Procedure.ndjson'
-    procedures_data = get_ndjson(procedure_link)
-    obligatory_fields = {'source_id', 'patient_id', 'procedure_date', 'type_code', 'type_code_system'}
-    log_file = 'skipped_procedures.ndjson'
-
-    start = time.time()
-    for data in procedures_data:
-        new_data = dict()
 
-        _handle_procedure_fields(data, new_data)
+def _report_table(load, table, start, rows_written):
+    spec = TABLES[table]
+    report = load['report']
+    print(f'{spec["name"]} TABLE populated')
+    for report_key in spec['skipped']:
+        print(f'- There were {report["skipped"][report_key]} skipped '
+              f'{report_key.replace("_", " ")}!')
+    if load['incremental']:
+        print(f'- There were {report["unchanged"][spec["report_key"]]} '
+              f'unchanged {spec["report_key"]}')
 
-        _handle_procedure_referenced_fields(cur, data, new_data)
+    report['insert_time'][spec['report_key']] = round(time.time() - start, 2)
+    report['inserted'][spec['report_key']] = rows_written
+    print(f'- It took {report["insert_time"][spec["report_key"]]} sec')
 
-        all_obligatory_fields = _check_all_obligatory_fields_present(
-            obligatory_fields, new_data)
 
-        if not all_obligatory_fields:
-            _skip_saving_and_write_logs(log_file, data)
-            report['skipped']['procedures'] += 1
-            continue
+_handle_patient_fields = mappings.compile_mapping(mappings.PATIENT)
 
-        _save_procedures(cur, new_data)
+_handle_encounter_fields = mappings.compile_mapping(mappings.ENCOUNTER)
 
+_handle_procedure_fields = mappings.compile_mapping(mappings.PROCEDURE)
 
-    print('Procedure TABLE populated')
-    print(f'- There were {report["skipped"]["procedures"]} skipped procedures!')
+_handle_observation_fields = mappings.compile_mapping(mappings.OBSERVATION)
 
-    report['insert_time']['procedures'] = round(time.time() - start, 2)
-    print(f'- It took {report["insert_time"]["procedures"]} sec')
+_extract_observation_resource_fields = mappings.compile_mapping(
+    mappings.OBSERVATION_RESOURCE)
 
+_extract_observation_value_fields = mappings.compile_mapping(
+    mappings.OBSERVATION_VALUE)
 
-def _handle_procedure_fields(data, new_data):
 
-    try:
-        new_data['source_id'] = data['id']
-
-        if data.get('performedDateTime'):
-            new_data['procedure_date'] = data['performedDateTime']
-        else:
-            new_data['procedure_date'] = data['performedPeriod']['start']
+def _handle_observation_fields_with_component(data, new_data, component):
+    _extract_observation_resource_fields(data, new_data)
+    _extract_observation_value_fields(component, new_data)
 
-        new_data['type_code'] = data['code']['coding'][0]['code']
 
-        new_data['type_code_system'] = data['code']['coding'][0]['system']
+def _transform_patient(data):
+    new_data = dict()
+    _handle_patient_fields(data, new_data)
+    return _get_references(data), [('patients', new_data)]
 
-        return True
 
-    except:
-        with open("logs/skipped_procedures.ndjson", "a+") as f:
-            dict_to_ndjson(data, f)
-        return False
+def _transform_encounter(data):
+    new_data = dict()
+    _handle_encounter_fields(data, new_data)
+    return _get_references(data), [('encounters', new_data)]
 
 
-def _handle_procedure_referenced_fields(cur, data, new_data):
-    _get_patient_id(cur, data, new_data)
-    _get_encounter_id(cur, data, new_data)
+def _transform_procedure(data):
+    new_data = dict()
+    _handle_procedure_fields(data, new_data)
+    return _get_references(data), [('procedures', new_data)]
 
 
-def _save_procedures(cur, new_data):
-    cur.execute("""
-                INSERT INTO procedure (
-                    source_id,
-                    patient_id,
-                    encounter_id,
-                    procedure_date,
-                    type_code,
-                    type_code_system
-                )
-                VALUES (
-                    %(source_id)s,
-                    %(patient_id)s,
-                    %(encounter_id)s,
-                    %(procedure_date)s,
-                    %(type_code)s,
-                    %(type_code_system)s
-                )
-                """, new_data)
+def _transform_observation(data):
+    rows = []
+    if data.get('component'):
+        for component in data['component']:
+            new_data = dict()
+            _handle_observation_fields_with_component(
+                data, new_data, component)
+            rows.append(('observations_with_component', new_data))
+    else:
+        new_data = dict()
+        _handle_observation_fields(data, new_data)
+        rows.append(('observations', new_data))
+    return _get_references(data), rows
+
+
+# Fields read for every resource besides mapped ones: references,
+# meta for content hash and observation components
+RESOURCE_FIELDS = {'subject', 'context', 'meta', 'component'}
+
+TABLES = {
+    'patient': {
+        'name': 'Patient',
+        'columns': PATIENT_COLUMNS,
+        'obligatory_fields': {'source_id'},
+        'references': (),
+        'transform': _transform_patient,
+        'fields': mappings.get_fields(mappings.PATIENT) | RESOURCE_FIELDS,
+        'incremental': 'upsert',
+        'log_file': 'skipped_patients.ndjson',
+        'report_key': 'patients',
+        'skipped': ('patients',)
+    },
+    'encounter': {
+        'name': 'Encounter',
+        'columns': ENCOUNTER_COLUMNS,
+        'obligatory_fields': {'source_id', 'patient_id', 'start_date', 'end_date'},
+        'references': ('patient',),
+        'transform': _transform_encounter,
+        'fields': mappings.get_fields(mappings.ENCOUNTER) | RESOURCE_FIELDS,
+        'incremental': 'upsert',
+        'log_file': 'skipped_encounters.ndjson',
+        'report_key': 'encounters',
+        'skipped': ('encounters',)
+    },
+    'procedure': {
+        'name': 'Procedure',
+        'columns': PROCEDURE_COLUMNS,
+        'obligatory_fields': {'source_id', 'patient_id', 'procedure_date', 'type_code', 'type_code_system'},
+        'references': ('patient', 'encounter'),
+        'transform': _transform_procedure,
+        'fields': mappings.get_fields(mappings.PROCEDURE) | RESOURCE_FIELDS,
+        'incremental': 'upsert',
+        'log_file': 'skipped_procedures.ndjson',
+        'report_key': 'procedures',
+        'skipped': ('procedures',)
+    },
+    'observation': {
+        'name': 'Observation',
+        'columns': OBSERVATION_COLUMNS,
+        'obligatory_fields': {'source_id', 'patient_id', 'observation_date', 'type_code', 'type_code_system', 'value'},
+        'references': ('patient', 'encounter'),
+        'transform': _transform_observation,
+        'fields': mappings.get_fields(mappings.OBSERVATION) | RESOURCE_FIELDS,
+        'incremental': 'replace',
+        'log_file': 'skipped_observations.ndjson',
+        'report_key': 'observations',
+        'skipped': ('observations', 'observations_with_component')
+    }
+}
 
 
-def _populate_observation_table(cur, report):
+def _check_all_obligatory_fields_present(obligatory_fields, new_data):
     """
-    Inserts observation data
+    Check that all required fields are present. If not ndjson data won't
+    be saved in DB but this data is goint to be save in a log file for
+    having a possibility to review skipped data afterwards.
     """
+    if _get_missing_obligatory_fields(obligatory_fields, new_data):
+        return False
+    return True
 
-    procedure_link = 'https://raw.githubusercontent.com/smart-on-fhir/flat-fhir-files/master/r3/Observation.ndjson'
-    procedures_data = get_ndjson(procedure_link)
-    obligatory_fields = {'source_id', 'patient_id', 'observation_date', 'type_code', 'type_code_system', 'value'}
-    log_file = 'skipped_observations.ndjson'
-
-    start = time.time()
-    for data in procedures_data:
-        new_data = dict()
-
-        if data.get('component'):
-
-            for component in data['component']:
-                new_data = dict()
-
-                _handle_observation_fields_with_component(
-                    data, new_data, component)
-
-                _handle_observation_referenced_fields_with_component(
-                    cur, data, new_data)
-
-                all_obligatory_fields = _check_all_obligatory_fields_present(
-                    obligatory_fields, new_data)
-
-                if not all_obligatory_fields:
-                    _skip_saving_and_write_logs(log_file, data)
-                    report['skipped']['observations_with_component'] += 1
-                    continue
-
-                _save_observations(cur, new_data)
-
-        else:
-
-            _handle_observation_fields(data, new_data)
-
-            _handle_observation_referenced_fields(cur, data, new_data)
-
-            all_obligatory_fields = _check_all_obligatory_fields_present(
-                obligatory_fields, new_data)
 
-            if not all_obligatory_fields:
-                _skip_saving_and_write_logs(log_file, data)
-                report['skipped']['observations'] += 1
-                continue
+def _get_missing_obligatory_fields(obligatory_fields, new_data):
+    return obligatory_fields - new_data.keys()
 
-            _save_observations(cur, new_data)
 
-    print('Observation TABLE populated')
-    print(f'- There were {report["skipped"]["observations"]} skipped observations '
-          f'and {report["skipped"]["observations_with_component"]} skipped '
-          f'observations with component')
-
-    report['insert_time']['observations'] = round(time.time() - start, 2)
-    print(f'- It took {report["insert_time"]["observations"]} sec')
+def _skip_saving_and_write_logs(rejections, log_file, data, references,
+                                missing_fields):
+    """
+    As not all obligatory fields are present data is not going to
+    be saved in db but is saved in the rejection log with the reason.
+    Patient which is referenced but not loaded is reported as
+    unresolved reference.
+    """
+    if 'patient_id' in missing_fields and references.get('patient'):
+        reason = UNRESOLVED_REFERENCE
+    else:
+        reason = MISSING_REQUIRED_FIELDS
+    rejections.reject(
+        log_file, data, reason, missing_fields=sorted(missing_fields))
 
 
-def _handle_observation_fields(data, new_data):
+def _count_row(load, table, stats, report_key, data, new_data):
+    """
+    Counts row in report statistics and returns True. Row with a value
+    it can not be counted by, like invalid encounter start date, is not
+    going to be saved, its resource is saved in the rejection log with
+    the error instead
+    """
     try:
-        new_data['source_id'] = data['id']
-
-        new_data['observation_date'] = data['effectiveDateTime']
+        stats.add(new_data)
+    except ValueError as error:
+        load['rejections'].reject(TABLES[table]['log_file'], data, INVALID_VALUE,
+                                  error=str(error))
+        load['report']['skipped'][report_key] += 1
+        return False
+    return True
 
-        new_data['type_code'] = data['code']['coding'][0]['code']
 
-        new_data['type_code_system'] = data['code']['coding'][0]['system']
+def _reject_row(load, table, stats, context, error):
+    """
+    Row was rejected by db, so its resource is saved in the rejection
+    log with the error and the row is not counted in report statistics,
+    loaded rows of its resource it was going to replace are counted again
+    """
+    report_key, data, new_data = context
+    load['rejections'].reject(TABLES[table]['log_file'], data, DATABASE_ERROR,
+                              error=str(error).strip())
+    load['report']['skipped'][report_key] += 1
+    stats.remove(new_data)
+    stats.restore(new_data.get('source_id'))
 
-        new_data['value'] = data['valueQuantity']['value']
-    except:
-        pass
 
+def _export_metrics(metrics, rejected):
+    """
+    Exports metrics of the run as JSON and Prometheus text files and
+    saves them to load_runs table if it is enabled in config
+    """
+    log_tables = {spec['log_file']: table for table, spec in TABLES.items()}
+    for log_file, reasons in rejected.items():
+        for reason, count in reasons.items():
+            metrics.inc('skipped_total', count,
+                        table=log_tables.get(log_file, log_file), reason=reason)
     try:
-        new_data['unit_code'] = data['valueQuantity']['unit']
-    except:
-        new_data['unit_code'] = None
+        metrics.export()
+        if LOAD_SETTINGS['METRICS_PERSIST']:
+            with common.db_cursor() as cur:
+                metrics.save(cur)
+    except (Exception, psycopg2.DatabaseError) as error:
+        print(error)
 
-    try:
-        new_data['unit_code_system'] = data['valueQuantity']['system']
-    except:
-        new_data['unit_code_system'] = None
 
+def _print_rejections(rejected):
+    for log_file, reasons in rejected.items():
+        print(f'Skipped resources saved in {log_file}:')
+        for reason, count in reasons.items():
+            print(f'- {reason}: {count}')
 
-def _handle_observation_referenced_fields(cur, data, new_data):
-    _get_patient_id(cur, data, new_data)
-    _get_encounter_id(cur, data, new_data)
 
+def _get_references(data):
+    """
+    Returns source ids of patient and encounter the resource refers to
+    """
+    return {
+        'patient': _get_reference_source_id(data, 'subject'),
+        'encounter': _get_reference_source_id(data, 'context')
+    }
 
-def _handle_observation_referenced_fields_with_component(cur, data, new_data):
-    _get_patient_id(cur, data, new_data)
-    _get_encounter_id(cur, data, new_data)
 
+def _get_reference_source_id(data, field):
+    try:
+        return data[field]['reference'].split('/')[-1]
+    except (KeyError, TypeError, AttributeError):
+        return None
 
-def _handle_observation_fields_with_component(data, new_data, component):
 
-    try:
-        new_data['source_id'] = data['id']
+def _resolve_references(resolvers, tables, references, new_data):
+    """
+    Sets ids of referenced rows. Missing patient leaves patient_id unset
+    so the row is skipped, missing encounter sets encounter_id to None
+    """
+    if 'patient' in tables:
+        patient_id = resolvers['patient'].resolve(references['patient'])
+        if patient_id is not None:
+            new_data['patient_id'] = patient_id
+    if 'encounter' in tables:
+        new_data['encounter_id'] = resolvers['encounter'].resolve(
+            references['encounter'])
 
-        new_data['observation_date'] = data['effectiveDateTime']
 
-        new_data['type_code'] = component['code']['coding'][0]['code']
+def _transform(table, data, line=None):
+    """
+    Transforms resource into rows of the table and stamps every row
+    with content hash of the resource, hashing its raw line if it is given
+    """
+    references, rows = TABLES[table]['transform'](data)
+    content_hash = _content_hash(data, line)
+    for report_key, new_data in rows:
+        new_data['content_hash'] = content_hash
+    return references, rows
 
-        new_data['type_code_system'] = component['code']['coding'][0]['system']
 
-        new_data['value'] = component['valueQuantity']['value']
-    except:
-        pass
+def _transform_line(table, line):
+    """
+    Decodes only fields of raw ndjson line used by the table and
+    transforms the resource
+    """
+    return _transform(table, json_backend.loads_selective(
+        line, TABLES[table]['fields']), line)
 
-    try:
-        new_data['unit_code'] = component['valueQuantity']['unit']
-    except:
-        new_data['unit_code'] = None
 
+def _transform_lines(table, lines, metrics=None):
+    """
+    Yields raw ndjson lines of the table with their references and rows.
+    Time spent on fetching, decoding and transforming is added to metrics
+    """
+    fields = TABLES[table]['fields']
+    fetch_time = decode_time = transform_time = 0
+    lines = iter(lines)
     try:
-        new_data['unit_code_system'] = component['valueQuantity']['system']
-    except:
-        new_data['unit_code_system'] = None
-
-
-def _save_observations(cur, new_data):
-    cur.execute("""
-            INSERT INTO observation (
-                source_id,
-                patient_id,
-                encounter_id,
-                observation_date,
-                type_code,
-                type_code_system,
-                value,
-                unit_code,
-                unit_code_system
-            )
-            VALUES (
-                %(source_id)s,
-                %(patient_id)s,
-                %(encounter_id)s,
-                %(observation_date)s,
-                %(type_code)s,
-                %(type_code_system)s,
-                %(value)s,
-                %(unit_code)s,
-                %(unit_code_system)s
-            )
-            """, new_data)
+        while True:
+            checkpoint = time.perf_counter()
+            line = next(lines, None)
+            decoding = time.perf_counter()
+            fetch_time += decoding - checkpoint
+            if line is None:
+                return
+            if not line.strip():
+                continue
+            data = json_backend.loads_selective(line, fields)
+            transforming = time.perf_counter()
+            decode_time += transforming - decoding
+            references, rows = _transform(table, data, line)
+            transform_time += time.perf_counter() - transforming
+            yield line, references, rows
+    finally:
+        if metrics is not None:
+            metrics.inc('stage_seconds_total', fetch_time, table=table, stage='fetch')
+            metrics.inc('stage_seconds_total', decode_time, table=table, stage='decode')
+            metrics.inc('stage_seconds_total', transform_time, table=table,
+                        stage='transform')
 
 
-def _check_all_obligatory_fields_present(obligatory_fields, new_data):
+def _content_hash(data, line=None):
     """
-    Check that all required fields are present. If not ndjson data won't
-    be saved in DB but this data is goint to be save in a log file for
-    having a possibility to review skipped data afterwards.
+    Uses resource version and update time when they are present,
+    otherwise hash of the raw line, so fields the table does not decode
+    count too, or of the whole resource when there is no line
     """
-    if obligatory_fields - set(new_data.keys()):
-        return False
-    return True
+    meta = data.get('meta') or {}
+    if meta.get('versionId') and meta.get('lastUpdated'):
+        return f'{meta["versionId"]}|{meta["lastUpdated"]}'
+    if line is not None:
+        return checkpoints.line_hash(line)
+    content = json.dumps(data, sort_keys=True, separators=(',', ':'))
+    return hashlib.md5(content.encode()).hexdigest()
 
 
-def _skip_saving_and_write_logs(log_file, data):
+def _load_content_hashes(cur, table):
     """
-    As not all obligatory fields are present data is not going to
-    be saved in db but is saved in this log file.
+    Returns content hash of every resource already loaded to the table
+    with keys report statistics count its rows by
     """
-    with open(f'logs/{log_file}', 'a+') as f:
-        dict_to_ndjson(data, f)
+    stats = LoadStats(table)
+    stats_columns = STATS_COLUMNS[table]
+    columns = ', '.join(('source_id', 'content_hash') + stats_columns)
+    content_hashes = dict()
+    with cur.connection.cursor(name=f'{table}_content_hashes') as hashes_cur:
+        hashes_cur.itersize = LOAD_SETTINGS['BATCH_SIZE']
+        hashes_cur.execute(f'SELECT {columns} FROM {codes.readable_table(table)}')
+        for source_id, content_hash, *values in hashes_cur:
+            _, keys = content_hashes.get(source_id, (None, ()))
+            keys += tuple(stats.keys(dict(zip(stats_columns, values))))
+            content_hashes[source_id] = (content_hash, keys)
+    return content_hashes
+
+
+def _is_unchanged(content_hashes, rows):
+    if not rows:
+        return False
+    new_data = rows[0][1]
+    loaded = content_hashes.get(new_data.get('source_id'))
+    return loaded is not None and loaded[0] == new_data['content_hash']
 
 
-def _get_patient_id(cur, data, new_data):
-    try:
-        patient_source_id = data['subject']['reference'].split('/')[-1]
-        query = f"SELECT id FROM patient WHERE patient.source_id = '{patient_source_id}'"
-        cur.execute(query)
-        new_data['patient_id'] = cur.fetchone()[0]
-    except:
-        pass
+def _replace_loaded(stats, content_hashes, rows):
+    """
+    Uncounts loaded rows of the changed resource its rows replace
+    """
+    if not rows:
+        return
+    source_id = rows[0][1].get('source_id')
+    loaded = content_hashes.pop(source_id, None)
+    if loaded is not None:
+        stats.replace(source_id, loaded[1])
 
 
-def _get_encounter_id(cur, data, new_data):
-    try:
-        encounter_source_id = data['context']['reference'].split('/')[-1]
-        query = f"SELECT id FROM encounter WHERE encounter.source_id = '{encounter_source_id}'"
-        cur.execute(query)
-        new_data['encounter_id'] = cur.fetchone()[0]
-    except:
-        new_data['encounter_id'] = None
+def get_ndjson(link, stream=False):
+    """
+    Returns resources of ndjson source (link, file, glob or directory).
+    In stream mode resources are decoded one at a time while iterating
+    instead of loading the whole file into memory
+    """
+    if stream:
+        return _decode_lines(iter_lines(link))
+    if LOAD_SETTINGS['DOWNLOAD_CACHE_DIR']:
+        link = download_sources({'link': link})['link']
+        return list(_decode_lines(iter_lines(link)))
+    response = requests.get(link, timeout=LOAD_SETTINGS['DOWNLOAD_TIMEOUT'])
+    return list(_decode_lines(response.content.splitlines()))
 
 
-def get_ndjson(link):
-    response = requests.get(link)
-    return response.json(cls=ndjson.Decoder)
+def _decode_lines(lines):
+    for line in lines:
+        if line.strip():
+            yield json_backend.loads(line)
 
 
 def dict_to_ndjson(dict, file):
-    json.dump(dict, file)
+    file.write(json_backend.dumps(dict))
     file.write('\n')
 
 
+def _parse_args():
+    parser = argparse.ArgumentParser(description='Populate tables')
+    for table in SOURCES:
+        parser.add_argument(
+            f'--{table}', help=f'{table} ndjson link, file, glob or directory')
+    parser.add_argument(
+        '--parallel', action='store_true', default=None,
+        help='populate independent tables concurrently')
+    parser.add_argument(
+        '--transform-workers', type=int,
+        help='number of processes decoding and transforming resources')
+    parser.add_argument(
+        '--defer-indexes', action='store_true', default=None,
+        help='drop foreign key indexes before load and build them after')
+    parser.add_argument(
+        '--incremental', action='store_true', default=None,
+        help='skip unchanged resources and upsert changed ones')
+    parser.add_argument(
+        '--async', dest='asynchronous', action='store_true', default=None,
+        help='overlap fetching, transforming and writing in an event loop '
+             '(needs asyncpg)')
+    parser.add_argument(
+        '--checkpoint', action='store_true', default=None,
+        help='commit every batch and resume interrupted load after it')
+    parser.add_argument(
+        '--shards', type=int, default=None,
+        help='split local files of SHARDED_TABLES into byte ranges loaded by '
+             'this number of worker processes')
+    return parser.parse_args()
+
+
 if __name__ == '__main__':
-    populate_tables()
+    args = _parse_args()
+    populate_tables({
+        table: getattr(args, table) for table in SOURCES
+        if getattr(args, table)
+    }, parallel=args.parallel, transform_workers=args.transform_workers,
+        defer_indexes=args.defer_indexes, incremental=args.incremental,
+        asynchronous=args.asynchronous, checkpoint=args.checkpoint,
+        shards=args.shards)
@@ -1,84 +1,93 @@
+import argparse
 import psycopg2
 import operator
 
 from app import common
+from app.create_tables import REPORT_VIEWS, report_query
 
 
-def process_tables():
+def process_tables(source='stats'):
     """
-    Retrieve data from tables
+    Retrieve data from tables. Reports are read from load_stats table
+    kept by populate_tables ('stats'), from materialized views refreshed
+    after every load ('views') or counted in tables ('tables')
     """
 
     try:
-        conn = common.get_db_connection()
-        cur = conn.cursor()
-
-        _count_records_in_every_table(cur)
-        _get_number_patients_by_gender(cur)
-        _get_top_10_procedure_types(cur)
-        _get_most_and_least_popular_days(cur)
-
-        cur.close()
-        conn.commit()
+        _print_reports(source)
 
     except (Exception, psycopg2.DatabaseError) as error:
         print(error)
-    finally:
-        if conn is not None:
-            cur.close()
-            conn.close()
 
 
-def _count_records_in_every_table(cur):
-    print('\n1. Number of records imported into each table:')
+@common.with_db_cursor
+def _print_reports(cur, source):
+    _count_records_in_every_table(cur, source)
+    _get_number_patients_by_gender(cur, source)
+    _get_top_10_procedure_types(cur, source)
+    _get_most_and_least_popular_days(cur, source)
 
-    cur.execute("SELECT COUNT(*) FROM patient;")
-    print(f'* in Patient table - {cur.fetchone()[0]} records')
 
-    cur.execute("SELECT COUNT(*) FROM encounter;")
-    print(f'* in Encounter table - {cur.fetchone()[0]} records')
+def _fetch_report(cur, view, source, suffix=''):
+    """
+    Selects keys with counts of report from load_stats table, its
+    materialized view or query of the view
+    """
+    report = REPORT_VIEWS[view]
+    if source == 'stats':
+        cur.execute(f'SELECT key, count FROM load_stats WHERE stat = %s {suffix}',
+                    (report['stat'],))
+    else:
+        table = view if source == 'views' else f'({report_query(view)}) AS report'
+        cur.execute(f'SELECT {report["key"]}, count FROM {table} {suffix}')
+    return cur.fetchall()
 
-    cur.execute("SELECT COUNT(*) FROM procedure;")
-    print(f'* in Procedure table - {cur.fetchone()[0]} records')
 
-    cur.execute("SELECT COUNT(*) FROM observation;")
-    print(f'* in Observation table - {cur.fetchone()[0]} records')
+def _count_records_in_every_table(cur, source):
+    print('\n1. Number of records imported into each table:')
 
-def _get_number_patients_by_gender(cur):
-    print('\n2. The number of patients by gender:')
+    counts = dict(_fetch_report(cur, 'report_table_counts', source))
+    print(f'* in Patient table - {counts.get("patient", 0)} records')
+    print(f'* in Encounter table - {counts.get("encounter", 0)} records')
+    print(f'* in Procedure table - {counts.get("procedure", 0)} records')
+    print(f'* in Observation table - {counts.get("observation", 0)} records')
 
-    cur.execute("SELECT COUNT(*) FROM patient WHERE patient.gender = 'male';")
-    print(f'* Male - {cur.fetchone()[0]}')
+def _get_number_patients_by_gender(cur, source):
+    print('\n2. The number of patients by gender:')
 
-    cur.execute("SELECT COUNT(*) FROM patient WHERE patient.gender = 'female';")
-    print(f'* Female - {cur.fetchone()[0]}')
+    genders = dict(_fetch_report(cur, 'report_patient_genders', source))
+    print(f'* Male - {genders.get("male", 0)}')
+    print(f'* Female - {genders.get("female", 0)}')
 
-def _get_top_10_procedure_types(cur):
+def _get_top_10_procedure_types(cur, source):
     print('\n3. The top 10 types of procedures:')
-    cur.execute("""SELECT type_code, COUNT(type_code) 
-                   FROM procedure 
-                   GROUP BY type_code 
-                   ORDER BY COUNT(type_code) DESC
-                   LIMIT 10;""")
-    for record in cur:
+    records = _fetch_report(cur, 'report_procedure_types', source,
+                            'ORDER BY count DESC LIMIT 10')
+    for record in records:
         print(f'* {record[0]} type code is in {record[1]} rows')
 
-def _get_most_and_least_popular_days(cur):
+def _get_most_and_least_popular_days(cur, source):
     print('\n4. The most and least popular days of the week when encounters occurred:')
-    # cur.execute("select start_date from encounter limit 10")
-    # cur.execute("select extract(dow from start_date)")
-    cur.execute("""SELECT EXTRACT(DOW FROM start_date), COUNT(type_code) 
-                   FROM encounter
-                   GROUP BY EXTRACT(DOW FROM start_date)
-                   ORDER BY COUNT(start_date) DESC;""")
-
-    days = {}
-    for record in cur:
-        days[int(record[0])] = record[1]
+
+    days = {int(day): count for day, count in
+            _fetch_report(cur, 'report_encounter_days', source)}
     sorted_by_popularity = sorted(days.items(), key=operator.itemgetter(1))
     print('* The most popular is', common.num_to_week_day(sorted_by_popularity[-1][0]))
     print('* The least popular is', common.num_to_week_day(sorted_by_popularity[0][0]))
 
 
+def _parse_args():
+    parser = argparse.ArgumentParser(description='Print reports of loaded data')
+    source = parser.add_mutually_exclusive_group()
+    source.add_argument('--fresh', dest='source', action='store_const',
+                        const='tables', help='count reports in tables')
+    source.add_argument('--cached', dest='source', action='store_const',
+                        const='views',
+                        help='read materialized views refreshed after load')
+    parser.set_defaults(source='stats')
+    return parser.parse_args()
+
+
 if __name__ == '__main__':
-    process_tables()
\ No newline at end of file
+    args = _parse_args()
+    process_tables(args.source)
@@ -0,0 +1,115 @@
+import gzip
+import os
+import re
+import threading
+from collections import Counter
+
+from app import json_backend
+from config.config import LOAD_SETTINGS
+
+MISSING_REQUIRED_FIELDS = 'missing_required_fields'
+UNRESOLVED_REFERENCE = 'unresolved_reference'
+DATABASE_ERROR = 'database_error'
+INVALID_VALUE = 'invalid_value'
+
+
+class RejectionSink:
+    """
+    Saves resources which were not loaded to db with the reason of
+    rejection. Keeps one buffered file per log file name, optionally
+    gzip compressed and rotated when it grows above max_bytes
+    """
+
+    def __init__(self, directory=None, compress=None, max_bytes=None):
+        self.directory = directory or LOAD_SETTINGS['REJECTIONS_DIR']
+        self.compress = (compress if compress is not None
+                         else LOAD_SETTINGS['REJECTIONS_COMPRESS'])
+        self.max_bytes = (max_bytes if max_bytes is not None
+                          else LOAD_SETTINGS['REJECTIONS_MAX_BYTES'])
+        self.counts = Counter()
+        self._files = {}
+        self._written = Counter()
+        self._lock = threading.Lock()
+
+    def reject(self, log_file, data, reason, **details):
+        """
+        Saves decoded resource or its raw ndjson line with the reason
+        """
+        record = _format_record(data, reason, details)
+        with self._lock:
+            self._write(log_file, record)
+            self.counts[(log_file, reason)] += 1
+
+    def merge(self, directory, counts):
+        """
+        Appends records of another sink which saved them to directory
+        uncompressed and not rotated, e.g. in a worker process, and adds
+        their counts
+        """
+        with self._lock:
+            for log_file in sorted({log_file for log_file, _ in counts}):
+                with open(os.path.join(directory, log_file)) as f:
+                    for record in f:
+                        self._write(log_file, record)
+            self.counts.update(counts)
+
+    def summary(self):
+        """
+        Returns number of rejected resources by log file and reason
+        """
+        summary = dict()
+        for (log_file, reason), count in sorted(self.counts.items()):
+            summary.setdefault(log_file, dict())[reason] = count
+        return summary
+
+    def close(self):
+        with self._lock:
+            for f in self._files.values():
+                f.close()
+            self._files = {}
+
+    def _write(self, log_file, record):
+        f = self._files.get(log_file)
+        if f is None:
+            f = self._files[log_file] = self._open(log_file)
+        f.write(record)
+        self._written[log_file] += len(record)
+        if self.max_bytes and self._written[log_file] >= self.max_bytes:
+            self._rotate(log_file)
+
+    def _path(self, log_file):
+        path = os.path.join(self.directory, log_file)
+        return path + '.gz' if self.compress else path
+
+    def _open(self, log_file):
+        os.makedirs(self.directory, exist_ok=True)
+        if self.compress:
+            return gzip.open(self._path(log_file), 'at')
+        return open(self._path(log_file), 'a', buffering=1 << 16)
+
+    def _rotate(self, log_file):
+        self._files.pop(log_file).close()
+        path = self._path(log_file)
+        os.replace(path, f'{path}.{_next_rotation(path)}')
+        self._written[log_file] = 0
+
+
+def _next_rotation(path):
+    """
+    Returns number after the last rotated file of the log, so files
+    rotated by previous runs are not overwritten
+    """
+    directory, name = os.path.split(path)
+    pattern = re.compile(re.escape(name) + r'\.(\d+)$')
+    rotations = [int(match[1]) for match in map(pattern.match, os.listdir(directory))
+                 if match]
+    return max(rotations, default=0) + 1
+
+
+def _format_record(data, reason, details):
+    if isinstance(data, (bytes, bytearray)):
+        resource = data.decode().strip()
+    else:
+        resource = json_backend.dumps(data)
+    header = json_backend.dumps({'reason': reason, **details})
+    return f'{header[:-1]},"resource":{resource}}}\n'
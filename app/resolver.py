@@ -0,0 +1,98 @@
+import os
+import sqlite3
+import tempfile
+
+from config.config import LOAD_SETTINGS
+
+
+class ReferenceResolver:
+    """
+    Maps source_id of already loaded rows of one table to their
+    surrogate id so references are resolved without querying db.
+    If max_in_memory is set, ids above the limit are spilled to
+    a temporary SQLite file.
+    """
+
+    def __init__(self, table, max_in_memory=None, spill_dir=None):
+        self.table = table
+        self.max_in_memory = (max_in_memory if max_in_memory is not None
+                              else LOAD_SETTINGS['RESOLVER_MAX_IN_MEMORY'])
+        self.spill_dir = spill_dir or LOAD_SETTINGS['RESOLVER_SPILL_DIR']
+        self.ids = {}
+        self._spill = None
+        self._spill_path = None
+
+    def load(self, cur):
+        """
+        Bulk loads ids of all rows of the table with one query
+        """
+        with cur.connection.cursor(name=f'{self.table}_ids') as ids_cur:
+            ids_cur.itersize = LOAD_SETTINGS['BATCH_SIZE']
+            ids_cur.execute(f'SELECT source_id, id FROM {self.table}')
+            for source_id, id in ids_cur:
+                self.record(source_id, id)
+
+    async def load_async(self, conn):
+        """
+        Same as load for asyncpg connection in a transaction
+        """
+        async for source_id, id in conn.cursor(
+                f'SELECT source_id, id FROM {self.table}',
+                prefetch=LOAD_SETTINGS['BATCH_SIZE']):
+            self.record(source_id, id)
+
+    def share(self):
+        """
+        Returns state of the resolver worker processes open it from
+        with open_shared to resolve references read only
+        """
+        if self._spill is not None:
+            self._spill.commit()
+        return self.table, self.ids, self._spill_path
+
+    @classmethod
+    def open_shared(cls, state):
+        table, ids, spill_path = state
+        resolver = cls(table)
+        resolver.ids = ids
+        if spill_path is not None:
+            resolver._spill = sqlite3.connect(
+                f'file:{spill_path}?mode=ro', uri=True, check_same_thread=False)
+        return resolver
+
+    def record(self, source_id, id):
+        if self.max_in_memory and len(self.ids) >= self.max_in_memory \
+                and source_id not in self.ids:
+            self._spill_record(source_id, id)
+        else:
+            self.ids[source_id] = id
+
+    def resolve(self, source_id):
+        id = self.ids.get(source_id)
+        if id is None and self._spill is not None:
+            row = self._spill.execute(
+                'SELECT id FROM ids WHERE source_id = ?', (source_id,)
+            ).fetchone()
+            if row:
+                id = row[0]
+        return id
+
+    def close(self):
+        if self._spill is not None:
+            self._spill.close()
+            if self._spill_path is not None:
+                os.remove(self._spill_path)
+            self._spill = None
+
+    def _spill_record(self, source_id, id):
+        if self._spill is None:
+            fd, self._spill_path = tempfile.mkstemp(
+                prefix=f'{self.table}_ids_', suffix='.sqlite',
+                dir=self.spill_dir)
+            os.close(fd)
+            self._spill = sqlite3.connect(
+                self._spill_path, check_same_thread=False)
+            self._spill.execute(
+                'CREATE TABLE ids (source_id TEXT PRIMARY KEY, id INTEGER)')
+        self._spill.execute(
+            'INSERT OR REPLACE INTO ids VALUES (?, ?)', (source_id, id))
@@ -0,0 +1,109 @@
+import queue
+import threading
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+STAGE_DEPENDENCIES = {
+    'patient': (),
+    'encounter': ('patient',),
+    'procedure': ('patient', 'encounter'),
+    'observation': ('patient', 'encounter')
+}
+
+_DONE = object()
+
+
+def run_stages(stages, dependencies, max_workers=None):
+    """
+    Runs every stage callable as soon as all stages it depends on are
+    finished, so independent stages run concurrently. The first failed
+    stage cancels not started ones and its error is raised
+    """
+    _check_dependencies(stages, dependencies)
+    done = set()
+    running = {}
+    with ThreadPoolExecutor(max_workers=max_workers or len(stages)) as executor:
+        while len(done) < len(stages):
+            for name in stages:
+                ready = all(dep in done for dep in dependencies.get(name, ()))
+                if name not in done and name not in running.values() and ready:
+                    running[executor.submit(stages[name])] = name
+
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                name = running.pop(future)
+                error = future.exception()
+                if error is not None:
+                    for pending in running:
+                        pending.cancel()
+                    raise error
+                done.add(name)
+
+
+def prefetch(iterable, size):
+    """
+    Starts iterating in a background thread right away and returns
+    generator over items buffered in a bounded queue
+    """
+    items = queue.Queue(maxsize=size)
+    stopped = threading.Event()
+
+    def produce():
+        try:
+            for item in iterable:
+                if not _put(items, item, stopped):
+                    return
+            _put(items, _DONE, stopped)
+        except BaseException as error:
+            _put(items, _PrefetchError(error), stopped)
+
+    threading.Thread(target=produce, daemon=True).start()
+    return _consume(items, stopped)
+
+
+def _consume(items, stopped):
+    try:
+        while True:
+            item = items.get()
+            if item is _DONE:
+                return
+            if isinstance(item, _PrefetchError):
+                raise item.error
+            yield item
+    finally:
+        stopped.set()
+
+
+def _put(items, item, stopped):
+    while not stopped.is_set():
+        try:
+            items.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def _check_dependencies(stages, dependencies):
+    visiting = set()
+    visited = set()
+
+    def visit(name):
+        if name in visited:
+            return
+        if name in visiting:
+            raise ValueError(f'Cyclic dependency on stage {name}')
+        visiting.add(name)
+        for dep in dependencies.get(name, ()):
+            if dep not in stages:
+                raise ValueError(f'Stage {name} depends on unknown stage {dep}')
+            visit(dep)
+        visiting.discard(name)
+        visited.add(name)
+
+    for name in stages:
+        visit(name)
+
+
+class _PrefetchError:
+    def __init__(self, error):
+        self.error = error
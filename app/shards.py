@@ -0,0 +1,121 @@
+import os
+import tempfile
+import time
+from collections import Counter
+from concurrent.futures import as_completed
+
+from app import codes
+from app import common
+from app import populate_tables
+from app.metrics import Metrics
+from app.rejections import RejectionSink
+from app.resolver import ReferenceResolver
+from app.sources import iter_file_lines, resolve_paths, split_file
+from app.transform import process_pool
+
+# Resolvers of referenced tables opened by the worker process
+_resolvers = None
+
+# Content hashes of loaded resources of the table in incremental loads
+_content_hashes = None
+
+
+def populate_table_sharded(cur, load, table):
+    """
+    Splits files of the local source of the table into byte ranges at
+    line boundaries and loads every range in a worker process with a
+    connection and transaction of its own. References are resolved
+    against ids of the referenced tables handed to spawned workers.
+    Incremental loads read content hashes of the table once and hand
+    them to workers too. Every range merges statistics of its rows in
+    its transaction. Skipped resources, rejection logs and metrics of
+    ranges are merged into the load when all of them are committed. Ids
+    of the table are read in cur afterwards
+    """
+    spec = populate_tables.TABLES[table]
+    start = time.time()
+    ranges = [
+        (path, range_start, range_end)
+        for path in resolve_paths(load['sharded'][table])
+        for range_start, range_end in split_file(path, load['shards'])
+    ]
+    shared = [load['resolvers'][reference].share()
+              for reference in spec['references']]
+    content_hashes = None
+    if load['incremental']:
+        content_hashes = populate_tables._load_content_hashes(cur, table)
+        load['metrics'].inc('db_round_trips_total', 1, table=table)
+    with tempfile.TemporaryDirectory(prefix=f'{table}_shards_') as directory:
+        with process_pool(load['shards'], _init_shard_worker,
+                          (shared, content_hashes)) as executor:
+            futures = [
+                executor.submit(_load_range, table, path, range_start, range_end,
+                                load['incremental'],
+                                os.path.join(directory, str(number)))
+                for number, (path, range_start, range_end) in enumerate(ranges)
+            ]
+            try:
+                for future in as_completed(futures):
+                    future.result()
+            except BaseException:
+                for future in futures:
+                    future.cancel()
+                raise
+        rows_written = 0
+        for future in futures:
+            skipped, unchanged, rejected, metrics, rows, shard_directory = \
+                future.result()
+            for report_key, count in skipped.items():
+                load['report']['skipped'][report_key] += count
+            for report_key, count in unchanged.items():
+                load['report']['unchanged'][report_key] += count
+            load['rejections'].merge(shard_directory, rejected)
+            load['metrics'].merge(metrics)
+            rows_written += rows
+
+    if table in load['resolvers']:
+        load['resolvers'][table].load(cur)
+    load['metrics'].inc('shards_total', len(ranges), table=table)
+    populate_tables._report_table(load, table, start, rows_written)
+
+
+def _init_shard_worker(shared, content_hashes):
+    global _resolvers, _content_hashes
+    _resolvers = {}
+    for state in shared:
+        resolver = ReferenceResolver.open_shared(state)
+        _resolvers[resolver.table] = resolver
+    _content_hashes = content_hashes
+
+
+def _load_range(table, path, start, end, incremental, directory):
+    """
+    Loads resources of the byte range of the file in the worker process
+    and returns what it counted, with rejections saved to directory.
+    Connections of the worker are closed afterwards
+    """
+    metrics = Metrics()
+    rejections = RejectionSink(directory, compress=False, max_bytes=0)
+    load = {
+        'report': {'skipped': Counter(), 'unchanged': Counter()},
+        'resolvers': _resolvers,
+        'rejections': rejections,
+        'metrics': metrics,
+        'incremental': incremental,
+        'checkpoints': None,
+        'sharded': {table: path},
+        'codes': codes.CodeCache() if codes.is_normalized() else None
+    }
+    try:
+        transformed = populate_tables._transform_lines(
+            table, iter_file_lines(path, start, end), metrics)
+        with common.db_cursor() as cur:
+            rows_written = populate_tables._write_table(
+                cur, load, table, transformed, _content_hashes)
+    finally:
+        rejections.close()
+        if load['codes'] is not None:
+            load['codes'].close()
+        common.close_connection_pool()
+    return (load['report']['skipped'], load['report']['unchanged'],
+            rejections.counts, metrics, rows_written, directory)
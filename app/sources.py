@@ -0,0 +1,124 @@
+import glob
+import gzip
+import mmap
+import os
+
+import requests
+
+from config.config import LOAD_SETTINGS
+
+NDJSON_EXTENSIONS = ('.ndjson', '.ndjson.gz', '.ndjson.zst')
+
+
+def iter_lines(source):
+    """
+    Yields raw lines of ndjson source. Source may be a link, a path
+    to a file, a glob pattern or a directory with ndjson files
+    """
+    if source.startswith(('http://', 'https://')):
+        yield from _iter_link_lines(source)
+        return
+    for path in resolve_paths(source):
+        yield from iter_file_lines(path)
+
+
+def resolve_paths(source):
+    """
+    Returns sorted list of files the local source points to. A directory
+    or glob pattern without files is an error like a missing file, so a
+    mistyped source does not load an empty table
+    """
+    if os.path.isdir(source):
+        paths = sorted(
+            os.path.join(source, name) for name in os.listdir(source)
+            if name.endswith(NDJSON_EXTENSIONS))
+    elif glob.has_magic(source):
+        paths = sorted(glob.glob(source))
+    elif os.path.exists(source):
+        paths = [source]
+    else:
+        raise FileNotFoundError(source)
+    if not paths:
+        raise FileNotFoundError(f'No ndjson files in {source}')
+    return paths
+
+
+def iter_file_lines(path, start=0, end=None):
+    """
+    Yields raw lines of the file. Lines of plain files may be read from
+    the byte range between start and end only
+    """
+    if path.endswith('.gz'):
+        with gzip.open(path, 'rb') as f:
+            yield from f
+    elif path.endswith('.zst'):
+        yield from _iter_zstd_lines(path)
+    else:
+        yield from _iter_mmap_lines(path, start, end)
+
+
+def split_file(path, parts):
+    """
+    Splits plain ndjson file into at most parts byte ranges of about
+    the same size which start and end at line boundaries. Compressed
+    files can not be read from the middle, so they are one range
+    """
+    if path.endswith(('.gz', '.zst')):
+        return [(0, None)]
+    size = os.path.getsize(path)
+    bounds = [0]
+    with open(path, 'rb') as f:
+        for part in range(1, parts):
+            offset = size * part // parts
+            if offset <= bounds[-1]:
+                continue
+            # Range starts after the newline ending the line at offset
+            f.seek(offset - 1)
+            f.readline()
+            if f.tell() >= size:
+                break
+            bounds.append(f.tell())
+    bounds.append(size)
+    return list(zip(bounds, bounds[1:]))
+
+
+def _iter_link_lines(link):
+    with requests.get(link, stream=True,
+                      timeout=LOAD_SETTINGS['DOWNLOAD_TIMEOUT']) as response:
+        response.raise_for_status()
+        yield from response.iter_lines(
+            chunk_size=LOAD_SETTINGS['STREAM_CHUNK_SIZE'])
+
+
+def _iter_mmap_lines(path, start=0, end=None):
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            end = len(mm) if end is None else end
+            while start < end:
+                newline = mm.find(b'\n', start, end)
+                if newline == -1:
+                    newline = end
+                yield mm[start:newline]
+                start = newline + 1
+
+
+def _iter_zstd_lines(path):
+    try:
+        import zstandard
+    except ImportError:
+        raise RuntimeError(
+            f'zstandard package is required to read {path}') from None
+    with open(path, 'rb') as f:
+        reader = zstandard.ZstdDecompressor().stream_reader(f)
+        buffer = b''
+        while True:
+            chunk = reader.read(LOAD_SETTINGS['STREAM_CHUNK_SIZE'])
+            if not chunk:
+                break
+            lines = (buffer + chunk).split(b'\n')
+            buffer = lines.pop()
+            yield from lines
+        if buffer:
+            yield buffer
@@ -0,0 +1,112 @@
+import sqlite3
+
+import psycopg2
+
+from config.config import DB_SETTINGS
+
+BACKENDS = ('postgres', 'sqlite')
+
+# Errors of statements rejected by either backend
+DATABASE_ERRORS = (psycopg2.DatabaseError, sqlite3.DatabaseError)
+
+
+def get_backend():
+    """
+    Returns storage backend set by DB_SETTINGS['BACKEND']: PostgreSQL
+    server or SQLite file embedded in the process
+    """
+    backend = DB_SETTINGS['BACKEND']
+    if backend not in BACKENDS:
+        raise ValueError(f'Unknown storage backend {backend}')
+    return backend
+
+
+def is_embedded():
+    return get_backend() == 'sqlite'
+
+
+def connect_sqlite(path=None):
+    conn = sqlite3.connect(path or DB_SETTINGS['SQLITE_PATH'],
+                           timeout=DB_SETTINGS['SQLITE_TIMEOUT'],
+                           check_same_thread=False)
+    conn.execute('PRAGMA journal_mode = WAL')
+    conn.execute('PRAGMA foreign_keys = ON')
+    return SQLiteConnection(conn)
+
+
+def day_of_week(column):
+    """
+    SQL expression of day of week of date column, 0 is Sunday
+    """
+    if is_embedded():
+        return f"CAST(strftime('%w', substr({column}, 1, 10)) AS integer)"
+    return f'EXTRACT(DOW FROM {column})::int'
+
+
+class SQLiteConnection:
+    """
+    Wraps sqlite3 connection so it is used like psycopg2 one. Cursors
+    are context managers and take %s placeholders. Names of server-side
+    cursors are ignored since SQLite reads rows lazily anyway.
+    Savepoints are nested in a transaction as in PostgreSQL, instead of
+    starting and committing one of their own
+    """
+    closed = 0
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def cursor(self, name=None):
+        return SQLiteCursor(self, self.conn.cursor())
+
+    def commit(self):
+        self.conn.commit()
+
+    def rollback(self):
+        self.conn.rollback()
+
+    def close(self):
+        self.conn.close()
+        self.closed = 1
+
+
+class SQLiteCursor:
+    itersize = None
+
+    def __init__(self, connection, cur):
+        self.connection = connection
+        self.cur = cur
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.cur.close()
+
+    def __iter__(self):
+        return iter(self.cur)
+
+    @property
+    def description(self):
+        return self.cur.description
+
+    def execute(self, query, params=()):
+        if query.startswith('SAVEPOINT') and not self.connection.conn.in_transaction:
+            self.cur.execute('BEGIN')
+        self.cur.execute(_qmark(query), params)
+
+    def executemany(self, query, params):
+        self.cur.executemany(_qmark(query), params)
+
+    def fetchone(self):
+        return self.cur.fetchone()
+
+    def fetchmany(self, size):
+        return self.cur.fetchmany(size)
+
+    def fetchall(self):
+        return self.cur.fetchall()
+
+
+def _qmark(query):
+    return query.replace('%s', '?')
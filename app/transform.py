@@ -0,0 +1,89 @@
+import multiprocessing
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+from config.config import DB_SETTINGS, LOAD_SETTINGS
+
+
+def process_pool(workers, initializer=None, initargs=()):
+    """
+    Returns pool of worker processes which are spawned instead of forked,
+    since the loader forks them from threads of stages holding db and IO
+    locks a forked child would inherit locked. Settings of the loader
+    are applied in every worker before the initializer runs
+    """
+    return ProcessPoolExecutor(
+        max_workers=workers, mp_context=multiprocessing.get_context('spawn'),
+        initializer=_init_worker,
+        initargs=(dict(DB_SETTINGS), dict(LOAD_SETTINGS), initializer, initargs))
+
+
+def _init_worker(db_settings, load_settings, initializer, initargs):
+    DB_SETTINGS.update(db_settings)
+    LOAD_SETTINGS.update(load_settings)
+    if initializer is not None:
+        initializer(*initargs)
+
+
+def transform_in_pool(transform, lines, workers=None, chunk_size=None,
+                      metrics=None, **labels):
+    """
+    Transforms raw ndjson lines into references and rows in worker
+    processes. Yields raw line of every resource with its references
+    and rows in the input order. Time spent on fetching lines and on
+    decoding and transforming them in workers is added to metrics
+    """
+    workers = workers or LOAD_SETTINGS['TRANSFORM_WORKERS']
+    chunk_size = chunk_size or LOAD_SETTINGS['TRANSFORM_CHUNK_SIZE']
+    fetch_time = transform_time = 0
+    with process_pool(workers) as executor:
+        pending = deque()
+        chunks = _chunks(lines, chunk_size)
+        try:
+            while True:
+                start = time.perf_counter()
+                chunk = next(chunks, None)
+                fetch_time += time.perf_counter() - start
+                if chunk is None:
+                    break
+                pending.append(
+                    (chunk, executor.submit(_transform_chunk, transform, chunk)))
+                if len(pending) >= workers * 2:
+                    transform_time += yield from _chunk_results(*pending.popleft())
+            while pending:
+                transform_time += yield from _chunk_results(*pending.popleft())
+        finally:
+            if metrics is not None:
+                metrics.inc('stage_seconds_total', fetch_time, stage='fetch', **labels)
+                metrics.inc('stage_seconds_total', transform_time, stage='transform',
+                            **labels)
+
+
+def _transform_chunk(transform, chunk):
+    start = time.perf_counter()
+    results = [transform(line) for line in chunk]
+    return results, time.perf_counter() - start
+
+
+def _chunk_results(chunk, future):
+    """
+    Yields results of the chunk and returns time workers spent on it
+    """
+    results, elapsed = future.result()
+    for line, (references, rows) in zip(chunk, results):
+        yield line, references, rows
+    return elapsed
+
+
+def _chunks(lines, chunk_size):
+    chunk = []
+    for line in lines:
+        if not line.strip():
+            continue
+        chunk.append(bytes(line))
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
@@ -1,6 +1,51 @@
 DB_SETTINGS = {
+    'BACKEND': 'postgres',
+    'SQLITE_PATH': 'healthcare.sqlite',
+    'SQLITE_TIMEOUT': 600,
     'NAME': 'my_test_db',
     'HOST': 'localhost',
     'PORT': 54320,
-    'USER': 'postgres'
+    'USER': 'postgres',
+    'POOL_MIN_SIZE': 1,
+    'POOL_MAX_SIZE': 8
+}
+
+LOAD_SETTINGS = {
+    'BATCH_SIZE': 5000,
+    'STREAM_CHUNK_SIZE': 64 * 1024,
+    'DOWNLOAD_CACHE_DIR': None,
+    'DOWNLOAD_REVALIDATE': True,
+    'DOWNLOAD_TIMEOUT': 60,
+    'PARALLEL': False,
+    'WORKERS': 4,
+    'PREFETCH_SIZE': 10000,
+    'TRANSFORM_WORKERS': 0,
+    'TRANSFORM_CHUNK_SIZE': 1000,
+    'SHARDS': 0,
+    'SHARDED_TABLES': ('observation',),
+    'DEFER_INDEXES': False,
+    'PARTITIONED_TABLES': (),
+    'PARTITION_RETENTION_MONTHS': None,
+    'NORMALIZED_CODES': False,
+    'INCREMENTAL': False,
+    'ASYNC': False,
+    'CHECKPOINTS': False,
+    'REJECTIONS_DIR': 'logs',
+    'REJECTIONS_COMPRESS': False,
+    'REJECTIONS_MAX_BYTES': None,
+    'JSON_BACKEND': None,
+    'METRICS_DIR': 'logs',
+    'METRICS_PERSIST': False,
+    'REFRESH_REPORTS': True,
+    'EXPORT_DIR': 'export',
+    'EXPORT_COMPRESSION': 'zstd',
+    'RESOLVER_MAX_IN_MEMORY': None,
+    'RESOLVER_SPILL_DIR': None
+}
+
+SOURCES = {
+    'patient': 'https://raw.githubusercontent.com/smart-on-fhir/flat-fhir-files/master/r3/Patient.ndjson',
+    'encounter': 'https://raw.githubusercontent.com/smart-on-fhir/flat-fhir-files/master/r3/Encounter.ndjson',
+    'procedure': 'https://raw.githubusercontent.com/smart-on-fhir/flat-fhir-files/master/r3/Procedure.ndjson',
+    'observation': 'https://raw.githubusercontent.com/smart-on-fhir/flat-fhir-files/master/r3/Observation.ndjson'
 }
@@ -0,0 +1,230 @@
+import argparse
+import datetime
+import functools
+import glob
+import gzip
+import json
+import multiprocessing
+import os
+import resource
+import subprocess
+import tempfile
+import time
+
+from app import common
+from app import json_backend
+from app import populate_tables
+from app import process_tables
+from app.create_tables import create_tables
+from app.resolver import ReferenceResolver
+from app.sources import iter_lines
+from tests import synthetic
+
+STAGES = ('decode', 'transform', 'resolve', 'write', 'report')
+DB_STAGES = ('write', 'report')
+
+
+def run_benchmark(data, resources, results, stages=STAGES, seed=0,
+                  component_rate=0.1, invalid_rate=0.01):
+    """
+    Generates synthetic dataset, runs every stage in its own spawned
+    process and appends rows/sec and peak RSS of the stages to results
+    file. A stage which fails or writes other number of rows than the
+    dataset has fails the benchmark
+    """
+    synthetic.generate(data, resources, seed, component_rate, invalid_rate)
+    paths = synthetic.resource_paths(data)
+    run = {
+        'started': datetime.datetime.now().isoformat(timespec='seconds'),
+        'commit': _git_commit(),
+        'json_backend': json_backend.get_backend(),
+        'resources': resources,
+        'stages': dict()
+    }
+    functions = dict(STAGE_FUNCTIONS)
+    if 'write' in stages:
+        functions['write'] = functools.partial(
+            _write, expected_rows=_transformed_rows(paths))
+    context = multiprocessing.get_context('spawn')
+    for stage in stages:
+        results_queue = context.Queue()
+        process = context.Process(target=_run_stage,
+                                  args=(functions[stage], paths, results_queue))
+        process.start()
+        process.join()
+        if process.exitcode != 0:
+            raise RuntimeError(f'{stage} stage failed with exit code {process.exitcode}')
+        run['stages'][stage] = results_queue.get()
+        _print_stage(stage, run['stages'][stage])
+
+    previous = _previous_run(results, resources)
+    with open(results, 'a') as f:
+        f.write(json.dumps(run) + '\n')
+    if previous:
+        _print_comparison(previous, run)
+    return run
+
+
+def _run_stage(function, paths, results_queue):
+    start = time.perf_counter()
+    records = function(paths)
+    seconds = time.perf_counter() - start
+    results_queue.put({
+        'records': records,
+        'seconds': round(seconds, 3),
+        'records_per_sec': round(records / seconds) if seconds else None,
+        'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    })
+
+
+def _decode(paths):
+    records = 0
+    for path in paths.values():
+        for line in iter_lines(path):
+            json_backend.loads(line)
+            records += 1
+    return records
+
+
+def _transform(paths):
+    records = 0
+    for table, path in paths.items():
+        for line, references, rows in populate_tables._transform_lines(
+                table, iter_lines(path)):
+            records += 1
+    return records
+
+
+def _resolve(paths):
+    resolvers = {table: ReferenceResolver(table)
+                 for table in ('patient', 'encounter')}
+    for table in resolvers:
+        for id, line in enumerate(iter_lines(paths[table]), start=1):
+            source_id = json_backend.loads(line).get('id')
+            if source_id:
+                resolvers[table].record(source_id, id)
+
+    references = [
+        populate_tables._get_references(json_backend.loads(line))
+        for table in ('procedure', 'observation')
+        for line in iter_lines(paths[table])
+    ]
+    for reference in references:
+        resolvers['patient'].resolve(reference['patient'])
+        resolvers['encounter'].resolve(reference['encounter'])
+    return len(references)
+
+
+def _transformed_rows(paths):
+    return sum(len(rows)
+               for table, path in paths.items()
+               for line, references, rows in populate_tables._transform_lines(
+                   table, iter_lines(path)))
+
+
+def _write(paths, expected_rows):
+    """
+    Loads the dataset and checks that every row the dataset has was
+    written or rejected, since populate_tables prints errors instead of
+    raising them
+    """
+    create_tables()
+    with common.db_cursor() as cur:
+        cur.execute('TRUNCATE patient, encounter, procedure, observation, '
+                    'load_stats RESTART IDENTITY CASCADE')
+    with tempfile.TemporaryDirectory() as logs:
+        populate_tables.LOAD_SETTINGS['REJECTIONS_DIR'] = logs
+        populate_tables.populate_tables(paths)
+        rejected = _rejected_rows(logs)
+    with common.db_cursor() as cur:
+        cur.execute('SELECT (SELECT COUNT(*) FROM patient) '
+                    '+ (SELECT COUNT(*) FROM encounter) '
+                    '+ (SELECT COUNT(*) FROM procedure) '
+                    '+ (SELECT COUNT(*) FROM observation)')
+        rows = cur.fetchone()[0]
+    if rows + rejected != expected_rows:
+        raise RuntimeError(f'{rows} rows written and {rejected} rejected '
+                           f'of {expected_rows} rows of the dataset')
+    return rows
+
+
+def _rejected_rows(logs):
+    rejected = 0
+    for path in glob.glob(os.path.join(logs, '*')):
+        with (gzip.open(path) if path.endswith('.gz') else open(path, 'rb')) as f:
+            rejected += sum(1 for _ in f)
+    return rejected
+
+
+def _report(paths):
+    process_tables.process_tables()
+    return 1
+
+
+STAGE_FUNCTIONS = {
+    'decode': _decode,
+    'transform': _transform,
+    'resolve': _resolve,
+    'write': _write,
+    'report': _report
+}
+
+
+def _git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _previous_run(results, resources):
+    if not os.path.exists(results):
+        return None
+    previous = None
+    with open(results) as f:
+        for line in f:
+            run = json.loads(line)
+            if run['resources'] == resources:
+                previous = run
+    return previous
+
+
+def _print_stage(stage, result):
+    print(f'{stage}: {result["records"]} records in {result["seconds"]} sec, '
+          f'{result["records_per_sec"]} records/sec, '
+          f'peak RSS {result["peak_rss_kb"]} KB')
+
+
+def _print_comparison(previous, run):
+    print(f'\nCompared with run {previous["started"]} ({previous["commit"]}):')
+    for stage, result in run['stages'].items():
+        before = previous['stages'].get(stage)
+        if not before or not before['records_per_sec'] \
+                or not result['records_per_sec']:
+            continue
+        change = result['records_per_sec'] / before['records_per_sec'] - 1
+        print(f'* {stage}: {change:+.1%} records/sec')
+
+
+def _parse_args():
+    parser = argparse.ArgumentParser(description='Benchmark table loading')
+    parser.add_argument('--resources', type=int, default=10000)
+    parser.add_argument('--data', default=os.path.join(
+        tempfile.gettempdir(), 'healthcare_benchmark'))
+    parser.add_argument('--results', default='bench_results.ndjson')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--component-rate', type=float, default=0.1)
+    parser.add_argument('--invalid-rate', type=float, default=0.01)
+    parser.add_argument('--no-db', action='store_true',
+                        help='skip stages which need PostgreSQL')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = _parse_args()
+    stages = [stage for stage in STAGES
+              if not (args.no_db and stage in DB_STAGES)]
+    run_benchmark(args.data, args.resources, args.results, stages, args.seed,
+                  args.component_rate, args.invalid_rate)
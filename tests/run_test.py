@@ -1,6 +1,41 @@
+import asyncio
+import collections
+import contextlib
+import datetime
+import decimal
+import functools
+import gzip
+import http.server
+import json
+import os
+import threading
+
+import psycopg2
 import pytest
 
+from app import async_pipeline
+from app import bulk_writer
+from app import checkpoints
+from app import codes
+from app import common
+from app import create_tables
+from app import downloads
+from app import export_tables
+from app import json_backend
+from app import load_stats
+from app import mappings
+from app import partitions
+from app import metrics
 from app import populate_tables
+from app import process_tables
+from app import rejections
+from app import resolver
+from app import scheduler
+from app import shards
+from app import sources
+from app import storage
+from app import transform
+from tests import synthetic
 
 
 @pytest.fixture
@@ -353,5 +388,1176 @@ def test_skipped_observation(skipped_observation):
     assert all_obligatory_fields is False
 
 
+class FakeCopyCursor:
+    def __init__(self):
+        self.copied = []
+        self.commands = []
+
+    def copy_expert(self, sql, file):
+        self.copied.append((sql, file.read()))
+
+    def execute(self, command, params=None):
+        self.commands.append(command)
+
+
+def test_bulk_writer_copies_in_batches():
+    cur = FakeCopyCursor()
+    writer = bulk_writer.BulkWriter(
+        cur, 'patient', ('source_id', 'gender', 'country'), batch_size=2)
+
+    writer.add({'source_id': 'a', 'gender': 'female', 'country': None})
+    writer.add({'source_id': 'b\tc', 'gender': 'male', 'country': 'US'})
+    writer.add({'source_id': 'd', 'country': 'US'})
+    writer.flush()
+
+    assert cur.copied == [
+        ('COPY patient (source_id, gender, country) FROM STDIN',
+         'a\tfemale\t\\N\nb\\tc\tmale\tUS\n'),
+        ('COPY patient (source_id, gender, country) FROM STDIN',
+         'd\t\\N\tUS\n')
+    ]
+    assert writer.rows_written == 3
+
+
+class RejectingCopyCursor(FakeCopyCursor):
+    def copy_expert(self, sql, file):
+        data = file.read()
+        if 'bad' in data:
+            raise psycopg2.IntegrityError('value too long for type character varying(10)')
+        self.copied.append((sql, data))
+
+
+def test_bulk_writer_isolates_rejected_rows_by_bisection():
+    cur = RejectingCopyCursor()
+    rejected = []
+    writer = bulk_writer.BulkWriter(
+        cur, 'patient', ('source_id', 'gender'), batch_size=8,
+        on_error=lambda context, error: rejected.append((context, str(error))))
+
+    for number in range(8):
+        gender = 'bad' if number in (2, 5) else 'female'
+        writer.add({'source_id': str(number), 'gender': gender}, number)
+
+    assert rejected == [
+        (2, 'value too long for type character varying(10)'),
+        (5, 'value too long for type character varying(10)')]
+    assert writer.rows_written == 6
+    assert sorted(line for _, data in cur.copied for line in data.splitlines()) == [
+        f'{number}\tfemale' for number in (0, 1, 3, 4, 6, 7)]
+    assert cur.commands.count('SAVEPOINT bulk_writer_batch') == 11
+    assert cur.commands.count('ROLLBACK TO SAVEPOINT bulk_writer_batch') == 7
+
+
+def test_resolver_spills_over_memory_cap(tmp_path):
+    patients = resolver.ReferenceResolver(
+        'patient', max_in_memory=2, spill_dir=str(tmp_path))
+    for id, source_id in enumerate(['a', 'b', 'c', 'd'], start=1):
+        patients.record(source_id, id)
+
+    new_data = {}
+    references = populate_tables._get_references(
+        {'subject': {'reference': 'Patient/d'}})
+    populate_tables._resolve_references(
+        {'patient': patients}, ('patient',), references, new_data)
+
+    assert len(patients.ids) == 2
+    assert [patients.resolve(s) for s in 'abcdx'] == [1, 2, 3, 4, None]
+    assert new_data == {'patient_id': 4}
+    patients.close()
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_get_ndjson_streams_local_file(tmp_path, patient, encounter):
+    path = tmp_path / 'resources.ndjson'
+    with open(path, 'w') as f:
+        populate_tables.dict_to_ndjson(patient, f)
+        f.write('\n')
+        populate_tables.dict_to_ndjson(encounter, f)
+
+    resources = populate_tables.get_ndjson(str(path), stream=True)
+
+    assert next(resources) == patient
+    assert list(resources) == [encounter]
+
+
+def test_sources_read_directory_glob_and_gzip(tmp_path):
+    (tmp_path / 'a.ndjson').write_bytes(b'{"id": "1"}\n{"id": "2"}')
+    with gzip.open(tmp_path / 'b.ndjson.gz', 'wb') as f:
+        f.write(b'{"id": "3"}\n')
+    (tmp_path / 'c.ndjson').write_bytes(b'')
+    (tmp_path / 'notes.txt').write_bytes(b'not ndjson')
+
+    assert list(sources.iter_lines(str(tmp_path))) == [
+        b'{"id": "1"}', b'{"id": "2"}', b'{"id": "3"}\n']
+    assert list(sources.iter_lines(str(tmp_path / '*.gz'))) == [
+        b'{"id": "3"}\n']
+
+
+@pytest.mark.parametrize('source', ['empty', 'empty/*.ndjson', 'missing.ndjson'])
+def test_sources_without_files_are_errors(tmp_path, source):
+    (tmp_path / 'empty').mkdir()
+    (tmp_path / 'empty' / 'notes.txt').write_bytes(b'not ndjson')
+
+    with pytest.raises(FileNotFoundError):
+        list(sources.iter_lines(str(tmp_path / source)))
+
+
+def test_link_source_is_streamed_with_timeout(monkeypatch):
+    calls = []
+
+    class FakeResponse:
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *args):
+            pass
+
+        def raise_for_status(self):
+            pass
+
+        def iter_lines(self, chunk_size):
+            return iter([b'{"id": "1"}'])
+
+    def fake_get(link, **kwargs):
+        calls.append(kwargs)
+        return FakeResponse()
+
+    monkeypatch.setattr(sources.requests, 'get', fake_get)
+    monkeypatch.setitem(sources.LOAD_SETTINGS, 'DOWNLOAD_TIMEOUT', 5)
+
+    assert list(sources.iter_lines('https://example.com/a.ndjson')) == [b'{"id": "1"}']
+    assert calls == [{'stream': True, 'timeout': 5}]
+
+
+def test_split_file_aligns_ranges_to_lines(tmp_path):
+    lines = [b'{"id": "%d"}' % number + b' ' * (number % 7) for number in range(100)]
+    path = str(tmp_path / 'a.ndjson')
+    with open(path, 'wb') as f:
+        f.write(b'\n'.join(lines))
+
+    ranges = sources.split_file(path, 4)
+
+    assert len(ranges) == 4
+    assert ranges[0][0] == 0 and ranges[-1][1] == os.path.getsize(path)
+    assert all(end == start for (_, end), (start, _) in zip(ranges, ranges[1:]))
+    assert [bytes(line) for start, end in ranges
+            for line in sources.iter_file_lines(path, start, end)] == lines
+    assert sources.split_file(path + '.gz', 4) == [(0, None)]
+
+
+def test_run_stages_runs_independent_stages_concurrently():
+    finished = []
+    both_started = threading.Barrier(2, timeout=5)
+
+    def stage(name, wait_for_other=False):
+        def run():
+            if wait_for_other:
+                both_started.wait()
+            finished.append(name)
+        return run
+
+    scheduler.run_stages({
+        'patient': stage('patient'),
+        'encounter': stage('encounter'),
+        'procedure': stage('procedure', wait_for_other=True),
+        'observation': stage('observation', wait_for_other=True)
+    }, scheduler.STAGE_DEPENDENCIES)
+
+    assert finished[:2] == ['patient', 'encounter']
+    assert set(finished[2:]) == {'procedure', 'observation'}
+
+
+def test_prefetch_buffers_items_and_raises_source_errors():
+    def resources():
+        yield 1
+        yield 2
+        raise ValueError('broken source')
+
+    prefetched = scheduler.prefetch(resources(), size=1)
+
+    assert next(prefetched) == 1
+    assert next(prefetched) == 2
+    with pytest.raises(ValueError):
+        next(prefetched)
+
+
+def test_transform_in_pool_matches_serial_transform(
+        observation, observation_with_component, skipped_observation):
+    resources = [observation, observation_with_component, skipped_observation]
+    lines = [json.dumps(data).encode() for data in resources] + [b'']
+
+    pool_metrics = metrics.Metrics()
+    pooled = list(transform.transform_in_pool(
+        functools.partial(populate_tables._transform_line, 'observation'),
+        iter(lines), workers=2, chunk_size=2, metrics=pool_metrics,
+        table='observation'))
+    serial = list(populate_tables._transform_lines('observation', lines))
+
+    assert [line for line, _, _ in pooled] == lines[:3]
+    assert [result[1:] for result in pooled] == \
+        [result[1:] for result in serial]
+    assert [len(rows) for _, _, rows in serial] == [1, 2, 1]
+    assert pool_metrics.value('stage_seconds_total', table='observation',
+                              stage='transform') > 0
+    assert (('stage_seconds_total', (('stage', 'fetch'), ('table', 'observation')))
+            in pool_metrics.counters)
+
+
+class FakeConnection:
+    closed = 0
+
+    def __init__(self):
+        self.calls = []
+
+    def commit(self):
+        self.calls.append('commit')
+
+    def rollback(self):
+        self.calls.append('rollback')
+
+
+class FakePool:
+    def __init__(self):
+        self.conn = FakeConnection()
+        self.returned = 0
+        self.closed = False
+
+    def closeall(self):
+        self.closed = True
+
+    def getconn(self):
+        return self.conn
+
+    def putconn(self, conn, close=False):
+        self.returned += 1
+
+
+def test_db_connection_commits_or_rolls_back(monkeypatch):
+    pool = FakePool()
+    monkeypatch.setattr(common, '_pool', pool)
+    monkeypatch.setattr(common, '_pool_slots', threading.BoundedSemaphore(1))
+
+    with common.db_connection() as conn:
+        assert conn is pool.conn
+    with pytest.raises(ValueError):
+        with common.db_connection():
+            raise ValueError('failed statement')
+
+    assert pool.conn.calls == ['commit', 'rollback']
+    assert pool.returned == 2
+
+
+class RecordingCursor:
+    def __init__(self):
+        self.commands = []
+
+    def execute(self, command, params=None):
+        self.commands.append(command)
+
+
+def test_create_indexes_without_deferred_indexes():
+    cur = RecordingCursor()
+
+    create_tables.create_indexes(cur, deferred=False)
+
+    assert cur.commands == list(create_tables.ESSENTIAL_INDEXES.values())
+    assert all('UNIQUE' in command for command in cur.commands)
+
+
+def test_bulk_writer_creates_monthly_partitions():
+    cur = FakeCopyCursor()
+    writer = bulk_writer.BulkWriter(
+        cur, 'observation', ('source_id', 'observation_date'), batch_size=2,
+        partitions=partitions.Partitions('observation'))
+
+    writer.add({'source_id': 'a', 'observation_date': '2012-03-31T23:00:00-05:00'})
+    writer.add({'source_id': 'b', 'observation_date': '2012-04-10T10:00:00+00:00'})
+    writer.add({'source_id': 'c', 'observation_date': '2012-04-01'})
+    writer.flush()
+
+    assert cur.commands == [
+        'CREATE TABLE IF NOT EXISTS observation_2012_04 PARTITION OF observation '
+        "FOR VALUES FROM ('2012-04-01 00:00:00+00') TO ('2012-05-01 00:00:00+00')",
+        'CREATE TABLE IF NOT EXISTS observation_2012_03 PARTITION OF observation '
+        "FOR VALUES FROM ('2012-03-01 00:00:00+00') TO ('2012-04-01 00:00:00+00')"]
+    assert len(cur.copied) == 2
+
+
+def test_partitioned_tables_and_retention(monkeypatch):
+    monkeypatch.setitem(partitions.LOAD_SETTINGS, 'PARTITIONED_TABLES',
+                        ('observation', 'procedure'))
+    cur = RecordingCursor()
+    create_tables.create_indexes(cur, deferred=False)
+    cur.fetchall = lambda: [('observation_2019_12',), ('observation_2020_01',),
+                            ('observation_default',)]
+
+    dropped = partitions.drop_expired_partitions(
+        cur, 'observation', 2, today=datetime.date(2020, 3, 15))
+
+    assert 'PARTITION BY RANGE (observation_date)' in create_tables._partition_by(
+        'observation')
+    assert 'CREATE INDEX IF NOT EXISTS procedure_source_id_key' in cur.commands[2]
+    assert dropped == ['observation_2019_12']
+    assert cur.commands[-1] == 'DROP TABLE observation_2019_12'
+
+
+class ReportCursor(RecordingCursor):
+    results = {
+        'rows': [('patient', 2), ('observation', 5)],
+        'gender': [('female', 2)],
+        'procedure_type': [('73761001', 4)],
+        'encounter_day': [('1', 2), ('5', 1)]
+    }
+
+    def execute(self, command, params=None):
+        super().execute(command, params)
+        self.stat = params[0] if params else next(
+            view['stat'] for view in create_tables.REPORT_VIEWS.values()
+            if f'SELECT {view["key"]}, count' in command)
+
+    def fetchall(self):
+        return self.results[self.stat]
+
+
+@pytest.mark.parametrize('source', ['stats', 'views', 'tables'])
+def test_reports_read_from_source(capsys, source):
+    cur = ReportCursor()
+
+    for report in (process_tables._count_records_in_every_table,
+                   process_tables._get_number_patients_by_gender,
+                   process_tables._get_top_10_procedure_types,
+                   process_tables._get_most_and_least_popular_days):
+        report(cur, source)
+    output = capsys.readouterr().out
+
+    assert len(cur.commands) == 4
+    assert all(('FROM load_stats' in command) == (source == 'stats')
+               for command in cur.commands)
+    assert all(('FROM report_' in command) == (source == 'views')
+               for command in cur.commands)
+    assert '* in Observation table - 5 records' in output
+    assert '* in Encounter table - 0 records' in output
+    assert '* Male - 0' in output and '* Female - 2' in output
+    assert '* The most popular is Monday' in output
+
+
+def test_load_stats_count_written_rows(patient, encounter):
+    _, patient_rows = populate_tables._transform('patient', patient)
+    _, encounter_rows = populate_tables._transform('encounter', encounter)
+    patients = load_stats.LoadStats('patient')
+    encounters = load_stats.LoadStats('encounter')
+
+    for _, new_data in patient_rows * 2:
+        patients.add(new_data)
+    for _, new_data in encounter_rows:
+        encounters.add(new_data)
+
+    assert patients.counts == {
+        ('rows', 'patient'): 2, ('gender', patient['gender']): 2}
+    day = datetime.date.fromisoformat(encounter['period']['start'][:10])
+    assert encounters.counts == {
+        ('rows', 'encounter'): 1,
+        ('encounter_day', str(int(day.strftime('%w')))): 1}
+
+
+def test_incremental_skips_unchanged_resources(patient, encounter):
+    patient_hash = populate_tables._content_hash(patient)
+    _, patient_rows = populate_tables._transform('patient', patient)
+    _, encounter_rows = populate_tables._transform('encounter', encounter)
+    del encounter['meta']
+
+    assert patient_hash == '1|2018-10-04T20:23:48.214-04:00'
+    assert populate_tables._is_unchanged(
+        {patient['id']: (patient_hash, ())}, patient_rows)
+    assert not populate_tables._is_unchanged(
+        {encounter['id']: ('stale hash', ())}, encounter_rows)
+    assert len(populate_tables._content_hash(encounter)) == 32
+
+
+def test_content_hash_covers_fields_the_table_does_not_decode(encounter):
+    del encounter['meta']
+    line = json.dumps(encounter).encode()
+    changed = json.dumps(dict(encounter, language='fr')).encode()
+
+    _, rows = populate_tables._transform_line('encounter', line)
+    _, changed_rows = populate_tables._transform_line('encounter', changed)
+
+    assert rows[0][1]['content_hash'] == checkpoints.line_hash(line)
+    assert changed_rows[0][1]['content_hash'] != rows[0][1]['content_hash']
+
+
+def test_bulk_writer_upserts_through_staging_table():
+    cur = FakeCopyCursor()
+    writer = bulk_writer.BulkWriter(
+        cur, 'encounter', ('source_id', 'type_code'), mode='upsert')
+
+    writer.add({'source_id': 'a', 'type_code': '1'})
+    writer.flush()
+
+    assert cur.copied == [
+        ('COPY encounter_staging (source_id, type_code) FROM STDIN', 'a\t1\n')]
+    assert cur.commands[1] == (
+        'INSERT INTO encounter (source_id, type_code) '
+        'SELECT source_id, type_code FROM encounter_staging '
+        'ON CONFLICT (source_id) DO UPDATE SET type_code = EXCLUDED.type_code')
+
+
+def test_compiled_mapping_uses_fallback_paths_and_required_flags():
+    extract = mappings.compile_mapping({
+        'source_id': ('id', mappings.REQUIRED),
+        'date': ('performedDateTime | performedPeriod.start', mappings.REQUIRED),
+        'code': ('code.coding.0.code', mappings.REQUIRED),
+        'system': ('code.coding.0.system', mappings.OPTIONAL),
+        'unit': ('valueQuantity.unit', mappings.OPTIONAL)
+    })
+
+    assert extract({
+        'id': '1',
+        'performedPeriod': {'start': '2017-01-24'},
+        'code': {'coding': [{'code': 'c'}]},
+        'valueQuantity': 'not an object'
+    }, {}) == {
+        'source_id': '1', 'date': '2017-01-24', 'code': 'c',
+        'system': None, 'unit': None
+    }
+    assert extract({'id': '2', 'code': {'coding': []}}, {}) == {
+        'source_id': '2', 'system': None, 'unit': None
+    }
+
+
+def test_rejection_sink_keeps_reasons_and_rotates(tmp_path, procedure):
+    sink = rejections.RejectionSink(directory=str(tmp_path), max_bytes=1000)
+    references = populate_tables._get_references(procedure)
+
+    populate_tables._skip_saving_and_write_logs(
+        sink, 'skipped_procedures.ndjson', procedure, references,
+        {'patient_id'})
+    populate_tables._skip_saving_and_write_logs(
+        sink, 'skipped_procedures.ndjson', b'{"id": "2"}\n', {},
+        {'patient_id', 'procedure_date'})
+    sink.close()
+
+    rotated = tmp_path / 'skipped_procedures.ndjson.1'
+    records = [json.loads(line) for line in
+               (tmp_path / 'skipped_procedures.ndjson').read_text().splitlines()]
+    assert json.loads(rotated.read_text()) == {
+        'reason': 'unresolved_reference', 'missing_fields': ['patient_id'],
+        'resource': procedure
+    }
+    assert records == [{
+        'reason': 'missing_required_fields',
+        'missing_fields': ['patient_id', 'procedure_date'],
+        'resource': {'id': '2'}
+    }]
+    assert sink.summary() == {'skipped_procedures.ndjson': {
+        'missing_required_fields': 1, 'unresolved_reference': 1}}
+
+
+def test_rejection_sink_keeps_files_rotated_by_previous_runs(tmp_path):
+    for run in range(2):
+        sink = rejections.RejectionSink(directory=str(tmp_path), max_bytes=10)
+        sink.reject('skipped_patients.ndjson', {'id': str(run)}, 'missing_required_fields')
+        sink.close()
+
+    rotated = [json.loads((tmp_path / f'skipped_patients.ndjson.{number}').read_text())
+               for number in (1, 2)]
+    assert [record['resource'] for record in rotated] == [{'id': '0'}, {'id': '1'}]
+
+
+@pytest.mark.parametrize('backend', ['json', None])
+def test_json_backend_selective_decoding(monkeypatch, backend, procedure):
+    monkeypatch.setitem(json_backend.LOAD_SETTINGS, 'JSON_BACKEND', backend)
+    line = json_backend.dumps(procedure).encode()
+    fields = populate_tables.TABLES['procedure']['fields']
+
+    data = json_backend.loads_selective(line, fields)
+
+    assert mappings.get_fields(mappings.PROCEDURE) == {
+        'id', 'performedDateTime', 'performedPeriod', 'code'}
+    assert json_backend.loads(line) == procedure
+    assert {key: procedure[key] for key in fields if key in procedure} == \
+        {key: data[key] for key in fields if key in data}
+
+
+def test_synthetic_generator_is_deterministic(tmp_path):
+    counts = synthetic.generate(
+        str(tmp_path / 'a'), 2000, seed=1, component_rate=0.5, invalid_rate=0.1)
+    synthetic.generate(
+        str(tmp_path / 'b'), 2000, seed=1, component_rate=0.5, invalid_rate=0.1)
+    paths = synthetic.resource_paths(str(tmp_path / 'a'))
+
+    observations = list(populate_tables._transform_lines(
+        'observation', sources.iter_lines(paths['observation'])))
+    without_value = [rows for _, _, rows in observations
+                     if any('value' not in new_data for _, new_data in rows)]
+
+    assert counts == {'patient': 20, 'encounter': 200, 'procedure': 300,
+                      'observation': 1480}
+    for name in synthetic.RESOURCE_FILES.values():
+        assert (tmp_path / 'a' / name).read_bytes() == \
+            (tmp_path / 'b' / name).read_bytes()
+    assert len(observations) == 1480
+    assert 0 < len(without_value) < 1480 * 0.2
+    assert any(len(rows) == 2 for _, _, rows in observations)
+
+
+def test_metrics_export(tmp_path):
+    load_metrics = metrics.Metrics()
+    load_metrics.inc('rows_written_total', 2, table='patient')
+    load_metrics.inc('rows_written_total', 3, table='patient')
+    load_metrics.observe('write_batch_seconds', 0.002, buckets=(0.001, 0.01),
+                         table='patient')
+    load_metrics.observe('write_batch_seconds', 5, buckets=(0.001, 0.01),
+                         table='patient')
+
+    load_metrics.export(str(tmp_path))
+    exported = json.loads((tmp_path / 'metrics.json').read_text())
+    prometheus = (tmp_path / 'metrics.prom').read_text().splitlines()
+
+    assert load_metrics.value('rows_written_total', table='patient') == 5
+    assert exported['counters']['rows_written_total'] == [
+        {'labels': {'table': 'patient'}, 'value': 5}]
+    assert exported['histograms']['write_batch_seconds'][0]['buckets'] == {
+        '0.001': 0, '0.01': 1, '+Inf': 2}
+    assert 'healthcare_load_rows_written_total{table="patient"} 5' in prometheus
+    assert 'healthcare_load_write_batch_seconds_bucket' \
+        '{table="patient",le="0.01"} 1' in prometheus
+    assert 'healthcare_load_write_batch_seconds_count{table="patient"} 2' \
+        in prometheus
+
+
+def test_transform_lines_records_stage_time(patient):
+    load_metrics = metrics.Metrics()
+    lines = [json.dumps(patient), '']
+
+    transformed = list(populate_tables._transform_lines(
+        'patient', lines, load_metrics))
+
+    assert len(transformed) == 1
+    assert {stage for (name, labels) in load_metrics.counters
+            for key, stage in labels if key == 'stage'} == {
+        'fetch', 'decode', 'transform'}
+
+
+class FakeAsyncConnection:
+    def __init__(self, ids):
+        self.ids = ids
+        self.copied = []
+        self.commands = []
+
+    async def copy_to_table(self, table, source, columns, format):
+        self.copied.append((table, source.read().decode()))
+
+    async def execute(self, command, *args):
+        self.commands.append(command)
+
+    def transaction(self):
+        return contextlib.nullcontext()
+
+    async def cursor(self, query, prefetch):
+        for row in self.ids:
+            yield row
+
+
+class FakeAsyncPool:
+    def __init__(self, conn):
+        self.conn = conn
+
+    def acquire(self):
+        return contextlib.nullcontext(self.conn)
+
+
+def test_async_pipeline_writes_table(tmp_path, patient):
+    source = tmp_path / 'Patient.ndjson'
+    invalid = {key: value for key, value in patient.items() if key != 'id'}
+    source.write_text(json.dumps(patient) + '\n\n' + json.dumps(invalid) + '\n')
+    conn = FakeAsyncConnection([(patient['id'], 7)])
+    report = {'skipped': {'patients': 0}, 'insert_time': {}, 'inserted': {}}
+    load = {
+        'report': report,
+        'resolvers': {'patient': resolver.ReferenceResolver('patient')},
+        'rejections': rejections.RejectionSink(directory=str(tmp_path)),
+        'metrics': metrics.Metrics(),
+        'incremental': False
+    }
+    committed = {'patient': asyncio.Event()}
+
+    asyncio.run(async_pipeline._load_table(
+        FakeAsyncPool(conn), load, 'patient', str(source), committed))
+    load['rejections'].close()
+
+    assert committed['patient'].is_set()
+    assert [table for table, _ in conn.copied] == ['patient']
+    assert conn.copied[0][1].startswith(patient['id'] + '\t')
+    assert len(conn.commands) == 1 and 'load_stats' in conn.commands[0]
+    assert load['resolvers']['patient'].resolve(patient['id']) == 7
+    assert report['inserted'] == {'patients': 1}
+    assert report['skipped'] == {'patients': 1}
+    assert load['metrics'].value('records_decoded_total', table='patient') == 2
+    assert {stage for (name, labels) in load['metrics'].counters
+            if name == 'stage_seconds_total'
+            for key, stage in labels if key == 'stage'} == {
+        'fetch', 'transform', 'read', 'resolve', 'write'}
+
+
+class NdjsonHandler(http.server.BaseHTTPRequestHandler):
+    body = b''.join(b'{"id": "%d"}\n' % index for index in range(1000))
+    etag = '"v1"'
+    requests = []
+
+    def do_GET(self):
+        self.requests.append(dict(self.headers))
+        if self.headers.get('If-None-Match') == self.etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        body = self.body
+        status = 200
+        range_header = self.headers.get('Range')
+        if range_header and self.headers.get('If-Range') == self.etag:
+            offset = int(range_header[len('bytes='):-1])
+            body = body[offset:]
+            status = 206
+        self.send_response(status)
+        self.send_header('ETag', self.etag)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def ndjson_server():
+    NdjsonHandler.requests = []
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), NdjsonHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f'http://127.0.0.1:{server.server_port}/Patient.ndjson'
+    server.shutdown()
+    server.server_close()
+
+
+def test_download_is_cached_and_revalidated(tmp_path, ndjson_server):
+    cache_dir = str(tmp_path)
+
+    paths = downloads.download_sources(
+        {'patient': ndjson_server, 'encounter': 'Encounter.ndjson'}, cache_dir)
+    path = downloads.download(ndjson_server, cache_dir)
+
+    assert paths == {'patient': path, 'encounter': 'Encounter.ndjson'}
+    assert path.endswith('Patient.ndjson')
+    with open(path, 'rb') as f:
+        assert f.read() == NdjsonHandler.body
+    assert NdjsonHandler.requests[1]['If-None-Match'] == NdjsonHandler.etag
+    assert downloads.download(ndjson_server, cache_dir, revalidate=False) == path
+    assert len(NdjsonHandler.requests) == 2
+
+
+def test_interrupted_download_is_resumed(tmp_path, ndjson_server):
+    cache_dir = str(tmp_path)
+    part = downloads.cache_path(ndjson_server, cache_dir) + '.part'
+    os.makedirs(os.path.dirname(part))
+    with open(part, 'wb') as f:
+        f.write(NdjsonHandler.body[:100])
+    with open(part + '.json', 'w') as f:
+        json.dump({'link': ndjson_server, 'etag': NdjsonHandler.etag}, f)
+
+    path = downloads.download(ndjson_server, cache_dir)
+
+    assert NdjsonHandler.requests[0]['Range'] == 'bytes=100-'
+    with open(path, 'rb') as f:
+        assert f.read() == NdjsonHandler.body
+    assert not os.path.exists(part)
+
+
+Column = collections.namedtuple('Column', 'name type_code precision scale',
+                                defaults=(None, None))
+
+
+class FakeExportCursor:
+    description = [Column('id', 23), Column('type_code', 1043),
+                   Column('value', 1700), Column('dose', 1700, 6, 3),
+                   Column('observation_date', 1184), Column('month', 25)]
+
+    def __init__(self, rows):
+        self.rows = rows
+        self.connection = self
+
+    def cursor(self, name):
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def execute(self, command):
+        self.command = command
+
+    def fetchmany(self, size):
+        rows, self.rows = self.rows[:size], self.rows[size:]
+        return rows
+
+
+def test_export_table_writes_partitioned_parquet(monkeypatch, tmp_path):
+    pyarrow_dataset = pytest.importorskip('pyarrow.dataset')
+    monkeypatch.setitem(export_tables.LOAD_SETTINGS, 'BATCH_SIZE', 2)
+    date = datetime.datetime(2012, 4, 1, tzinfo=datetime.timezone.utc)
+    value = decimal.Decimal('0.123456789012345678')
+    rows = [(id, code, value, decimal.Decimal('1.5'), date, '2012-04')
+            for id, code in enumerate(['8302-2', '29463-7', '8302-2'])]
+    cur = FakeExportCursor(rows)
+
+    exported = export_tables.export_table(cur, 'observation', str(tmp_path))
+    dataset = pyarrow_dataset.dataset(
+        str(tmp_path / 'observation'), format='parquet', partitioning='hive')
+
+    assert exported == 3
+    assert "AT TIME ZONE 'UTC'" in cur.command
+    assert (tmp_path / 'observation' / 'type_code=8302-2' / 'month=2012-04').is_dir()
+    assert sorted(dataset.to_table().column('id').to_pylist()) == [0, 1, 2]
+    assert dataset.to_table().column('value').to_pylist() == [value] * 3
+    assert str(dataset.schema.field('dose').type) == 'decimal128(6, 3)'
+
+
+@pytest.fixture
+def sqlite_db(monkeypatch, tmp_path):
+    """
+    Loads into SQLite db files in tmp_path with rejection logs and metrics
+    saved next to them. Returns function which switches to the named db
+    file and creates its tables
+    """
+    monkeypatch.setitem(storage.DB_SETTINGS, 'BACKEND', 'sqlite')
+    monkeypatch.setitem(populate_tables.LOAD_SETTINGS, 'REJECTIONS_DIR', str(tmp_path))
+    monkeypatch.setitem(populate_tables.LOAD_SETTINGS, 'METRICS_DIR', str(tmp_path))
+
+    def create_db(name='db.sqlite'):
+        monkeypatch.setitem(storage.DB_SETTINGS, 'SQLITE_PATH', str(tmp_path / name))
+        create_tables.create_tables()
+
+    return create_db
+
+
+def test_sqlite_backend_loads_and_reports(monkeypatch, tmp_path, sqlite_db, capsys):
+    counts = synthetic.generate(str(tmp_path / 'data'), 500, invalid_rate=0)
+    paths = synthetic.resource_paths(str(tmp_path / 'data'))
+
+    pool = FakePool()
+    monkeypatch.setattr(common, '_pool', pool)
+
+    sqlite_db()
+    populate_tables.populate_tables(paths)
+    capsys.readouterr()
+    reports = []
+    for source in ('stats', 'views', 'tables'):
+        process_tables.process_tables(source)
+        reports.append(capsys.readouterr().out)
+
+    assert pool.closed and common._pool is None
+    assert reports[0] == reports[1] == reports[2]
+    assert f'* in Patient table - {counts["patient"]} records' in reports[0]
+    assert f'* in Encounter table - {counts["encounter"]} records' in reports[0]
+    assert f'* in Procedure table - {counts["procedure"]} records' in reports[0]
+
+
+def test_rows_rejected_by_db_are_logged_and_batch_is_written(monkeypatch, tmp_path,
+                                                             sqlite_db, capsys):
+    monkeypatch.setitem(populate_tables.LOAD_SETTINGS, 'BATCH_SIZE', 50)
+    counts = synthetic.generate(str(tmp_path / 'data'), 500, invalid_rate=0)
+    paths = synthetic.resource_paths(str(tmp_path / 'data'))
+    with open(paths['patient']) as f:
+        duplicate = f.readline()
+    with open(paths['patient'], 'a') as f:
+        f.write(duplicate)
+
+    sqlite_db()
+    populate_tables.populate_tables(paths)
+
+    with common.db_cursor() as cur:
+        cur.execute('SELECT COUNT(*) FROM patient')
+        loaded_patients = cur.fetchone()[0]
+        cur.execute("SELECT count FROM load_stats WHERE stat = 'rows' AND key = 'patient'")
+        counted_patients = cur.fetchone()[0]
+        cur.execute('SELECT COUNT(*) FROM encounter')
+        loaded_encounters = cur.fetchone()[0]
+    with open(tmp_path / 'skipped_patients.ndjson') as f:
+        skipped = [json.loads(line) for line in f]
+    assert 'There were 1 skipped patients' in capsys.readouterr().out
+    assert loaded_patients == counted_patients == counts['patient']
+    assert loaded_encounters == counts['encounter']
+    assert [record['reason'] for record in skipped] == ['database_error']
+    assert 'UNIQUE constraint failed' in skipped[0]['error']
+    assert skipped[0]['resource'] == json.loads(duplicate)
+
+
+def test_row_rejected_when_its_batch_is_flushed_is_not_counted(monkeypatch, tmp_path,
+                                                               sqlite_db):
+    monkeypatch.setitem(populate_tables.LOAD_SETTINGS, 'BATCH_SIZE', 2)
+    counts = synthetic.generate(str(tmp_path / 'data'), 100, invalid_rate=0)
+    paths = synthetic.resource_paths(str(tmp_path / 'data'))
+    with open(paths['patient']) as f:
+        patients = [json.loads(line) for line in f]
+    # The duplicate is the last row of the first batch and the only one
+    # of its gender
+    patients.insert(1, dict(patients[0], gender='other'))
+    with open(paths['patient'], 'w') as f:
+        f.writelines(json.dumps(patient) + '\n' for patient in patients)
+
+    sqlite_db()
+    populate_tables.populate_tables(paths)
+
+    with common.db_cursor() as cur:
+        cur.execute("SELECT key, count FROM load_stats WHERE stat IN ('rows', 'gender')")
+        stats = dict(cur.fetchall())
+    with open(tmp_path / 'skipped_patients.ndjson') as f:
+        assert [json.loads(line)['reason'] for line in f] == ['database_error']
+    assert 'other' not in stats
+    assert stats['patient'] == counts['patient']
+    assert all(count > 0 for count in stats.values())
+
+
+def test_load_stats_do_not_save_uncounted_keys(monkeypatch):
+    monkeypatch.setitem(storage.DB_SETTINGS, 'BACKEND', 'sqlite')
+    saved = []
+
+    class FakeStatsCursor:
+        def executemany(self, command, rows):
+            saved.extend(rows)
+
+    stats = load_stats.LoadStats('procedure')
+    stats.counts.update({('rows', 'procedure'): 1, ('procedure_type', 'x' * 45): 0})
+
+    stats.save(FakeStatsCursor())
+
+    assert saved == [('rows', 'procedure', 1)]
+    assert stats.counts == {}
+
+
+def test_encounter_with_invalid_start_date_is_rejected(tmp_path, sqlite_db, capsys):
+    counts = synthetic.generate(str(tmp_path / 'data'), 500, invalid_rate=0)
+    paths = synthetic.resource_paths(str(tmp_path / 'data'))
+    with open(paths['encounter']) as f:
+        encounters = [json.loads(line) for line in f]
+    encounters[0]['period']['start'] = '2020-13-45'
+    with open(paths['encounter'], 'w') as f:
+        f.writelines(json.dumps(encounter) + '\n' for encounter in encounters)
+
+    sqlite_db()
+    populate_tables.populate_tables(paths)
+
+    with common.db_cursor() as cur:
+        cur.execute('SELECT COUNT(*) FROM patient')
+        loaded_patients = cur.fetchone()[0]
+        cur.execute('SELECT COUNT(*) FROM encounter')
+        loaded_encounters = cur.fetchone()[0]
+        cur.execute("SELECT SUM(count) FROM load_stats WHERE stat = 'encounter_day'")
+        counted_encounters = cur.fetchone()[0]
+    with open(tmp_path / 'skipped_encounters.ndjson') as f:
+        skipped = [json.loads(line) for line in f]
+    assert 'There were 1 skipped encounters' in capsys.readouterr().out
+    assert loaded_patients == counts['patient']
+    assert loaded_encounters == counted_encounters == counts['encounter'] - 1
+    assert [record['reason'] for record in skipped] == ['invalid_value']
+    assert 'month must be in 1..12' in skipped[0]['error']
+
+
+@pytest.mark.parametrize('parallel', [False, True])
+def test_sharded_load_matches_serial_load(monkeypatch, tmp_path, sqlite_db, capsys,
+                                          parallel):
+    monkeypatch.setitem(populate_tables.LOAD_SETTINGS, 'BATCH_SIZE', 50)
+    synthetic.generate(str(tmp_path / 'data'), 1000, component_rate=0.5)
+    paths = synthetic.resource_paths(str(tmp_path / 'data'))
+    loads = []
+    for shards in (0, 3):
+        directory = tmp_path / f'shards_{shards}'
+        monkeypatch.setitem(populate_tables.LOAD_SETTINGS, 'REJECTIONS_DIR', str(directory))
+        os.makedirs(directory)
+        sqlite_db(f'shards_{shards}/db.sqlite')
+        capsys.readouterr()
+        populate_tables.populate_tables(paths, parallel=parallel and shards > 0,
+                                        shards=shards)
+        output = capsys.readouterr().out
+        with common.db_cursor() as cur:
+            cur.execute('SELECT source_id, patient_id, encounter_id, value '
+                        'FROM observation ORDER BY source_id, type_code')
+            observations = cur.fetchall()
+            cur.execute('SELECT stat, key, count FROM load_stats ORDER BY stat, key')
+            stats = cur.fetchall()
+        with open(directory / 'skipped_observations.ndjson') as f:
+            skipped = sorted(f)
+        loads.append((observations, stats, skipped,
+                      sorted(line for line in output.splitlines() if 'skipped' in line)))
+
+    with open(tmp_path / 'metrics.json') as f:
+        sharded_metrics = json.load(f)
+    assert sharded_metrics['counters']['shards_total'] == [
+        {'labels': {'table': 'observation'}, 'value': 3}]
+    assert loads[0] == loads[1]
+    assert loads[0][2]
+
+
+def test_sharded_incremental_load_reads_content_hashes_once(monkeypatch, tmp_path,
+                                                            sqlite_db, capsys):
+    counts = synthetic.generate(str(tmp_path / 'data'), 300, invalid_rate=0)
+    paths = synthetic.resource_paths(str(tmp_path / 'data'))
+    loaded_hashes = []
+    load_content_hashes = populate_tables._load_content_hashes
+
+    def counting_load_content_hashes(cur, table):
+        loaded_hashes.append(table)
+        return load_content_hashes(cur, table)
+
+    sqlite_db()
+    populate_tables.populate_tables(paths, shards=3)
+    monkeypatch.setattr(populate_tables, '_load_content_hashes',
+                        counting_load_content_hashes)
+    capsys.readouterr()
+    populate_tables.populate_tables(paths, incremental=True, shards=3)
+
+    assert loaded_hashes.count('observation') == 1
+    assert f'There were {counts["observation"]} unchanged observations' in \
+        capsys.readouterr().out
+
+    def failing_load_content_hashes(cur, table):
+        raise AssertionError('shard worker read content hashes')
+
+    with common.db_cursor() as cur:
+        hashes = load_content_hashes(cur, 'patient')
+    monkeypatch.setattr(populate_tables, '_load_content_hashes',
+                        failing_load_content_hashes)
+    monkeypatch.setattr(shards, '_resolvers', {})
+    monkeypatch.setattr(shards, '_content_hashes', hashes)
+    pool = FakePool()
+    monkeypatch.setattr(common, '_pool', pool)
+    skipped, unchanged, *_ = shards._load_range(
+        'patient', paths['patient'], 0, None, True, str(tmp_path / 'shard'))
+
+    assert unchanged['patients'] == counts['patient']
+    assert pool.closed and common._pool is None
+
+
+def _change_resources(path, change):
+    with open(path) as f:
+        resources = [json.loads(line) for line in f]
+    for resource in resources[::3]:
+        resource['meta']['versionId'] = '2'
+        change(resource)
+    with open(path, 'w') as f:
+        f.writelines(json.dumps(resource) + '\n' for resource in resources)
+
+
+def _shift_start(encounter):
+    start = datetime.datetime.fromisoformat(encounter['period']['start'])
+    encounter['period']['start'] = (start + datetime.timedelta(days=1)).isoformat()
+
+
+def _drop_component(observation):
+    if 'component' in observation:
+        observation['component'].pop()
+
+
+@pytest.mark.parametrize('shards', [0, 3])
+def test_incremental_load_merges_statistics_of_changed_rows(monkeypatch, tmp_path,
+                                                            sqlite_db, shards):
+    synthetic.generate(str(tmp_path / 'data'), 500, component_rate=0.5, invalid_rate=0)
+    paths = synthetic.resource_paths(str(tmp_path / 'data'))
+
+    def load_stats_rows():
+        with common.db_cursor() as cur:
+            cur.execute('SELECT stat, key, count FROM load_stats ORDER BY stat, key')
+            return cur.fetchall()
+
+    sqlite_db()
+    populate_tables.populate_tables(paths, shards=shards)
+    _change_resources(paths['patient'], lambda patient: patient.update(
+        gender={'male': 'female', 'female': 'male'}[patient['gender']]))
+    _change_resources(paths['encounter'], _shift_start)
+    _change_resources(paths['procedure'], lambda procedure: procedure['code'].update(
+        coding=[{'code': '73761001', 'system': 'http://snomed.info/sct'}]))
+    _change_resources(paths['observation'], _drop_component)
+    monkeypatch.setattr(load_stats.LoadStats, 'rebuild', None)
+    populate_tables.populate_tables(paths, incremental=True, shards=shards)
+    incremental = load_stats_rows()
+
+    sqlite_db('full.sqlite')
+    populate_tables.populate_tables(paths)
+
+    assert incremental == load_stats_rows()
+
+
+def test_normalized_codes_keep_denormalized_shape(monkeypatch, tmp_path, sqlite_db,
+                                                  capsys):
+    synthetic.generate(str(tmp_path / 'data'), 500, component_rate=0.5)
+    paths = synthetic.resource_paths(str(tmp_path / 'data'))
+    loads = []
+    for normalized in (False, True):
+        monkeypatch.setitem(populate_tables.LOAD_SETTINGS, 'NORMALIZED_CODES', normalized)
+        sqlite_db(f'normalized_{normalized}.sqlite')
+        populate_tables.populate_tables(paths)
+        capsys.readouterr()
+        reports = []
+        for source in ('stats', 'views', 'tables'):
+            process_tables.process_tables(source)
+            reports.append(capsys.readouterr().out)
+        with common.db_cursor() as cur:
+            rows = []
+            for table in ('procedure', 'observation'):
+                cur.execute(f'SELECT * FROM {codes.readable_table(table)} ORDER BY id')
+                rows.append(([column[0] for column in cur.description], cur.fetchall()))
+        loads.append((rows, reports))
+
+    with common.db_cursor() as cur:
+        cur.execute('SELECT COUNT(*) FROM code_system')
+        systems = cur.fetchone()[0]
+        cur.execute('SELECT * FROM observation')
+        columns = [column[0] for column in cur.description]
+    assert loads[0] == loads[1]
+    assert all(table_rows for _, table_rows in loads[1][0])
+    assert loads[1][1][0] == loads[1][1][1] == loads[1][1][2]
+    assert 0 < systems < 5
+    assert 'type_code_id' in columns and 'type_code' not in columns
+
+
+def test_deferred_indexes_are_built_after_failed_load(monkeypatch, tmp_path, sqlite_db,
+                                                      capsys):
+    synthetic.generate(str(tmp_path / 'data'), 100)
+    paths = synthetic.resource_paths(str(tmp_path / 'data'))
+
+    def failing_transform(table, data, line=None):
+        raise RuntimeError('connection lost')
+
+    sqlite_db()
+    monkeypatch.setattr(populate_tables, '_transform', failing_transform)
+    populate_tables.populate_tables(paths, defer_indexes=True)
+
+    with common.db_cursor() as cur:
+        cur.execute("SELECT name FROM sqlite_master WHERE type = 'index'")
+        indexes = {name for name, in cur.fetchall()}
+    output = capsys.readouterr().out
+    assert 'connection lost' in output and 'INDEXES BUILT' in output
+    assert set(create_tables.DEFERRED_INDEXES) <= indexes
+
+
+class FakeCodeConnection:
+    autocommit = False
+    closed = 0
+
+    def __init__(self):
+        self.commands = []
+
+    def cursor(self):
+        return FakeCodeCursor(self)
+
+    def close(self):
+        self.closed = 1
+
+
+class FakeCodeCursor:
+    def __init__(self, connection):
+        self.connection = connection
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def execute(self, command, params=None):
+        self.connection.commands.append(command)
+
+    def fetchone(self):
+        return (len(self.connection.commands),)
+
+    def fetchall(self):
+        return []
+
+
+def test_code_cache_interns_codes_outside_connection_pool(monkeypatch):
+    intern_connection = FakeCodeConnection()
+    load_connection = FakeCodeConnection()
+    monkeypatch.setitem(storage.DB_SETTINGS, 'BACKEND', 'postgres')
+    monkeypatch.setattr(common, 'get_db_connection', lambda: intern_connection)
+    monkeypatch.setattr(common, 'db_cursor', None)
+    cache = codes.CodeCache()
+
+    first = cache.code_id(load_connection.cursor(), 'http://loinc.org', '8302-2')
+    again = cache.code_id(load_connection.cursor(), 'http://loinc.org', '8302-2')
+    unit = cache.code_id(load_connection.cursor(), 'http://unitsofmeasure.org', 'cm')
+    cache.close()
+
+    assert first == again != unit
+    assert cache.code_id(load_connection.cursor(), None, None) is None
+    assert len(load_connection.commands) == 2
+    assert len(intern_connection.commands) == 8
+    assert intern_connection.autocommit and intern_connection.closed
+
+
+def test_skip_committed_checks_last_committed_resource():
+    lines = ['{"id": 1}\n', '\n', '{"id": 2}\n', '{"id": 3}\n']
+    checkpoint = {'source': 'Observation.ndjson', 'line': 2,
+                  'content_hash': checkpoints.line_hash('{"id": 2}'),
+                  'done': False}
+
+    assert list(checkpoints.skip_committed(lines, checkpoint)) == ['{"id": 3}\n']
+    assert list(checkpoints.skip_committed(lines, dict(checkpoint, done=True))) == []
+    with pytest.raises(ValueError):
+        list(checkpoints.skip_committed(
+            lines, dict(checkpoint, content_hash=checkpoints.line_hash('{"id": 1}'))))
+
+
+def test_checkpointed_load_resumes_after_failure(monkeypatch, tmp_path, sqlite_db,
+                                                 capsys):
+    monkeypatch.setitem(populate_tables.LOAD_SETTINGS, 'BATCH_SIZE', 50)
+    synthetic.generate(str(tmp_path / 'data'), 1000, component_rate=0.5,
+                       invalid_rate=0)
+    paths = synthetic.resource_paths(str(tmp_path / 'data'))
+    transform = populate_tables._transform
+    observations = []
+
+    def failing_transform(table, data, line=None):
+        if table == 'observation':
+            observations.append(data)
+            if len(observations) == 500:
+                raise RuntimeError('connection lost')
+        return transform(table, data, line)
+
+    def loaded_tables():
+        with common.db_cursor() as cur:
+            counts = {}
+            for table in populate_tables.TABLES:
+                cur.execute(f'SELECT COUNT(*) FROM {table}')
+                counts[table] = cur.fetchone()[0]
+            cur.execute('SELECT stat, key, count FROM load_stats ORDER BY stat, key')
+            return counts, cur.fetchall()
+
+    sqlite_db('full.sqlite')
+    populate_tables.populate_tables(paths, checkpoint=True)
+    uninterrupted = loaded_tables()
+
+    sqlite_db()
+    monkeypatch.setattr(populate_tables, '_transform', failing_transform)
+    populate_tables.populate_tables(paths, checkpoint=True)
+    monkeypatch.setattr(populate_tables, '_transform', transform)
+    with common.db_cursor() as cur:
+        cur.execute('SELECT table_name, line, done FROM load_checkpoints '
+                    'ORDER BY table_name')
+        interrupted = cur.fetchall()
+    populate_tables.populate_tables(paths, checkpoint=True)
+
+    with common.db_cursor() as cur:
+        cur.execute('SELECT COUNT(*) FROM load_checkpoints')
+        left_checkpoints = cur.fetchone()[0]
+    assert 'connection lost' in capsys.readouterr().out
+    assert dict((table, done) for table, _, done in interrupted) == {
+        'encounter': 1, 'observation': 0, 'patient': 1, 'procedure': 1}
+    assert 400 < dict((table, line) for table, line, _ in interrupted)[
+        'observation'] < 500
+    assert loaded_tables() == uninterrupted
+    assert left_checkpoints == 0
+
+
 if __name__ == '__main__':
     pytest.main()
\ No newline at end of file
@@ -0,0 +1,272 @@
+import argparse
+import datetime
+import gzip
+import os
+import random
+import uuid
+from array import array
+
+from app import json_backend
+
+RESOURCE_FILES = {
+    'patient': 'Patient.ndjson',
+    'encounter': 'Encounter.ndjson',
+    'procedure': 'Procedure.ndjson',
+    'observation': 'Observation.ndjson'
+}
+
+# Share of every resource type in generated dataset, observations
+# take the rest
+SHARES = {
+    'patient': 0.01,
+    'encounter': 0.1,
+    'procedure': 0.15
+}
+
+RACES = [('2106-3', 'White'), ('2054-5', 'Black or African American'),
+         ('2028-9', 'Asian'), ('1002-5', 'American Indian or Alaska Native')]
+ETHNICITIES = [('2186-5', 'Nonhispanic'), ('2135-2', 'Hispanic or Latino')]
+ENCOUNTER_TYPES = ['185345009', '270427003', '50849002', '183452005']
+PROCEDURE_TYPES = ['428191000124101', '430193006', '73761001', '399208008',
+                   '117015009', '183450002', '23426006', '90226004',
+                   '76601001', '171207006', '274804006', '65200003']
+OBSERVATIONS = [('8302-2', 'Body Height', 'cm'), ('29463-7', 'Body Weight', 'kg'),
+                ('39156-5', 'Body Mass Index', 'kg/m2'),
+                ('2571-8', 'Triglycerides', 'mg/dL'),
+                ('2093-3', 'Total Cholesterol', 'mg/dL'),
+                ('4548-4', 'Hemoglobin A1c', '%')]
+BLOOD_PRESSURE = [('8480-6', 'Systolic Blood Pressure'),
+                  ('8462-4', 'Diastolic Blood Pressure')]
+START_DATE = datetime.datetime(2000, 1, 1, tzinfo=datetime.timezone.utc)
+
+
+def generate(output, resources, seed=0, component_rate=0.1, invalid_rate=0.01,
+             compress=False):
+    """
+    Writes deterministic Synthea-shaped Patient, Encounter, Procedure and
+    Observation ndjson files with about the given number of resources.
+    Part of observations have components and part of all resources
+    are invalid and must be skipped by loader. Returns number of
+    generated resources by type
+    """
+    counts = _counts(resources)
+    rng = random.Random(seed)
+    os.makedirs(output, exist_ok=True)
+    encounter_patients = array('I')
+
+    with _open(output, 'patient', compress) as f:
+        for index in range(counts['patient']):
+            _write(f, _patient(rng, seed, index, _invalid(rng, invalid_rate)))
+
+    with _open(output, 'encounter', compress) as f:
+        for index in range(counts['encounter']):
+            patient = rng.randrange(counts['patient'])
+            encounter_patients.append(patient)
+            _write(f, _encounter(rng, seed, index, patient,
+                                 _invalid(rng, invalid_rate)))
+
+    with _open(output, 'procedure', compress) as f:
+        for index in range(counts['procedure']):
+            encounter = rng.randrange(counts['encounter'])
+            _write(f, _procedure(rng, seed, index, encounter,
+                                 encounter_patients[encounter],
+                                 _invalid(rng, invalid_rate)))
+
+    with _open(output, 'observation', compress) as f:
+        for index in range(counts['observation']):
+            encounter = rng.randrange(counts['encounter'])
+            _write(f, _observation(rng, seed, index, encounter,
+                                   encounter_patients[encounter],
+                                   rng.random() < component_rate,
+                                   _invalid(rng, invalid_rate)))
+    return counts
+
+
+def resource_paths(output, compress=False):
+    """
+    Returns paths of generated files by table
+    """
+    suffix = '.gz' if compress else ''
+    return {table: os.path.join(output, name + suffix)
+            for table, name in RESOURCE_FILES.items()}
+
+
+def _counts(resources):
+    counts = {table: max(1, int(resources * share))
+              for table, share in SHARES.items()}
+    counts['observation'] = max(1, resources - sum(counts.values()))
+    return counts
+
+
+def _open(output, table, compress):
+    path = resource_paths(output, compress)[table]
+    if compress:
+        return gzip.open(path, 'wt')
+    return open(path, 'w')
+
+
+def _write(f, data):
+    f.write(json_backend.dumps(data))
+    f.write('\n')
+
+
+def _invalid(rng, invalid_rate):
+    return rng.random() < invalid_rate
+
+
+def _id(seed, table, index):
+    kind = list(RESOURCE_FILES).index(table) + 1
+    return str(uuid.UUID(int=(seed << 96) | (kind << 64) | index))
+
+
+def _date(rng):
+    return START_DATE + datetime.timedelta(seconds=rng.randrange(18 * 365 * 86400))
+
+
+def _meta(profile, date):
+    return {
+        'tag': [{'code': 'synthea-7-2017',
+                 'system': 'https://smarthealthit.org/tags'}],
+        'profile': [f'http://standardhealthrecord.org/fhir/StructureDefinition/{profile}'],
+        'versionId': '1',
+        'lastUpdated': date.isoformat()
+    }
+
+
+def _reference(table, id):
+    return {'reference': f'{table.capitalize()}/{id}'}
+
+
+def _coding(code, system, display=None):
+    coding = {'code': code, 'system': system}
+    if display:
+        coding['display'] = display
+    return {'text': display or code, 'coding': [coding]}
+
+
+def _patient(rng, seed, index, invalid):
+    race = rng.choice(RACES)
+    ethnicity = rng.choice(ETHNICITIES)
+    birth_date = _date(rng) - datetime.timedelta(days=rng.randrange(80 * 365))
+    data = {
+        'id': _id(seed, 'patient', index),
+        'meta': _meta('shr-demographics-PersonOfRecord', birth_date),
+        'name': [{'use': 'official', 'given': [f'Given{index}'],
+                  'family': f'Family{index % 997}'}],
+        'text': {'div': '<div xmlns="http://www.w3.org/1999/xhtml">Generated '
+                        'by synthetic generator</div>',
+                 'status': 'generated'},
+        'gender': rng.choice(['male', 'female']),
+        'address': [{'city': 'Boston', 'line': [f'{index} Main Street'],
+                     'state': 'MA', 'country': 'US', 'postalCode': '02184'}],
+        'birthDate': birth_date.date().isoformat(),
+        'extension': [
+            {'url': 'http://hl7.org/fhir/us/core/StructureDefinition/us-core-race',
+             'valueCodeableConcept': _coding(race[0], 'http://hl7.org/fhir/v3/Race', race[1])},
+            {'url': 'http://hl7.org/fhir/us/core/StructureDefinition/us-core-ethnicity',
+             'valueCodeableConcept': _coding(ethnicity[0], 'http://hl7.org/fhir/v3/Ethnicity', ethnicity[1])}
+        ],
+        'identifier': [{'value': _id(seed, 'patient', index),
+                        'system': 'https://github.com/synthetichealth/synthea'}],
+        'resourceType': 'Patient'
+    }
+    if invalid:
+        del data['id']
+    return data
+
+
+def _encounter(rng, seed, index, patient, invalid):
+    start = _date(rng)
+    data = {
+        'id': _id(seed, 'encounter', index),
+        'meta': _meta('shr-encounter-Encounter', start),
+        'type': [_coding(rng.choice(ENCOUNTER_TYPES), 'http://snomed.info/sct')],
+        'class': {'code': 'ambulatory'},
+        'period': {'start': start.isoformat(),
+                   'end': (start + datetime.timedelta(minutes=rng.randrange(15, 240))).isoformat()},
+        'status': 'finished',
+        'subject': _reference('patient', _id(seed, 'patient', patient)),
+        'resourceType': 'Encounter'
+    }
+    if invalid:
+        del data['period']
+    return data
+
+
+def _procedure(rng, seed, index, encounter, patient, invalid):
+    date = _date(rng)
+    data = {
+        'id': _id(seed, 'procedure', index),
+        'meta': _meta('shr-procedure-Procedure', date),
+        'code': _coding(rng.choice(PROCEDURE_TYPES), 'http://snomed.info/sct'),
+        'status': 'completed',
+        'context': _reference('encounter', _id(seed, 'encounter', encounter)),
+        'subject': _reference('patient', _id(seed, 'patient', patient)),
+        'resourceType': 'Procedure'
+    }
+    if rng.random() < 0.5:
+        data['performedDateTime'] = date.isoformat()
+    else:
+        data['performedPeriod'] = {
+            'start': date.isoformat(),
+            'end': (date + datetime.timedelta(minutes=30)).isoformat()}
+    if invalid:
+        del data['code']
+    return data
+
+
+def _observation(rng, seed, index, encounter, patient, with_component, invalid):
+    date = _date(rng)
+    data = {
+        'id': _id(seed, 'observation', index),
+        'meta': _meta('shr-observation-Observation', date),
+        'issued': date.isoformat(),
+        'status': 'final',
+        'context': _reference('encounter', _id(seed, 'encounter', encounter)),
+        'subject': _reference('patient', _id(seed, 'patient', patient)),
+        'category': [{'coding': [{'code': 'vital-signs',
+                                  'system': 'http://hl7.org/fhir/observation-category'}]}],
+        'resourceType': 'Observation',
+        'effectiveDateTime': date.isoformat()
+    }
+    if with_component:
+        data['code'] = _coding('55284-4', 'http://loinc.org', 'Blood Pressure')
+        data['component'] = [
+            {'code': _coding(code, 'http://loinc.org', display),
+             'valueQuantity': _quantity(rng.randrange(60, 180), 'mmHg')}
+            for code, display in BLOOD_PRESSURE
+        ]
+    else:
+        code, display, unit = rng.choice(OBSERVATIONS)
+        data['code'] = _coding(code, 'http://loinc.org', display)
+        data['valueQuantity'] = _quantity(round(rng.uniform(1, 200), 2), unit)
+    if invalid:
+        data.pop('valueQuantity', None)
+        data['valueString'] = 'Not a quantity'
+        for component in data.get('component', []):
+            del component['valueQuantity']
+    return data
+
+
+def _quantity(value, unit):
+    return {'code': unit, 'unit': unit, 'value': value,
+            'system': 'http://unitsofmeasure.org/'}
+
+
+def _parse_args():
+    parser = argparse.ArgumentParser(
+        description='Generate synthetic FHIR ndjson files')
+    parser.add_argument('output', help='directory for generated files')
+    parser.add_argument('--resources', type=int, default=10000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--component-rate', type=float, default=0.1)
+    parser.add_argument('--invalid-rate', type=float, default=0.01)
+    parser.add_argument('--compress', action='store_true')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = _parse_args()
+    counts = generate(args.output, args.resources, args.seed,
+                      args.component_rate, args.invalid_rate, args.compress)
+    print(counts)